@@ -1,4 +1,6 @@
 import os
+import json
+import sqlite3
 import argparse
 from datasets import load_dataset
 from pathlib import Path
@@ -6,7 +8,8 @@ from tqdm import tqdm
 import logging
 import time
 import random
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import shard_io
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -15,7 +18,7 @@ MAX_FILE_SIZE_BYTES = 1 * 1024 * 1024
 MIN_LINE_COUNT = 5
 ALLOWED_EXTENSIONS = {'.py', '.java', '.cpp', '.h', '.cc', '.cxx', '.hpp'}
 EXCLUDED_DIRS = {'node_modules', 'venv', '__pycache__', 'target', 'dist', 'build', 'bin', 'obj', 'test', 'tests', 'vendor'}
-BATCH_SIZE = 500
+BATCH_SIZE = 500 # Files per shard (or shard_io.SHARD_MAX_BYTES of content, whichever comes first)
 # OPTIMIZATION: Increased max workers to utilize more I/O bandwidth
 MAX_WORKERS = min(os.cpu_count() * 4, 32) if os.cpu_count() else 8
 
@@ -65,34 +68,87 @@ def is_valid_file(content, filename):
     return True
 
 
-def save_file_batch(batch_data, output_dir):
+class CrawlManifest:
+    """
+    Persistent record of the crawl in SQLite, kept next to the output directory.
+
+    Per language it stores every saved file by its offset in the dataset
+    stream (with the shard holding it), and the offset up to which every sample has been handled (saved
+    or rejected) together with the dataset iterator state at that point. A
+    restarted crawl resumes from there and skips offsets already saved, so
+    reruns are idempotent.
+    """
+    def __init__(self, path):
+        self.conn = sqlite3.connect(str(path))
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                lang TEXT, offset INTEGER, path TEXT, PRIMARY KEY (lang, offset)
+            );
+            CREATE TABLE IF NOT EXISTS progress (
+                lang TEXT PRIMARY KEY, next_offset INTEGER, state TEXT, exhausted INTEGER DEFAULT 0
+            );
+        """)
+
+    def saved_count(self, lang):
+        return self.conn.execute("SELECT COUNT(*) FROM files WHERE lang = ?", (lang,)).fetchone()[0]
+
+    def saved_offsets(self, lang, start):
+        rows = self.conn.execute("SELECT offset FROM files WHERE lang = ? AND offset >= ?", (lang, start))
+        return {offset for (offset,) in rows}
+
+    def resume_point(self, lang):
+        """(next offset, dataset state or None, stream exhausted)."""
+        row = self.conn.execute("SELECT next_offset, state, exhausted FROM progress WHERE lang = ?", (lang,)).fetchone()
+        if row is None:
+            return 0, None, False
+        return row[0], json.loads(row[1]) if row[1] else None, bool(row[2])
+
+    def record(self, lang, files, next_offset=None, state=None, exhausted=False):
+        """Adds saved (offset, path) files and advances the resume point, in one transaction."""
+        with self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO files (lang, offset, path) VALUES (?, ?, ?)",
+                                  [(lang, offset, path) for offset, path in files])
+            if next_offset is not None:
+                self.conn.execute(
+                    "INSERT INTO progress (lang, next_offset, state, exhausted) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(lang) DO UPDATE SET next_offset = excluded.next_offset, "
+                    "state = excluded.state, exhausted = excluded.exhausted",
+                    (lang, next_offset, json.dumps(state) if state is not None else None, int(exhausted)))
+
+    def close(self):
+        self.conn.close()
+
+
+def save_shard(batch_data, output_dir, shard_format):
+    """
+    Writes (offset, content, filename, lang) items as one compressed shard
+    named after the first stream offset, so a rerun rewrites the same shard.
+    The shard is renamed into place once complete. Returns the saved
+    (offset, shard path) pairs.
+    """
     # LOGGING: Input - batch to save
-    logger.info(f"[save_file_batch] Input: Batch of {len(batch_data)} files to {output_dir}")
+    logger.info(f"[save_shard] Input: Batch of {len(batch_data)} files to {output_dir}")
+    if not batch_data:
+        return []
+    
+    first_offset, _, _, lang = batch_data[0]
+    records = [shard_io.make_record(content, filename, lang, offset=offset)
+               for offset, content, filename, lang in batch_data]
+    shard_path = shard_io.write_shard(output_dir / lang / f"{first_offset:09d}", records, shard_format)
+    rel_path = str(shard_path.relative_to(output_dir))
     
-    saved_count = 0
-    for content, filename, lang in batch_data:
-        try:
-            lang_dir = output_dir / lang
-            lang_dir.mkdir(parents=True, exist_ok=True)
-            
-            safe_filename = filename.replace('\\', '/').lstrip('/')
-            safe_filename = safe_filename.replace('/', '_')
-            
-            unique_name = f"{saved_count}_{safe_filename}"
-            file_path = lang_dir / unique_name
-            
-            with open(file_path, 'w', encoding='utf-8', errors='replace') as f:
-                f.write(content)
-            saved_count += 1
-        except Exception as e:
-            logger.debug(f"Failed to save {filename}: {e}")
-            
     # LOGGING: Output - save result
-    logger.info(f"[save_file_batch] Output: Successfully saved {saved_count}/{len(batch_data)} files")
-    return saved_count
+    logger.info(f"[save_shard] Output: Saved {len(records)} files to {rel_path}")
+    return [(offset, rel_path) for offset, _, _, _ in batch_data]
 
 
-def process_language(lang_name, data_dir, output_path, target_samples, hf_token, workers):
+def dataset_state(ds):
+    """Iterator state of a streaming dataset (datasets >= 2.18), or None."""
+    return ds.state_dict() if hasattr(ds, "state_dict") else None
+
+
+def process_language(lang_name, data_dir, output_path, target_samples, hf_token, workers, manifest, shard_format):
     logger.info(f"========== START process_language: {lang_name} ==========")
     logger.info(f"Input: data_dir={data_dir}, target={target_samples}, workers={workers}")
     
@@ -100,6 +156,14 @@ def process_language(lang_name, data_dir, output_path, target_samples, hf_token,
     base_delay = 10
     
     for attempt in range(max_retries):
+        # Every attempt resumes from the manifest instead of the start of the stream
+        start_offset, state, exhausted = manifest.resume_point(lang_name)
+        count = manifest.saved_count(lang_name)
+        if count >= target_samples or exhausted:
+            logger.info(f"{lang_name}: already complete ({count} files saved)")
+            return count
+        already_saved = manifest.saved_offsets(lang_name, start_offset)
+        
         try:
             ds = load_dataset(
                 DATASET_NAME,
@@ -108,72 +172,104 @@ def process_language(lang_name, data_dir, output_path, target_samples, hf_token,
                 streaming=True,
                 token=hf_token
             )
+            if start_offset:
+                logger.info(f"Resuming {lang_name} at offset {start_offset} ({count} files saved)")
+                if state is not None and hasattr(ds, "load_state_dict"):
+                    ds.load_state_dict(state)
+                else:
+                    ds = ds.skip(start_offset)
             
-            count = 0
-            batch = []
-            pbar = tqdm(total=target_samples, desc=f"Downloading {lang_name}", unit="files")
-            
+            pbar = tqdm(total=target_samples, initial=count, desc=f"Downloading {lang_name}", unit="files")
             ds_iter = iter(ds)
+            offset = batch_start = start_offset
+            batch = []
+            batch_bytes = 0
+            pending = {} # future -> (start offset, end offset, dataset state at end, files)
+            in_flight = 0
+            # Batches finish out of order; the resume point only advances over
+            # a contiguous run of finished batches
+            finished = {}
+            frontier, frontier_state = start_offset, state
+            stream_ended = False
             
             with ThreadPoolExecutor(max_workers=workers) as executor:
-                futures = []
+                def submit():
+                    nonlocal batch, batch_start, batch_bytes, in_flight
+                    future = executor.submit(save_shard, batch, output_path, shard_format)
+                    pending[future] = (batch_start, offset, dataset_state(ds), len(batch))
+                    in_flight += len(batch)
+                    batch, batch_start, batch_bytes = [], offset, 0
                 
-                while count < target_samples:
-                    try:
-                        sample = None
-                        iter_retries = 10
-                        
-                        for i in range(iter_retries):
-                            try:
-                                sample = next(ds_iter)
-                                break
-                            except StopIteration:
-                                break
-                            except Exception as e:
-                                if "429" in str(e) or "Too Many Requests" in str(e) or "ConnectionError" in str(e):
-                                    wait_time = base_delay * (1.5 ** i) + random.uniform(1, 5)
-                                    logger.warning(f"Rate limited. Waiting {wait_time:.2f}s... (Attempt {i+1}/{iter_retries})")
-                                    time.sleep(wait_time)
-                                else:
-                                    logger.warning(f"Error fetching sample: {e}. Retrying...")
-                                    time.sleep(1)
-                        
-                        if sample is None:
+                def collect(done):
+                    nonlocal count, in_flight, frontier, frontier_state
+                    for f in done:
+                        start, end, end_state, size = pending.pop(f)
+                        in_flight -= size
+                        saved = f.result()
+                        finished[start] = (end, end_state)
+                        advanced = frontier in finished
+                        while frontier in finished:
+                            frontier, frontier_state = finished.pop(frontier)
+                        manifest.record(lang_name, saved, frontier if advanced else None, frontier_state)
+                        count += len(saved)
+                        pbar.update(len(saved))
+                
+                def drain():
+                    while pending:
+                        done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+                        collect(done)
+                
+                while count + in_flight + len(batch) < target_samples:
+                    sample = None
+                    fetch_error = None
+                    iter_retries = 10
+                    
+                    for i in range(iter_retries):
+                        try:
+                            sample = next(ds_iter)
                             break
-                        
-                        content = sample.get('content', '')
-                        filename = sample.get('max_stars_repo_path', sample.get('path', f'unknown_{count}.txt'))
-                        
-                        if is_valid_file(content, filename):
-                            batch.append((content, filename, lang_name))
-                            
-                            if len(batch) >= BATCH_SIZE:
-                                future = executor.submit(save_file_batch, batch.copy(), output_path)
-                                futures.append(future)
-                                batch.clear()
-                                
-                                for f in list(futures):
-                                    if f.done():
-                                        saved = f.result()
-                                        count += saved
-                                        pbar.update(saved)
-                                        futures.remove(f)
-                                
-                    except StopIteration:
+                        except StopIteration:
+                            break
+                        except Exception as e:
+                            fetch_error = e
+                            if "429" in str(e) or "Too Many Requests" in str(e) or "ConnectionError" in str(e):
+                                wait_time = base_delay * (1.5 ** i) + random.uniform(1, 5)
+                                logger.warning(f"Rate limited. Waiting {wait_time:.2f}s... (Attempt {i+1}/{iter_retries})")
+                                time.sleep(wait_time)
+                            else:
+                                logger.warning(f"Error fetching sample: {e}. Retrying...")
+                                time.sleep(1)
+                    
+                    if sample is None:
+                        if fetch_error is not None:
+                            # A failed stream iterator ends early; record finished batches and retry from the manifest
+                            drain()
+                            raise RuntimeError(f"Dataset stream failed at offset {offset}: {fetch_error}")
+                        stream_ended = True
                         break
-                    except Exception as e:
-                        logger.debug(f"Error in processing loop: {e}")
+                    
+                    sample_offset = offset
+                    offset += 1
+                    if sample_offset in already_saved:
                         continue
+                    
+                    content = sample.get('content', '')
+                    filename = sample.get('max_stars_repo_path', sample.get('path', f'unknown_{sample_offset}.txt'))
+                    
+                    if is_valid_file(content, filename):
+                        batch.append((sample_offset, content, filename, lang_name))
+                        batch_bytes += len(content)
+                        
+                        if len(batch) >= BATCH_SIZE or batch_bytes >= shard_io.SHARD_MAX_BYTES:
+                            submit()
+                            collect([f for f in pending if f.done()])
                 
-                if batch:
-                    future = executor.submit(save_file_batch, batch.copy(), output_path)
-                    futures.append(future)
-                
-                for future in as_completed(futures):
-                    saved = future.result()
-                    count += saved
-                    pbar.update(saved)
+                # The last batch also covers the rejected samples after the last saved one
+                submit()
+                drain()
             
+            if stream_ended:
+                manifest.record(lang_name, [], frontier, frontier_state, exhausted=True)
             pbar.close()
             logger.info(f"========== END process_language: {lang_name} ==========")
             logger.info(f"Output: {count} files saved")
@@ -185,7 +281,7 @@ def process_language(lang_name, data_dir, output_path, target_samples, hf_token,
             time.sleep(wait_time)
     
     logger.error(f"Max retries reached for {lang_name}. Skipping.")
-    return 0
+    return manifest.saved_count(lang_name)
 
 
 def main():
@@ -197,6 +293,9 @@ def main():
     parser.add_argument("--max_samples_cpp", type=int, default=DEFAULT_TARGETS['C++'], help="Max C++ samples")
     parser.add_argument("--hf_token", type=str, default=None, help="HuggingFace API Token")
     parser.add_argument("--workers", type=int, default=MAX_WORKERS, help="Number of parallel workers")
+    parser.add_argument("--shard_format", type=str, default=shard_io.default_format(), choices=list(shard_io.SUFFIXES),
+                        help="Shard format: zstd/gzip-compressed JSONL, plain JSONL or Parquet")
+    parser.add_argument("--manifest", type=str, default=None, help="Crawl manifest for resuming (default: <output_dir>.manifest.sqlite)")
     
     args = parser.parse_args()
     
@@ -208,6 +307,11 @@ def main():
     
     output_path = Path(args.output_dir)
     output_path.mkdir(parents=True, exist_ok=True)
+    # Shards interrupted by a crash are rewritten on resume
+    for tmp in output_path.rglob('.*.tmp'):
+        tmp.unlink()
+    # Kept outside the output directory, which the next stages read file by file
+    manifest = CrawlManifest(args.manifest or f"{output_path}.manifest.sqlite")
     
     total_target = sum(targets.values())
     logger.info(f"Starting crawl from {DATASET_NAME}")
@@ -218,8 +322,10 @@ def main():
     
     for lang_name, data_dir in LANG_MAP.items():
         target = targets[lang_name]
-        count = process_language(lang_name, data_dir, output_path, target, args.hf_token, args.workers)
+        count = process_language(lang_name, data_dir, output_path, target, args.hf_token, args.workers, manifest,
+                                 args.shard_format)
         total_downloaded += count
+    manifest.close()
     
     logger.info(f"Download completed. Total files: {total_downloaded}")
 
@@ -0,0 +1,267 @@
+import re
+import json
+import zlib
+import sqlite3
+import hashlib
+import argparse
+from pathlib import Path
+from tqdm import tqdm
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import cpu_count
+
+import numpy as np
+
+import shard_io
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# MinHash parameters
+NUM_PERM = 128
+SHINGLE_SIZE = 5 # Tokens per shingle
+DEFAULT_THRESHOLD = 0.85 # Estimated Jaccard similarity above which files are near-duplicates
+SEED = 1
+MINHASH_CHUNK = 1024 # Shingles hashed at once; bounds the shingles x permutations temporaries
+
+TOKEN_RE = re.compile(r"\w+")
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+
+_permutations = {}
+
+
+def permutations(num_perm):
+    """Fixed (a, b) pairs of the universal hash family, identical in every process and run."""
+    if num_perm not in _permutations:
+        rng = np.random.RandomState(SEED)
+        a = rng.randint(1, (1 << 61) - 1, size=num_perm, dtype=np.uint64)
+        b = rng.randint(0, (1 << 61) - 1, size=num_perm, dtype=np.uint64)
+        _permutations[num_perm] = (a, b)
+    return _permutations[num_perm]
+
+
+def minhash(content, num_perm=NUM_PERM, shingle_size=SHINGLE_SIZE):
+    """MinHash signature (uint32[num_perm]) of the token shingles of a file."""
+    tokens = TOKEN_RE.findall(content)
+    if len(tokens) < shingle_size:
+        shingles = {" ".join(tokens)}
+    else:
+        shingles = {" ".join(tokens[i:i + shingle_size]) for i in range(len(tokens) - shingle_size + 1)}
+    hashes = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingles), dtype=np.uint64, count=len(shingles))
+    a, b = permutations(num_perm)
+    signature = np.full(num_perm, MAX_HASH, dtype=np.uint64)
+    for start in range(0, len(hashes), MINHASH_CHUNK):
+        # Wrapping uint64 arithmetic, as in datasketch
+        values = ((hashes[start:start + MINHASH_CHUNK, None] * a + b) % MERSENNE_PRIME) & MAX_HASH
+        np.minimum(signature, values.min(axis=0), out=signature)
+    return signature.astype(np.uint32)
+
+
+def lsh_params(threshold, num_perm):
+    """(bands, rows) with bands * rows <= num_perm whose S-curve midpoint (1/b)^(1/r) is closest to the threshold."""
+    best = None
+    for rows in range(1, num_perm + 1):
+        bands = num_perm // rows
+        error = abs((1 / bands) ** (1 / rows) - threshold)
+        if best is None or error < best[0]:
+            best = (error, bands, rows)
+    return best[1], best[2]
+
+
+def band_keys(signature, bands, rows):
+    """One 63-bit bucket key per band (band index included, so a single index column suffices)."""
+    keys = []
+    for band in range(bands):
+        digest = hashlib.blake2b(signature[band * rows:(band + 1) * rows].tobytes(), digest_size=8,
+                                 person=band.to_bytes(2, "little") + b"band").digest()
+        keys.append(int.from_bytes(digest, "little") >> 1)
+    return keys
+
+
+class DedupIndex:
+    """
+    Persistent dedup index in SQLite: content hashes, MinHash signatures and
+    LSH buckets of every kept file. Later crawls are deduplicated against it,
+    and a file already in the index (same source and content hash) is kept on
+    reruns. A source whose content changed is removed and deduplicated again.
+    """
+    def __init__(self, path, num_perm, bands, rows):
+        self.conn = sqlite3.connect(str(path))
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS docs (id INTEGER PRIMARY KEY, source TEXT UNIQUE, sha256 TEXT, signature BLOB);
+            CREATE INDEX IF NOT EXISTS docs_sha256 ON docs (sha256);
+            CREATE TABLE IF NOT EXISTS buckets (key INTEGER, doc_id INTEGER);
+            CREATE INDEX IF NOT EXISTS buckets_key ON buckets (key);
+        """)
+        params = json.dumps({"num_perm": num_perm, "bands": bands, "rows": rows,
+                             "shingle_size": SHINGLE_SIZE, "seed": SEED})
+        stored = self.conn.execute("SELECT value FROM meta WHERE key = 'params'").fetchone()
+        if stored is None:
+            with self.conn:
+                self.conn.execute("INSERT INTO meta (key, value) VALUES ('params', ?)", (params,))
+        elif stored[0] != params:
+            raise ValueError(f"Index {path} was built with {stored[0]}; use the same settings or a new index")
+        self.bands, self.rows = bands, rows
+
+    def lookup_source(self, source):
+        """(id, sha256) of the indexed file of a source, or None."""
+        return self.conn.execute("SELECT id, sha256 FROM docs WHERE source = ?", (source,)).fetchone()
+
+    def remove(self, doc_id):
+        self.conn.execute("DELETE FROM buckets WHERE doc_id = ?", (doc_id,))
+        self.conn.execute("DELETE FROM docs WHERE id = ?", (doc_id,))
+
+    def exact_duplicate(self, sha256):
+        row = self.conn.execute("SELECT source FROM docs WHERE sha256 = ? LIMIT 1", (sha256,)).fetchone()
+        return row[0] if row else None
+
+    def near_duplicate(self, signature, keys, threshold):
+        """Source of an indexed file whose estimated Jaccard similarity reaches the threshold, or None."""
+        marks = ",".join("?" * len(keys))
+        rows = self.conn.execute(
+            f"SELECT source, signature FROM docs WHERE id IN (SELECT DISTINCT doc_id FROM buckets WHERE key IN ({marks}))",
+            keys)
+        for source, blob in rows:
+            if np.mean(np.frombuffer(blob, dtype=np.uint32) == signature) >= threshold:
+                return source
+        return None
+
+    def add(self, source, sha256, signature, keys):
+        cur = self.conn.execute("INSERT INTO docs (source, sha256, signature) VALUES (?, ?, ?)",
+                                (source, sha256, signature.tobytes()))
+        self.conn.executemany("INSERT INTO buckets (key, doc_id) VALUES (?, ?)",
+                              [(key, cur.lastrowid) for key in keys])
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def read_records(source_path, input_dir):
+    """Records of a shard, or a one-record list for a loose file (crawls from before sharding)."""
+    if shard_io.shard_format(source_path):
+        return list(shard_io.read_shard(source_path))
+    with open(source_path, 'r', encoding='utf-8', errors='ignore') as f:
+        content = f.read()
+    rel_path = source_path.relative_to(input_dir)
+    return [shard_io.make_record(content, str(rel_path), rel_path.parts[0] if len(rel_path.parts) > 1 else "")]
+
+
+def signature_task(args_tuple):
+    """
+    Hash and MinHash signature of every record of one input, None for records
+    that failed, so positions still match the records. Runs in a worker process.
+    """
+    source_path, input_dir, num_perm = args_tuple
+    items = []
+    try:
+        for rec in read_records(source_path, input_dir):
+            try:
+                items.append((rec.get("sha256") or shard_io.with_content(rec, rec["content"])["sha256"],
+                              minhash(rec["content"], num_perm)))
+            except Exception as e:
+                items.append(None)
+                logger.error(f"Error processing {rec.get('path')} in {source_path}: {e}")
+    except Exception as e:
+        logger.error(f"Error reading {source_path}: {e}")
+    return items
+
+
+def write_task(args_tuple):
+    """Writes the kept records of one input to the output directory."""
+    source_path, input_dir, output_dir, keep = args_tuple
+    if not keep:
+        return 0
+    records = [rec for i, rec in enumerate(read_records(source_path, input_dir)) if i in keep]
+    if not records:
+        return 0
+    if shard_io.shard_format(source_path):
+        shard_io.write_shard(shard_io.output_shard_path(source_path, input_dir, output_dir), records,
+                             shard_io.shard_format(source_path))
+    else:
+        dest_path = output_dir / source_path.relative_to(input_dir)
+        dest_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(dest_path, 'w', encoding='utf-8') as f:
+            f.write(records[0]["content"])
+    return len(records)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Exact and near-duplicate (MinHash/LSH) deduplication of crawled code")
+    parser.add_argument("--input_dir", type=str, default="raw_data", help="Crawler output (shards or files)")
+    parser.add_argument("--output_dir", type=str, default="dedup_data", help="Directory to save deduplicated data")
+    parser.add_argument("--index", type=str, default="dedup_index.sqlite", help="Persistent index shared by successive crawls")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="Jaccard similarity of near-duplicates (0 to 1)")
+    parser.add_argument("--num_perm", type=int, default=NUM_PERM, help="MinHash permutations")
+    parser.add_argument("--workers", type=int, default=None, help="Number of parallel workers (default: CPU count)")
+    parser.add_argument("--report", type=str, default=None, help="Write dedup statistics as JSON")
+
+    args = parser.parse_args()
+
+    workers = args.workers or cpu_count()
+    input_path = Path(args.input_dir)
+    output_path = Path(args.output_dir)
+
+    if not input_path.exists():
+        logger.error(f"Input directory {input_path} does not exist.")
+        return
+
+    sources = shard_io.list_shards(input_path) or sorted(f for f in input_path.rglob('*') if f.is_file())
+    bands, rows = lsh_params(args.threshold, args.num_perm)
+    index = DedupIndex(args.index, args.num_perm, bands, rows)
+    logger.info(f"Found {len(sources)} inputs. LSH: {bands} bands x {rows} rows for threshold {args.threshold}")
+
+    stats = {"files": 0, "exact_duplicates": 0, "near_duplicates": 0, "errors": 0, "kept": 0}
+    keep = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Signatures are computed in parallel; decisions are taken in input
+        # order in this process, so results do not depend on scheduling
+        tasks = [(source, input_path, args.num_perm) for source in sources]
+        for source, items in tqdm(zip(sources, executor.map(signature_task, tasks)), total=len(sources), desc="Dedup"):
+            kept = set()
+            for i, item in enumerate(items):
+                stats["files"] += 1
+                if item is None:
+                    stats["errors"] += 1
+                    continue
+                sha256, signature = item
+                source_id = f"{source.relative_to(input_path)}:{i}"
+                indexed = index.lookup_source(source_id)
+                if indexed and indexed[1] == sha256:
+                    kept.add(i) # Indexed by an earlier run over the same input
+                    continue
+                if indexed:
+                    # Same shard name and offset, different content (a re-crawl): index it afresh
+                    index.remove(indexed[0])
+                if index.exact_duplicate(sha256):
+                    stats["exact_duplicates"] += 1
+                    continue
+                else:
+                    keys = band_keys(signature, bands, rows)
+                    if index.near_duplicate(signature, keys, args.threshold):
+                        stats["near_duplicates"] += 1
+                        continue
+                    index.add(source_id, sha256, signature, keys)
+                    kept.add(i)
+            index.commit()
+            keep[source] = kept
+        stats["kept"] = stats["files"] - stats["exact_duplicates"] - stats["near_duplicates"] - stats["errors"]
+
+        write_args = [(source, input_path, output_path, keep[source]) for source in sources]
+        written = sum(tqdm(executor.map(write_task, write_args), total=len(write_args), desc="Write"))
+    index.close()
+
+    logger.info(f"Deduplication completed. {stats['files']} files: {stats['exact_duplicates']} exact and "
+                f"{stats['near_duplicates']} near duplicates removed, {stats['errors']} dropped on errors, "
+                f"{written} written to {output_path}.")
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump({"config": vars(args), "bands": bands, "rows": rows, **stats}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,8 @@ import logging
 from concurrent.futures import ProcessPoolExecutor
 from multiprocessing import cpu_count
 
+import shard_io
+
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -63,9 +65,27 @@ def process_file(args_tuple):
         logger.error(f"Error processing {input_path}: {e}")
         return False
 
+def process_shard(args_tuple):
+    """Scrubs one shard. Returns the number of records written and of records dropped on errors."""
+    input_shard, output_base = args_tuple
+    scrubber = SecretScrubber()
+    records, dropped = [], 0
+    try:
+        for rec in shard_io.read_shard(input_shard):
+            try:
+                records.append(shard_io.with_content(rec, scrubber.scrub(rec["content"])))
+            except Exception as e:
+                dropped += 1
+                logger.error(f"Error processing {rec.get('path')} in {input_shard}: {e}")
+        shard_io.write_shard(output_base, records, shard_io.shard_format(input_shard))
+    except Exception as e:
+        logger.error(f"Error processing {input_shard}: {e}")
+        return 0, dropped + len(records)
+    return len(records), dropped
+
 def main():
     parser = argparse.ArgumentParser(description="Scrub secrets from code files (Optimized)")
-    parser.add_argument("--input_dir", type=str, default="raw_data", help="Directory containing raw code files")
+    parser.add_argument("--input_dir", type=str, default="dedup_data", help="Directory containing deduplicated (01b_dedup.py) or raw code files")
     parser.add_argument("--output_dir", type=str, default="scrubbed_data", help="Directory to save scrubbed files")
     parser.add_argument("--workers", type=int, default=None, help="Number of parallel workers (default: CPU count)")
     
@@ -80,6 +100,17 @@ def main():
         logger.error(f"Input directory {input_path} does not exist.")
         return
 
+    shards = shard_io.list_shards(input_path)
+    if shards:
+        # Crawler output: one task per shard, written to a shard of the same name
+        logger.info(f"Found {len(shards)} shards to process.")
+        shard_pairs = [(shard, shard_io.output_shard_path(shard, input_path, output_path)) for shard in shards]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(tqdm(executor.map(process_shard, shard_pairs), total=len(shard_pairs)))
+        count, dropped = (sum(column) for column in zip(*results)) if results else (0, 0)
+        logger.info(f"Scrubbing completed. Processed {count} files, dropped {dropped} on errors.")
+        return
+
     files = list(input_path.rglob('*'))
     files = [f for f in files if f.is_file()]
     
@@ -8,6 +8,8 @@ import logging
 from concurrent.futures import ProcessPoolExecutor
 from multiprocessing import cpu_count
 
+import shard_io
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
@@ -117,6 +119,23 @@ def process_file(file_path):
         logger.error(f"Error processing {file_path}: {e}")
         return None
 
+def process_shard(shard_path):
+    """FIM samples of one shard, and the number of records dropped on errors."""
+    samples, dropped = [], 0
+    try:
+        for rec in shard_io.read_shard(shard_path):
+            try:
+                if rec["content"].strip():
+                    sample = create_fim_sample(rec["content"])
+                    if sample:
+                        samples.append(sample)
+            except Exception as e:
+                dropped += 1
+                logger.error(f"Error processing {rec.get('path')} in {shard_path}: {e}")
+    except Exception as e:
+        logger.error(f"Error reading {shard_path}: {e}")
+    return samples, dropped
+
 def main():
     parser = argparse.ArgumentParser(description="Generate FIM Dataset (Optimized for Latency)")
     parser.add_argument("--input_dir", type=str, default="transformed_data", help="Directory containing transformed files")
@@ -132,6 +151,22 @@ def main():
         logger.error(f"Input directory {input_path} does not exist.")
         return
 
+    shards = shard_io.list_shards(input_path)
+    if shards:
+        logger.info(f"Found {len(shards)} shards to process.")
+        count = 0
+        dropped = 0
+        with open(args.output_file, 'w', encoding='utf-8') as outfile:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                for samples, shard_dropped in tqdm(executor.map(process_shard, shards), total=len(shards)):
+                    dropped += shard_dropped
+                    for sample in samples:
+                        json.dump(sample, outfile, ensure_ascii=False)
+                        outfile.write('\n')
+                        count += 1
+        logger.info(f"FIM Generation completed. Generated {count} samples, dropped {dropped} records on errors.")
+        return
+
     files = list(input_path.rglob('*'))
     files = [f for f in files if f.is_file()]
     
@@ -0,0 +1,263 @@
+"""
+Single-pass phase-1 pipeline: scrub -> transform -> FIM in memory.
+
+Runs the same functions as 02_scrubbing.py, 03_transform.py and 04_fim_gen.py
+(SecretScrubber.scrub, CodeTransformer.transform, create_fim_sample), but
+each worker takes a shard (or a chunk of loose files) through all three
+steps at once. The corpus is read once and only the FIM dataset is written,
+instead of two full intermediate copies each rebuilt with rglob.
+--intermediate_dir additionally writes the scrubbed and transformed shards
+for debugging.
+
+With --checkpoint_db, every stage output is checkpointed in SQLite under
+(stage, sha256 of the stage input, stage fingerprint), the fingerprint being
+a hash of the stage script and its parameters; the transform input also
+covers the file extension, which selects the language. On a rerun only
+files whose input or stage changed are reprocessed: after editing the SecretScrubber patterns, files
+the scrubber leaves unchanged reuse their transform and FIM results, and a
+new --dropout_rate only reruns transform and FIM. Transform and FIM are
+seeded from the hash of their input, so reused and recomputed samples are
+identical, and each sample is tagged with the pipeline version.
+
+Usage:
+    python run_pipeline.py --input_dir dedup_data --output_file fim_dataset.jsonl
+    python run_pipeline.py --input_dir dedup_data --checkpoint_db pipeline_checkpoints.sqlite
+"""
+import json
+import zlib
+import random
+import sqlite3
+import hashlib
+import argparse
+import importlib.util
+from pathlib import Path
+from tqdm import tqdm
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import cpu_count
+
+import shard_io
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+SCRIPT_DIR = Path(__file__).resolve().parent
+FILES_PER_TASK = 256 # Loose files per worker task
+STAGES = ("scrub", "transform", "fim")
+
+
+def load_stage(script):
+    """Imports a stage script; the file names start with a digit, so `import` cannot be used."""
+    spec = importlib.util.spec_from_file_location(Path(script).stem.lstrip("0123456789_"), SCRIPT_DIR / script)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+scrubbing = load_stage("02_scrubbing.py")
+transform = load_stage("03_transform.py")
+fim_gen = load_stage("04_fim_gen.py")
+
+
+def digest(text):
+    return hashlib.sha256(text.encode("utf-8", errors="replace")).hexdigest()
+
+
+def stage_fingerprints(dropout_rate):
+    """Hash of each stage's script and parameters; editing either invalidates that stage's checkpoints."""
+    def fingerprint(script, **params):
+        code = hashlib.sha256((SCRIPT_DIR / script).read_bytes()).hexdigest()
+        return digest(json.dumps({"code": code, **params}, sort_keys=True))[:16]
+    return {"scrub": fingerprint("02_scrubbing.py"),
+            "transform": fingerprint("03_transform.py", dropout_rate=dropout_rate),
+            "fim": fingerprint("04_fim_gen.py")}
+
+
+def pipeline_version(fingerprints):
+    return digest(json.dumps([fingerprints[stage] for stage in STAGES]))[:12]
+
+
+class CheckpointStore:
+    """
+    Stage outputs keyed by (stage, input sha256, fingerprint), zlib-compressed
+    in SQLite. Workers open it read-only; only the main process writes.
+    """
+    def __init__(self, path, readonly=False):
+        if readonly:
+            self.conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+            return
+        self.conn = sqlite3.connect(str(path))
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS outputs (stage TEXT, input_sha256 TEXT, fingerprint TEXT, output BLOB,
+                                                PRIMARY KEY (stage, input_sha256, fingerprint))
+        """)
+        self.conn.commit()
+
+    def get(self, stage, input_sha256, fingerprint):
+        row = self.conn.execute("SELECT output FROM outputs WHERE stage = ? AND input_sha256 = ? AND fingerprint = ?",
+                                (stage, input_sha256, fingerprint)).fetchone()
+        return zlib.decompress(row[0]).decode("utf-8") if row else None
+
+    def put_many(self, entries):
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO outputs (stage, input_sha256, fingerprint, output) VALUES (?, ?, ?, ?)",
+                                  [(stage, sha, fp, zlib.compress(output.encode("utf-8"), 6))
+                                   for stage, sha, fp, output in entries])
+
+    def prune(self, fingerprints):
+        """Deletes the checkpoints of stage versions other than the current ones."""
+        with self.conn:
+            return sum(self.conn.execute("DELETE FROM outputs WHERE stage = ? AND fingerprint != ?",
+                                         (stage, fp)).rowcount for stage, fp in fingerprints.items())
+
+    def close(self):
+        self.conn.close()
+
+
+def read_inputs(task):
+    """Records of a shard, or of a chunk of loose files."""
+    source, input_dir = task
+    if isinstance(source, list):
+        records = []
+        for path in source:
+            with open(path, 'r', encoding='utf-8', errors='ignore') as f:
+                rel_path = path.relative_to(input_dir)
+                records.append(shard_io.make_record(f.read(), str(rel_path), rel_path.parts[0] if len(rel_path.parts) > 1 else ""))
+        return records
+    return list(shard_io.read_shard(source))
+
+
+def seeded(input_sha256, func, *args):
+    """Calls a randomized stage with `random` seeded from its input, so its output only depends on input and code."""
+    random.seed(input_sha256)
+    return func(*args)
+
+
+def process_task(args_tuple):
+    """
+    Runs every record of one task through scrub, transform and FIM generation,
+    reusing checkpointed stage outputs. Returns the samples, the new
+    checkpoint entries and per-stage counts of reused/computed outputs.
+    """
+    task, input_dir, dropout_rate, intermediate_dir, task_id, checkpoint_db, fingerprints = args_tuple
+    scrubber = scrubbing.SecretScrubber()
+    transformer = transform.CodeTransformer(import_dropout_rate=dropout_rate)
+    store = CheckpointStore(checkpoint_db, readonly=True) if checkpoint_db else None
+    samples, scrubbed, transformed, entries = [], [], [], []
+    counts = {f"{stage}_{kind}": 0 for stage in STAGES for kind in ("reused", "computed")}
+
+    def run_stage(stage, input_sha256, compute):
+        output = store.get(stage, input_sha256, fingerprints[stage]) if store else None
+        if output is None:
+            output = compute()
+            entries.append((stage, input_sha256, fingerprints[stage], output))
+            counts[f"{stage}_computed"] += 1
+        else:
+            counts[f"{stage}_reused"] += 1
+        return output
+
+    try:
+        records = read_inputs((task, input_dir))
+    except Exception as e:
+        logger.error(f"Error reading task {task_id}: {e}")
+        records = []
+
+    for rec in records:
+        try:
+            source_sha = rec.get("sha256") or digest(rec["content"])
+            content = run_stage("scrub", source_sha, lambda: scrubber.scrub(rec["content"]))
+            sha = digest(content)
+            if intermediate_dir:
+                scrubbed.append({**rec, "content": content, "sha256": sha, "version": fingerprints["scrub"]})
+            name = Path(rec["path"]).name
+            # The extension picks the transform language, so it is part of the stage input.
+            transform_sha = digest(f"{Path(name).suffix}:{sha}")
+            content = run_stage("transform", transform_sha,
+                                lambda: seeded(transform_sha, transformer.transform, content, name))
+            sha = digest(content)
+            if intermediate_dir:
+                transformed.append({**rec, "content": content, "sha256": sha, "version": fingerprints["transform"]})
+            if content.strip():
+                sample = json.loads(run_stage("fim", sha, lambda: json.dumps(seeded(sha, fim_gen.create_fim_sample, content))))
+                if sample:
+                    sample["metadata"]["source_sha256"] = source_sha
+                    samples.append(sample)
+        except Exception as e:
+            logger.error(f"Error processing {rec.get('path')} in task {task_id}: {e}")
+    if store:
+        store.close()
+
+    if intermediate_dir:
+        if isinstance(task, list):
+            base = Path(f"files-{task_id:06d}")
+            fmt = shard_io.default_format()
+        else:
+            base = shard_io.output_shard_path(task, input_dir, "")
+            fmt = shard_io.shard_format(task)
+        shard_io.write_shard(Path(intermediate_dir) / "scrubbed" / base, scrubbed, fmt)
+        shard_io.write_shard(Path(intermediate_dir) / "transformed" / base, transformed, fmt)
+    return samples, entries, counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Single-pass scrub -> transform -> FIM pipeline")
+    parser.add_argument("--input_dir", type=str, default="dedup_data", help="Crawler or dedup output (shards or files)")
+    parser.add_argument("--output_file", type=str, default="fim_dataset.jsonl", help="Output JSONL file")
+    parser.add_argument("--dropout_rate", type=float, default=0.3, help="Rate of import dropout (0.0 to 1.0)")
+    parser.add_argument("--intermediate_dir", type=str, default=None,
+                        help="Also write scrubbed/ and transformed/ shards here (debugging)")
+    parser.add_argument("--workers", type=int, default=None, help="Number of parallel workers (default: CPU count)")
+    parser.add_argument("--checkpoint_db", type=str, default=None,
+                        help="SQLite file of stage checkpoints reused by incremental reruns (default: no checkpointing)")
+    parser.add_argument("--prune", action="store_true", help="Drop checkpoints of older stage versions after the run")
+
+    args = parser.parse_args()
+
+    workers = args.workers or cpu_count()
+    input_path = Path(args.input_dir)
+
+    if not input_path.exists():
+        logger.error(f"Input directory {input_path} does not exist.")
+        return
+
+    tasks = shard_io.list_shards(input_path)
+    if not tasks:
+        files = sorted(f for f in input_path.rglob('*') if f.is_file())
+        tasks = [files[i:i + FILES_PER_TASK] for i in range(0, len(files), FILES_PER_TASK)]
+
+    fingerprints = stage_fingerprints(args.dropout_rate)
+    version = pipeline_version(fingerprints)
+    checkpoint_db = args.checkpoint_db
+    store = CheckpointStore(checkpoint_db) if checkpoint_db else None
+    logger.info(f"Processing {len(tasks)} tasks with {workers} workers. Pipeline version {version} "
+                f"({', '.join(f'{stage} {fp}' for stage, fp in fingerprints.items())})")
+
+    count = 0
+    totals = {}
+    task_args = [(task, input_path, args.dropout_rate, args.intermediate_dir, i, checkpoint_db, fingerprints)
+                 for i, task in enumerate(tasks)]
+    with open(args.output_file, 'w', encoding='utf-8') as outfile:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for samples, entries, counts in tqdm(executor.map(process_task, task_args), total=len(task_args)):
+                if store and entries:
+                    store.put_many(entries)
+                for key, value in counts.items():
+                    totals[key] = totals.get(key, 0) + value
+                for sample in samples:
+                    sample["metadata"]["pipeline_version"] = version
+                    json.dump(sample, outfile, ensure_ascii=False)
+                    outfile.write('\n')
+                    count += 1
+
+    if store:
+        if args.prune:
+            logger.info(f"Pruned {store.prune(fingerprints)} checkpoints of older stage versions.")
+        store.close()
+    logger.info(f"Pipeline completed. Generated {count} FIM samples in {args.output_file}. " +
+                ", ".join(f"{stage}: {totals.get(f'{stage}_reused', 0)} reused / {totals.get(f'{stage}_computed', 0)} computed"
+                          for stage in STAGES))
+
+
+if __name__ == "__main__":
+    main()
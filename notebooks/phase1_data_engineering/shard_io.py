@@ -0,0 +1,125 @@
+"""
+Compressed record shards shared by the phase-1 stages.
+
+A shard holds one record per source file ({"content", "path", "language",
+"sha256", ...}). JSONL shards are compressed with zstd when the zstandard
+package is installed and gzip otherwise; Parquet shards need pyarrow.
+Readers accept every format, and the stages fall back to loose files when
+an input directory has no shards, so older corpora still work.
+"""
+import os
+import io
+import gzip
+import json
+import hashlib
+from pathlib import Path
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# Uncompressed bytes after which the crawler closes a shard
+SHARD_MAX_BYTES = 64 * 1024 * 1024
+SUFFIXES = {"zst": ".jsonl.zst", "gz": ".jsonl.gz", "jsonl": ".jsonl", "parquet": ".parquet"}
+COLUMNS = ["content", "path", "language", "sha256"]
+
+
+def default_format():
+    return "zst" if zstandard else "gz"
+
+
+def make_record(content, path, language, **extra):
+    rec = {"content": content, "path": path, "language": language,
+           "sha256": hashlib.sha256(content.encode("utf-8", errors="replace")).hexdigest()}
+    rec.update(extra)
+    return rec
+
+
+def with_content(rec, content):
+    """Copy of a record with new content and its hash."""
+    return {**rec, "content": content,
+            "sha256": hashlib.sha256(content.encode("utf-8", errors="replace")).hexdigest()}
+
+
+def shard_format(path):
+    name = str(path)
+    for fmt, suffix in SUFFIXES.items():
+        if name.endswith(suffix):
+            return fmt
+    return None
+
+
+def write_shard(path, records, fmt=None):
+    """
+    Writes records to `path` + the format's suffix. The shard is written to a
+    temporary file and renamed into place, so it is either complete or absent.
+    Returns the final path.
+    """
+    fmt = fmt or default_format()
+    path = Path(str(path) + SUFFIXES[fmt])
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+
+    if fmt == "parquet":
+        if pq is None:
+            raise RuntimeError("Parquet shards need pyarrow")
+        columns = {c: [r.get(c) for r in records] for c in COLUMNS}
+        extra = sorted({k for r in records for k in r} - set(COLUMNS))
+        for key in extra:
+            columns[key] = [r.get(key) for r in records]
+        pq.write_table(pa.table(columns), tmp_path, compression="zstd")
+    else:
+        data = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records).encode("utf-8")
+        if fmt == "zst":
+            if zstandard is None:
+                raise RuntimeError("zstd shards need the zstandard package")
+            data = zstandard.ZstdCompressor(level=3).compress(data)
+        elif fmt == "gz":
+            data = gzip.compress(data, compresslevel=6)
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+    os.replace(tmp_path, path)
+    return path
+
+
+def read_shard(path):
+    """Yields the records of one shard."""
+    fmt = shard_format(path)
+    if fmt == "parquet":
+        if pq is None:
+            raise RuntimeError("Parquet shards need pyarrow")
+        for batch in pq.ParquetFile(path).iter_batches():
+            yield from batch.to_pylist()
+        return
+
+    if fmt == "zst":
+        if zstandard is None:
+            raise RuntimeError("zstd shards need the zstandard package")
+        raw = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"))
+    elif fmt == "gz":
+        raw = gzip.open(path, "rb")
+    else:
+        raw = open(path, "rb")
+    with io.TextIOWrapper(raw, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def list_shards(input_dir):
+    """Shards under input_dir in a stable order (temporary files excluded)."""
+    return sorted(p for p in Path(input_dir).rglob("*")
+                  if shard_format(p) and not p.name.startswith(".") and p.is_file())
+
+
+def output_shard_path(shard, input_dir, output_dir):
+    """Destination of a shard in the next stage, without the format suffix."""
+    rel = Path(shard).relative_to(input_dir)
+    return Path(output_dir) / rel.parent / rel.name[:-len(SUFFIXES[shard_format(shard)])]
@@ -1,27 +1,49 @@
 import os
+import re
+import json
+import time
+import random
 import shutil
+import argparse
 import subprocess
 import sys
 from pathlib import Path
 
+import numpy as np
+
 # --- Configuration ---
 BASE_MODEL_ID = "Qwen/Qwen2.5-Coder-0.5B-Instruct"
 ADAPTER_PATH = "/kaggle/input/modell/final_model" # Adjust based on Kaggle input structure
 OUTPUT_DIR = "qwen2.5-coder-0.5b-onnx"
 QUANTIZED_OUTPUT = "qwen2.5-coder-0.5b-onnx-int8"
+STATIC_QUANTIZED_OUTPUT = "qwen2.5-coder-0.5b-onnx-int8-static"
+FIM_DATASET = "fim_dataset.jsonl" # Output of phase1_data_engineering/04_fim_gen.py
+REPORT_PATH = "quantization_report.json"
+
+# Static quantization
+CALIBRATION_SAMPLES = 128
+EVAL_SAMPLES = 64
+MAX_SEQ_TOKENS = 256
+DECODE_STEPS = 16
+# Node name patterns kept in float: the logits projection and the MLP down
+# projections, whose inputs carry the activation outliers of Qwen2-style models
+SENSITIVE_NODES = [r"/lm_head/", r"/mlp/down_proj/"]
+
+STARTUP_REPEATS = 3
+
+# Offline graph optimization uses the naming and external-data check of the
+# serving backend, which loads <name>.optimized.onnx with runtime optimization disabled
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "phase4_deployment"))
+from onnx_backend import has_external_data, optimized_path
 
 def install_dependencies():
     print("Installing dependencies...")
     subprocess.check_call([sys.executable, "-m", "pip", "install", "-q", "optimum[onnxruntime]", "onnx", "onnxruntime", "peft", "transformers", "accelerate", "protobuf==3.20.3"])
 
-def main():
-    install_dependencies()
-    
+def export_model():
     import torch
     from transformers import AutoModelForCausalLM, AutoTokenizer
     from peft import PeftModel
-    from optimum.exporters.onnx import main_export
-    from onnxruntime.quantization import quantize_dynamic, QuantType
 
     # 1. Load and Merge Model
     print("Loading Base Model...")
@@ -34,7 +56,7 @@ def main():
 
     print(f"Loading Adapter from {ADAPTER_PATH}...")
     # Handle case where adapter is inside a subdir or zip (simplified for script)
-    # In Kaggle, usually inputs are unzipped. 
+    # In Kaggle, usually inputs are unzipped.
     # If ADAPTER_PATH doesn't exist, try to find it
     adapter_final_path = ADAPTER_PATH
     if not os.path.exists(ADAPTER_PATH):
@@ -42,51 +64,342 @@ def main():
             if "adapter_config.json" in files:
                 adapter_final_path = root
                 break
-    
+
     print(f"Found adapter at: {adapter_final_path}")
     model = PeftModel.from_pretrained(base_model, adapter_final_path)
-    
+
     print("Merging model...")
     model = model.merge_and_unload()
-    
+
     # Save merged model temporarily for ONNX export
     merged_dir = "merged_model"
     model.save_pretrained(merged_dir)
     tokenizer.save_pretrained(merged_dir)
-    
+
     # 2. Export to ONNX
     print("Exporting to ONNX...")
     # We use optimum's main_export for simplicity and robustness
     # optimum-cli export onnx --model merged_model --task text-generation-with-past qwen2.5-coder-0.5b-onnx
-    
+
     subprocess.run([
         "optimum-cli", "export", "onnx",
         "--model", merged_dir,
         "--task", "text-generation-with-past",
         OUTPUT_DIR
     ], check=True)
-    
-    # 3. Quantize to INT8
-    print("Quantizing to INT8 (Dynamic)...")
-    onnx_model_path = os.path.join(OUTPUT_DIR, "model.onnx")
-    quantized_model_path = os.path.join(QUANTIZED_OUTPUT, "model_int8.onnx")
-    
-    os.makedirs(QUANTIZED_OUTPUT, exist_ok=True)
-    
-    # Copy other necessary files (tokenizer, config, etc.)
+
+def copy_model_files(output_dir):
+    """Copies tokenizer and config files of the export next to a quantized model."""
+    os.makedirs(output_dir, exist_ok=True)
     for file in os.listdir(OUTPUT_DIR):
         if file != "model.onnx" and not file.endswith(".onnx_data"):
-            shutil.copy(os.path.join(OUTPUT_DIR, file), QUANTIZED_OUTPUT)
-            
+            shutil.copy(os.path.join(OUTPUT_DIR, file), output_dir)
+
+def quantize_dynamic_int8(onnx_model_path):
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    print("Quantizing to INT8 (Dynamic)...")
+    quantized_model_path = os.path.join(QUANTIZED_OUTPUT, "model_int8.onnx")
+    copy_model_files(QUANTIZED_OUTPUT)
     quantize_dynamic(
         model_input=onnx_model_path,
         model_output=quantized_model_path,
         weight_type=QuantType.QUInt8
     )
-    
-    print(f"Quantization complete! Model saved to {QUANTIZED_OUTPUT}")
-    print("Files in output:")
-    print(os.listdir(QUANTIZED_OUTPUT))
+    return quantized_model_path
+
+# --- Calibration data ---
+
+def load_fim_samples(path, count, seed=42):
+    """Random FIM samples ({"text": "<PRE> ... <SUF> ... <MID> ..."}) from the 04_fim_gen.py output."""
+    with open(path, "r", encoding="utf-8") as f:
+        samples = [json.loads(line) for line in f if line.strip()]
+    samples = [s for s in samples if " <MID> " in s.get("text", "")]
+    random.Random(seed).shuffle(samples)
+    return samples[:count]
+
+def build_feed(session, input_ids, past=None):
+    """
+    Inputs of a text-generation-with-past export for input_ids following
+    `past` (the present outputs of a previous run, renamed to past_key_values).
+    """
+    names = {i.name for i in session.get_inputs()}
+    past_len = next(iter(past.values())).shape[2] if past else 0
+    n = len(input_ids)
+    feed = {
+        "input_ids": np.array([input_ids], dtype=np.int64),
+        "attention_mask": np.ones((1, past_len + n), dtype=np.int64),
+    }
+    if "position_ids" in names:
+        feed["position_ids"] = np.arange(past_len, past_len + n, dtype=np.int64)[None]
+    if "use_cache_branch" in names:
+        feed["use_cache_branch"] = np.array([past_len > 0])
+    for i in session.get_inputs():
+        if i.name.startswith("past_key_values."):
+            feed[i.name] = past[i.name] if past else np.zeros((1, i.shape[1], 0, i.shape[3]), dtype=np.float32)
+    return feed
+
+def run_with_past(session, input_ids, past=None):
+    """Returns (logits [1, n, vocab], past for the next call)."""
+    names = [o.name for o in session.get_outputs()]
+    outputs = dict(zip(names, session.run(None, build_feed(session, input_ids, past))))
+    new_past = {n.replace("present", "past_key_values", 1): v for n, v in outputs.items() if n.startswith("present")}
+    return outputs["logits"], new_past
+
+class FimCalibrationReader:
+    """
+    CalibrationDataReader over tokenized FIM samples.
+
+    Each sample is fed twice: its first half with an empty KV cache (prompt
+    evaluation) and its second half after the first half's present tensors
+    (decoding with a cache), so attention over past keys is calibrated too.
+    """
+    def __init__(self, model_path, sequences):
+        self.model_path = model_path
+        self.sequences = sequences
+        self.rewind()
+
+    def _feeds(self):
+        import onnxruntime as ort
+
+        session = ort.InferenceSession(self.model_path, providers=["CPUExecutionProvider"])
+        for ids in self.sequences:
+            half = len(ids) // 2
+            if half < 2:
+                yield build_feed(session, ids)
+                continue
+            _, past = run_with_past(session, ids[:half])
+            yield build_feed(session, ids[:half])
+            yield build_feed(session, ids[half:], past)
+
+    def get_next(self):
+        return next(self._iter, None)
+
+    def rewind(self):
+        self._iter = self._feeds()
+
+def resolve_excluded_nodes(onnx_model_path, patterns):
+    """Names of the MatMul nodes matching any of the regex patterns."""
+    import onnx
+
+    model = onnx.load(onnx_model_path, load_external_data=False)
+    regexes = [re.compile(p) for p in patterns]
+    return [node.name for node in model.graph.node
+            if node.op_type == "MatMul" and any(r.search(node.name) for r in regexes)]
+
+def quantize_static_int8(onnx_model_path, sequences, per_channel=True, exclude=SENSITIVE_NODES,
+                         calibrate_method="minmax"):
+    from onnxruntime.quantization import quantize_static, QuantType, QuantFormat, CalibrationMethod
+
+    print(f"Quantizing to INT8 (Static, {len(sequences)} calibration samples)...")
+    quantized_model_path = os.path.join(STATIC_QUANTIZED_OUTPUT, "model_int8_static.onnx")
+    copy_model_files(STATIC_QUANTIZED_OUTPUT)
+
+    nodes_to_exclude = resolve_excluded_nodes(onnx_model_path, exclude)
+    print(f"Keeping {len(nodes_to_exclude)} sensitive MatMul nodes in float")
+    methods = {"minmax": CalibrationMethod.MinMax, "entropy": CalibrationMethod.Entropy,
+               "percentile": CalibrationMethod.Percentile}
+    quantize_static(
+        model_input=onnx_model_path,
+        model_output=quantized_model_path,
+        calibration_data_reader=FimCalibrationReader(onnx_model_path, sequences),
+        quant_format=QuantFormat.QDQ, # Fused into integer MatMuls by the CPU provider
+        op_types_to_quantize=["MatMul"],
+        per_channel=per_channel,
+        activation_type=QuantType.QUInt8, # U8S8: the fast path of the x86 integer kernels
+        weight_type=QuantType.QInt8,
+        nodes_to_exclude=nodes_to_exclude,
+        calibrate_method=methods[calibrate_method],
+        extra_options={"ActivationSymmetric": False, "WeightSymmetric": True},
+    )
+    return quantized_model_path
+
+# --- Offline optimization ---
+
+def optimize_offline(model_path):
+    """
+    Runs ONNX Runtime's graph optimizations once and serializes the result
+    (MatMul+Add, GELU, RMSNorm and QDQ fusions, constant folding). The extended
+    level is used because the full level adds layout transforms specific to
+    the CPU the model is optimized on.
+    """
+    import onnxruntime as ort
+
+    optimized_model_path = optimized_path(model_path)
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+    options.optimized_model_filepath = optimized_model_path
+    if has_external_data(model_path):
+        # Weights in an external file (models over 2GB) stay external
+        options.add_session_config_entry("session.optimized_model_external_initializers_file_name",
+                                         os.path.basename(optimized_model_path) + "_data")
+    ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+    print(f"Optimized graph saved to {optimized_model_path}")
+    return optimized_model_path
+
+def measure_startup(model_path, optimized_model_path, repeats=STARTUP_REPEATS):
+    """Session creation time with runtime optimization vs. loading the pre-optimized graph."""
+    import onnxruntime as ort
+
+    def load_time(path, level):
+        options = ort.SessionOptions()
+        options.graph_optimization_level = level
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    runtime_s = load_time(model_path, ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED)
+    offline_s = load_time(optimized_model_path, ort.GraphOptimizationLevel.ORT_DISABLE_ALL)
+    print(f"Startup {os.path.basename(model_path)}: {runtime_s:.2f}s optimizing at load, "
+          f"{offline_s:.2f}s pre-optimized ({runtime_s / offline_s:.1f}x)")
+    return {"optimized_model": optimized_model_path, "load_s_runtime_optimization": runtime_s,
+            "load_s_preoptimized": offline_s, "speedup": runtime_s / offline_s}
+
+# --- Comparison ---
+
+def evaluate_model(model_path, cases, reference=None, threads=0):
+    """
+    Accuracy and latency of one model on held-out FIM cases.
+
+    Accuracy is the mean negative log-likelihood of the middle given prefix and
+    suffix, and the share of middle positions whose top-1 token matches the
+    reference (float) model. Latency is prompt evaluation plus DECODE_STEPS
+    greedy steps with the KV cache.
+    """
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = threads
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    start = time.perf_counter()
+    session = ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+    load_s = time.perf_counter() - start
+
+    nll, agree, positions = 0.0, 0, 0
+    top1 = []
+    prompt_ms, decode_ms = [], []
+    for i, (prompt_ids, middle_ids) in enumerate(cases):
+        ids = prompt_ids + middle_ids
+        logits, _ = run_with_past(session, ids)
+        logits = logits[0, len(prompt_ids) - 1:-1].astype(np.float64)
+        log_probs = logits - logits.max(axis=-1, keepdims=True)
+        log_probs -= np.log(np.exp(log_probs).sum(axis=-1, keepdims=True))
+        nll -= log_probs[np.arange(len(middle_ids)), middle_ids].sum()
+        predicted = logits.argmax(axis=-1)
+        top1.append(predicted)
+        if reference is not None:
+            agree += int((predicted == reference[i]).sum())
+        positions += len(middle_ids)
+
+        start = time.perf_counter()
+        logits, past = run_with_past(session, prompt_ids)
+        prompt_ms.append((time.perf_counter() - start) * 1000)
+        token = int(logits[0, -1].argmax())
+        start = time.perf_counter()
+        for _ in range(DECODE_STEPS):
+            logits, past = run_with_past(session, [token], past)
+            token = int(logits[0, -1].argmax())
+        decode_ms.append((time.perf_counter() - start) * 1000 / DECODE_STEPS)
+
+    return {
+        "model": model_path,
+        "size_mb": round(sum(p.stat().st_size for p in Path(model_path).parent.glob(Path(model_path).name + "*")) / 2**20, 1),
+        "load_s": round(load_s, 2),
+        "middle_nll": nll / positions if positions else None,
+        "top1_agreement": agree / positions if reference is not None and positions else None,
+        "prompt_eval_ms": float(np.mean(prompt_ms)),
+        "decode_ms_per_token": float(np.mean(decode_ms)),
+    }, top1
+
+def compare_models(models, samples, tokenizer, threads=0):
+    """Evaluates the float model and its quantized variants on the same cases; the first entry is the reference."""
+    cases = []
+    for sample in samples:
+        prompt, middle = sample["text"].split(" <MID> ", 1)
+        prompt_ids = tokenizer(prompt + " <MID> ", add_special_tokens=False)["input_ids"][-MAX_SEQ_TOKENS:]
+        middle_ids = tokenizer(middle, add_special_tokens=False)["input_ids"][:MAX_SEQ_TOKENS - len(prompt_ids)]
+        if prompt_ids and middle_ids:
+            cases.append((prompt_ids, middle_ids))
+
+    results = {}
+    reference = None
+    for name, path in models:
+        print(f"Evaluating {name} ({path}) on {len(cases)} cases...")
+        results[name], top1 = evaluate_model(path, cases, reference, threads)
+        if reference is None:
+            reference = top1
+
+    print(f"\n{'model':<10} {'size MB':>8} {'NLL':>7} {'top-1 agr':>10} {'prompt ms':>10} {'ms/token':>9}")
+    for name, r in results.items():
+        agreement = f"{r['top1_agreement'] * 100:.1f}%" if r["top1_agreement"] is not None else "-"
+        print(f"{name:<10} {r['size_mb']:>8.0f} {r['middle_nll']:>7.3f} {agreement:>10} "
+              f"{r['prompt_eval_ms']:>10.1f} {r['decode_ms_per_token']:>9.1f}")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the fine-tuned model to ONNX and quantize it to INT8")
+    parser.add_argument("--skip-export", action="store_true", help=f"Reuse the export in {OUTPUT_DIR}")
+    parser.add_argument("--quantization", choices=["dynamic", "static", "both"], default="both")
+    parser.add_argument("--fim-dataset", default=FIM_DATASET, help="FIM JSONL used for calibration and evaluation")
+    parser.add_argument("--calibration-samples", type=int, default=CALIBRATION_SAMPLES)
+    parser.add_argument("--eval-samples", type=int, default=EVAL_SAMPLES, help="Held-out samples for the comparison (0 skips it)")
+    parser.add_argument("--calibrate-method", choices=["minmax", "entropy", "percentile"], default="minmax")
+    parser.add_argument("--no-per-channel", action="store_true", help="Per-tensor instead of per-channel weight scales")
+    parser.add_argument("--exclude", action="append", default=None,
+                        help="Regex of MatMul node names kept in float (repeatable, default: lm_head and down_proj)")
+    parser.add_argument("--threads", type=int, default=0, help="intra_op_num_threads for the comparison (0: all cores)")
+    parser.add_argument("--no-optimize", action="store_true", help="Skip saving offline-optimized graphs")
+    args = parser.parse_args()
+
+    install_dependencies()
+
+    if not args.skip_export:
+        export_model()
+
+    onnx_model_path = os.path.join(OUTPUT_DIR, "model.onnx")
+    models = [("fp32", onnx_model_path)]
+    report = {"config": vars(args)}
+
+    # 3. Quantize to INT8
+    if args.quantization in ("dynamic", "both"):
+        models.append(("dynamic", quantize_dynamic_int8(onnx_model_path)))
+
+    if args.quantization in ("static", "both"):
+        from transformers import AutoTokenizer
+
+        tokenizer = AutoTokenizer.from_pretrained(OUTPUT_DIR)
+        samples = load_fim_samples(args.fim_dataset, args.calibration_samples + args.eval_samples)
+        calibration, held_out = samples[:args.calibration_samples], samples[args.calibration_samples:]
+        sequences = [tokenizer(s["text"], add_special_tokens=False)["input_ids"][:MAX_SEQ_TOKENS] for s in calibration]
+        models.append(("static", quantize_static_int8(
+            onnx_model_path, sequences,
+            per_channel=not args.no_per_channel,
+            exclude=args.exclude if args.exclude is not None else SENSITIVE_NODES,
+            calibrate_method=args.calibrate_method,
+        )))
+
+        if held_out:
+            report["results"] = compare_models(models, held_out, tokenizer, args.threads)
+
+    # 4. Serialize optimized graphs so servers skip optimization at startup
+    if not args.no_optimize:
+        report["startup"] = {}
+        for name, path in models[1:]:
+            report["startup"][name] = measure_startup(path, optimize_offline(path))
+
+    if len(report) > 1:
+        with open(REPORT_PATH, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {REPORT_PATH}")
+
+    for _, path in models[1:]:
+        output_dir = os.path.dirname(path)
+        print(f"Quantization complete! Model saved to {output_dir}")
+        print("Files in output:")
+        print(os.listdir(output_dir))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,204 @@
+import os
+import re
+import time
+import random
+import zlib
+from typing import Iterator, List, Optional, Protocol, Sequence, Union
+
+# Markers tokenized as single tokens when special=True (ChatML and Qwen FIM)
+SPECIAL_TOKENS = [
+    "<|im_start|>", "<|im_end|>", "<|endoftext|>",
+    "<|fim_prefix|>", "<|fim_suffix|>", "<|fim_middle|>", "<|fim_pad|>",
+]
+PIECE_RE = re.compile(r"\s*[A-Za-z_0-9]+|\s*[^\sA-Za-z_0-9]|\s+")
+SPECIAL_RE = re.compile("(" + "|".join(re.escape(t) for t in SPECIAL_TOKENS) + ")")
+
+# Output vocabulary of the stub: code-like pieces
+STUB_PIECES = [" x", " =", " self", ".", "value", "(", ")", " return", " if", " None", ",", " 0", " +", " 1", ":", "\n    "]
+
+
+class CompletionBackend(Protocol):
+    """
+    The subset of llama_cpp.Llama the server relies on. Any object providing
+    it can be returned by a model loader and registered in the ModelRegistry.
+    """
+    input_ids: Sequence[int]
+    n_tokens: int
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False) -> List[int]: ...
+    def detokenize(self, tokens: List[int]) -> bytes: ...
+    def n_ctx(self) -> int: ...
+    def __call__(self, prompt: Union[str, List[int]], **kwargs): ...
+    def reset(self): ...
+    def eval(self, tokens: Sequence[int]): ...
+    def save_state(self): ...
+    def load_state(self, state): ...
+
+
+class StoppingCriteriaList(list):
+    """Same calling convention as llama_cpp.StoppingCriteriaList, for use without llama.cpp."""
+    def __call__(self, input_ids, logits) -> bool:
+        return any(criterion(input_ids, logits) for criterion in self)
+
+
+def find_stop(text: str, stops: Sequence[str]) -> int:
+    """Position of the earliest stop sequence in text, or -1."""
+    return min((i for i in (text.find(s) for s in stops if s) if i >= 0), default=-1)
+
+
+def completion_response(steps: Iterator[tuple], n_prompt: int, stream: bool, model: str):
+    """
+    Builds llama_cpp-style text_completion output from (text, finish_reason)
+    steps, where finish_reason is None for each generated token and set on the
+    last step. Returns a chunk iterator when streaming, otherwise one dict
+    with usage.
+    """
+    created = int(time.time())
+
+    def chunk(text: str, finish_reason: Optional[str]) -> dict:
+        return {
+            "id": f"cmpl-{model}-{created}",
+            "object": "text_completion",
+            "created": created,
+            "model": model,
+            "choices": [{"text": text, "index": 0, "logprobs": None, "finish_reason": finish_reason}],
+        }
+
+    if stream:
+        return (chunk(text, finish_reason) for text, finish_reason in steps)
+
+    parts = []
+    n_completion = 0
+    finish_reason = "length"
+    for text, finish_reason in steps:
+        if finish_reason is None:
+            n_completion += 1
+        parts.append(text)
+    output = chunk("".join(parts), finish_reason)
+    output["usage"] = {
+        "prompt_tokens": n_prompt,
+        "completion_tokens": n_completion,
+        "total_tokens": n_prompt + n_completion,
+    }
+    return output
+
+
+class StubLlama:
+    """
+    Deterministic stand-in for llama_cpp.Llama without a model file.
+
+    Text is split into word/punctuation pieces, each one token. Evaluating a
+    prompt costs `prompt_token_ms` per token not already in the evaluated
+    prefix (so KV reuse shows up in timings), and each generated token costs
+    `token_ms`. The output depends only on the prompt text and is the same
+    for every temperature.
+    """
+    BOS = 1
+
+    def __init__(self, n_ctx: int = 512, token_ms: float = 20.0, prompt_token_ms: float = 0.5):
+        self._n_ctx = n_ctx
+        self.token_ms = token_ms
+        self.prompt_token_ms = prompt_token_ms
+        self.pieces: List[str] = ["", ""]
+        self.ids = {}
+        self.input_ids: List[int] = []
+        self.n_tokens = 0
+
+    @classmethod
+    def from_env(cls) -> "StubLlama":
+        return cls(
+            n_ctx=int(os.getenv("N_CTX", 0)) or 512,
+            token_ms=float(os.getenv("STUB_TOKEN_MS", 20)),
+            prompt_token_ms=float(os.getenv("STUB_PROMPT_TOKEN_MS", 0.5)),
+        )
+
+    def _id(self, piece: str) -> int:
+        token = self.ids.get(piece)
+        if token is None:
+            token = len(self.pieces)
+            self.pieces.append(piece)
+            self.ids[piece] = token
+        return token
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False) -> List[int]:
+        text = text.decode("utf-8", errors="ignore")
+        tokens = [self.BOS] if add_bos else []
+        parts = SPECIAL_RE.split(text) if special else [text]
+        for part in parts:
+            if special and part in SPECIAL_TOKENS:
+                tokens.append(self._id(part))
+            else:
+                tokens.extend(self._id(piece) for piece in PIECE_RE.findall(part))
+        return tokens
+
+    def detokenize(self, tokens: List[int]) -> bytes:
+        return "".join(self.pieces[t] for t in tokens if 0 <= t < len(self.pieces)).encode("utf-8")
+
+    def n_ctx(self) -> int:
+        return self._n_ctx
+
+    def reset(self):
+        self.n_tokens = 0
+
+    def eval(self, tokens: Sequence[int]):
+        self.input_ids = list(self.input_ids[:self.n_tokens]) + list(tokens)
+        self.n_tokens = len(self.input_ids)
+        time.sleep(len(tokens) * self.prompt_token_ms / 1000)
+
+    def save_state(self):
+        return list(self.input_ids[:self.n_tokens])
+
+    def load_state(self, state):
+        self.input_ids = list(state)
+        self.n_tokens = len(self.input_ids)
+
+    def close(self):
+        self.input_ids = []
+        self.n_tokens = 0
+
+    def _evaluate_prompt(self, tokens: List[int]):
+        # Only the part that differs from the evaluated prefix costs time, as with llama.cpp's KV cache
+        evaluated = self.input_ids[:self.n_tokens]
+        keep = 0
+        while keep < min(len(evaluated), len(tokens)) and evaluated[keep] == tokens[keep]:
+            keep += 1
+        self.n_tokens = keep
+        self.eval(tokens[keep:])
+
+    def _generate(self, prompt, suffix, max_tokens, stop, stopping_criteria) -> Iterator[tuple]:
+        tokens = list(prompt) if isinstance(prompt, list) else self.tokenize(prompt.encode("utf-8"))
+        if suffix:
+            tokens += self.tokenize(suffix.encode("utf-8"), add_bos=False)
+        self._evaluate_prompt(tokens)
+
+        seed = zlib.crc32(self.detokenize(tokens))
+        rng = random.Random(seed)
+        stops = [stop] if isinstance(stop, str) else list(stop or [])
+        text = ""
+        for _ in range(max_tokens):
+            time.sleep(self.token_ms / 1000)
+            piece = rng.choice(STUB_PIECES)
+            token = self._id(piece)
+            self.input_ids.append(token)
+            self.n_tokens += 1
+            if stopping_criteria is not None and stopping_criteria(self.input_ids, None):
+                yield "", "stop"
+                return
+            hit = find_stop(text + piece, stops)
+            if hit >= 0:
+                yield (text + piece)[len(text):hit], "stop"
+                return
+            text += piece
+            yield piece, None
+        yield "", "length"
+
+    def __call__(self, prompt: Union[str, List[int]], suffix: Optional[str] = None, max_tokens: int = 16,
+                 stop=None, stream: bool = False, stopping_criteria=None, **kwargs):
+        n_prompt = len(prompt) if isinstance(prompt, list) else len(self.tokenize(prompt.encode("utf-8")))
+        steps = self._generate(prompt, suffix, max_tokens or 16, stop, stopping_criteria)
+        return completion_response(steps, n_prompt, stream, "stub")
+
+
+def load_stub(model_path: str) -> StubLlama:
+    """Model loader for BACKEND=stub; the path is ignored."""
+    return StubLlama.from_env()
@@ -0,0 +1,336 @@
+"""
+Benchmark suite comparing the llama.cpp (GGUF) and ONNX Runtime backends.
+
+Every model runs the same prompts over a sweep of thread counts, prompt
+lengths and max_tokens. Prompt evaluation (time to the first token) is
+measured separately from per-token decode time, each configuration is
+repeated to get 95% confidence intervals, and the results are written as
+CSV and JSON tagged with the git commit, so runs can be compared across
+commits.
+
+Usage:
+    python benchmark_suite.py --gguf ../phase3_optimization/gguf_model/qwen2.5-coder-0.5b-q4_k_m.gguf \\
+        --onnx ../phase3_optimization/qwen2.5-coder-0.5b-onnx-int8/model_int8.onnx \\
+        --onnx-iobinding ../phase3_optimization/qwen2.5-coder-0.5b-onnx-int8/model_int8.onnx \\
+        --threads 1,2,4 --prompt-tokens 16,128,384 --max-tokens 8,32 --repeats 5
+    python benchmark_suite.py --stub --repeats 3    # offline smoke run without model files
+"""
+import argparse
+import csv
+import json
+import math
+import os
+import platform
+import re
+import statistics
+import subprocess
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Code the prompts are cut from (the last N tokens are used as the prompt)
+PROMPT_SOURCE = '''import os
+import json
+import logging
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class Repository:
+    """Loads records from JSON files and indexes them by id."""
+    def __init__(self, root: str):
+        self.root = root
+        self.records: Dict[str, dict] = {}
+
+    def load(self) -> int:
+        count = 0
+        for name in sorted(os.listdir(self.root)):
+            if not name.endswith(".json"):
+                continue
+            with open(os.path.join(self.root, name), "r", encoding="utf-8") as f:
+                for record in json.load(f):
+                    self.records[record["id"]] = record
+                    count += 1
+        logger.info(f"Loaded {count} records from {self.root}")
+        return count
+
+    def find(self, predicate) -> List[dict]:
+        return [r for r in self.records.values() if predicate(r)]
+
+    def get(self, record_id: str) -> Optional[dict]:
+        return self.records.get(record_id)
+
+
+def summarize(records: List[dict], field: str) -> Dict[str, float]:
+    values = [r[field] for r in records if field in r]
+    if not values:
+        return {}
+    total = sum(values)
+    return {"count": len(values), "total": total, "mean": total / len(values)}
+
+
+def main():
+    repo = Repository("data")
+    repo.load()
+    active = repo.find(lambda r: r.get("active"))
+    stats = summarize(active, "score")
+    print(json.dumps(stats, indent=2))
+'''
+
+QUANT_RE = re.compile(r"(iq\d_\w+|q\d_k_[sml]|q\d_k|q\d_\d|bf16|f16|f32|fp16|fp32|int8|int4|uint8)", re.IGNORECASE)
+
+# Two-sided 95% Student t critical values by degrees of freedom
+T_95 = {1: 12.706, 2: 4.303, 3: 3.182, 4: 2.776, 5: 2.571, 6: 2.447, 7: 2.365, 8: 2.306, 9: 2.262,
+        10: 2.228, 12: 2.179, 15: 2.131, 20: 2.086, 25: 2.060, 30: 2.042}
+
+
+def t_critical(df: int) -> float:
+    if df >= 30:
+        return 1.96 if df > 120 else T_95[30]
+    return T_95.get(df) or T_95[max(k for k in T_95 if k <= df)]
+
+
+def mean_ci(values: List[float]) -> Tuple[Optional[float], Optional[float]]:
+    """Mean and half-width of its 95% confidence interval."""
+    if not values:
+        return None, None
+    mean = statistics.mean(values)
+    if len(values) < 2:
+        return mean, None
+    return mean, t_critical(len(values) - 1) * statistics.stdev(values) / math.sqrt(len(values))
+
+
+def quant_label(path: str, default: str) -> str:
+    m = QUANT_RE.search(os.path.basename(path))
+    return m.group(1).lower() if m else default
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=SCRIPT_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class LlamaRunner:
+    """Times generations through llama-cpp-python (or the stub backend)."""
+    backend = "gguf"
+
+    def __init__(self, path: str, threads: int, n_ctx: int, stub: bool = False):
+        if stub:
+            from backends import StubLlama
+            self.llm = StubLlama.from_env()
+            self.backend = "stub"
+        else:
+            from llama_cpp import Llama
+            self.llm = Llama(model_path=path, n_ctx=n_ctx, n_threads=threads, n_threads_batch=threads,
+                             n_batch=512, n_gpu_layers=0, verbose=False, use_mmap=True, use_mlock=False)
+
+    def tokenize(self, text: str) -> List[int]:
+        return self.llm.tokenize(text.encode("utf-8"), add_bos=False)
+
+    def run(self, tokens: List[int], max_tokens: int) -> Tuple[float, float, int]:
+        """Returns (prompt eval ms, total ms, generated tokens) of one greedy generation."""
+        self.llm.reset() # Evaluate the full prompt on every repeat
+        start = time.perf_counter()
+        first = None
+        generated = 0
+        for chunk in self.llm(prompt=tokens, max_tokens=max_tokens, temperature=0.0, top_k=1, stream=True):
+            choice = chunk["choices"][0]
+            # The closing chunk only carries the finish reason
+            if choice["finish_reason"] is not None and not choice["text"]:
+                continue
+            if first is None:
+                first = time.perf_counter()
+            generated += 1
+        end = time.perf_counter()
+        return ((first or end) - start) * 1000, (end - start) * 1000, generated
+
+    def close(self):
+        if hasattr(self.llm, "close"):
+            self.llm.close()
+
+
+class OnnxBindingRunner(LlamaRunner):
+    """Times the server's ONNX backend: hand-written decode loop with IO binding and preallocated KV buffers."""
+    backend = "onnx-iobinding"
+
+    def __init__(self, path: str, threads: int, n_ctx: int, stub: bool = False):
+        from onnx_backend import OnnxLlama
+        self.llm = OnnxLlama(path, n_ctx=n_ctx, n_threads=threads)
+
+
+class OnnxRunner:
+    """Times greedy generations of an exported model through ONNX Runtime (optimum)."""
+    backend = "onnx"
+
+    def __init__(self, path: str, threads: int, n_ctx: int, stub: bool = False):
+        import onnxruntime as ort
+        from optimum.onnxruntime import ORTModelForCausalLM
+        from transformers import AutoTokenizer
+
+        model_dir, file_name = (os.path.dirname(path), os.path.basename(path)) if path.endswith(".onnx") \
+            else (path, "model.onnx")
+        sess_options = ort.SessionOptions()
+        sess_options.intra_op_num_threads = threads
+        sess_options.inter_op_num_threads = 1
+        sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.model = ORTModelForCausalLM.from_pretrained(
+            model_dir, file_name=file_name, use_cache=True, use_io_binding=False,
+            session_options=sess_options, provider="CPUExecutionProvider"
+        )
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+
+    def tokenize(self, text: str) -> List[int]:
+        return self.tokenizer(text, add_special_tokens=False)["input_ids"]
+
+    def run(self, tokens: List[int], max_tokens: int) -> Tuple[float, float, int]:
+        import torch
+
+        input_ids = torch.tensor([tokens], dtype=torch.long)
+        attention_mask = torch.ones_like(input_ids)
+        eos = self.tokenizer.eos_token_id
+        start = time.perf_counter()
+        with torch.no_grad():
+            out = self.model(input_ids=input_ids, attention_mask=attention_mask, use_cache=True)
+            next_id = out.logits[:, -1, :].argmax(dim=-1, keepdim=True)
+            first = time.perf_counter()
+            generated = 1
+            while generated < max_tokens and next_id.item() != eos:
+                attention_mask = torch.cat([attention_mask, torch.ones_like(next_id)], dim=1)
+                out = self.model(input_ids=next_id, attention_mask=attention_mask,
+                                 past_key_values=out.past_key_values, use_cache=True)
+                next_id = out.logits[:, -1, :].argmax(dim=-1, keepdim=True)
+                generated += 1
+        end = time.perf_counter()
+        return (first - start) * 1000, (end - start) * 1000, generated
+
+    def close(self):
+        self.model = None
+
+
+def bench_config(runner, prompt_tokens: List[int], max_tokens: int, repeats: int, warmup: int) -> dict:
+    for _ in range(warmup):
+        runner.run(prompt_tokens, max_tokens)
+
+    prompt_ms, decode_ms, total_ms, generated = [], [], [], []
+    for _ in range(repeats):
+        p_ms, t_ms, n = runner.run(prompt_tokens, max_tokens)
+        prompt_ms.append(p_ms)
+        total_ms.append(t_ms)
+        generated.append(n)
+        if n > 1:
+            decode_ms.append((t_ms - p_ms) / (n - 1))
+
+    prompt_mean, prompt_ci = mean_ci(prompt_ms)
+    decode_mean, decode_ci = mean_ci(decode_ms)
+    total_mean, total_ci = mean_ci(total_ms)
+    return {
+        "repeats": repeats,
+        "generated_tokens": statistics.mean(generated),
+        "prompt_eval_ms": prompt_mean,
+        "prompt_eval_ms_ci95": prompt_ci,
+        "prompt_tok_per_s": len(prompt_tokens) / (prompt_mean / 1000) if prompt_mean else None,
+        "decode_ms_per_token": decode_mean,
+        "decode_ms_per_token_ci95": decode_ci,
+        "decode_tok_per_s": 1000 / decode_mean if decode_mean else None,
+        "total_ms": total_mean,
+        "total_ms_ci95": total_ci,
+    }
+
+
+def parse_ints(text: str) -> List[int]:
+    return [int(x) for x in text.split(",") if x.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="GGUF vs ONNX Runtime benchmark sweep")
+    parser.add_argument("--gguf", action="append", default=[], help="GGUF model file (repeatable)")
+    parser.add_argument("--onnx", action="append", default=[], help="ONNX model file or directory (repeatable)")
+    parser.add_argument("--onnx-iobinding", action="append", default=[],
+                        help="ONNX model file run through the server's BACKEND=onnx decode loop (repeatable)")
+    parser.add_argument("--stub", action="store_true", help="Benchmark the stub backend (no model files)")
+    parser.add_argument("--threads", default="1,2,4", help="Comma-separated thread counts")
+    parser.add_argument("--prompt-tokens", default="16,128,384", help="Comma-separated prompt lengths in tokens")
+    parser.add_argument("--max-tokens", default="8,32", help="Comma-separated generation lengths")
+    parser.add_argument("--repeats", type=int, default=5, help="Timed runs per configuration")
+    parser.add_argument("--warmup", type=int, default=1, help="Untimed runs per configuration")
+    parser.add_argument("--output", default="benchmark_results", help="Output path without extension (.csv and .json are written)")
+    args = parser.parse_args()
+
+    models: List[Tuple[Callable, str, str]] = []
+    models += [(LlamaRunner, path, quant_label(path, "gguf")) for path in args.gguf]
+    models += [(OnnxRunner, path, quant_label(path, "fp32")) for path in args.onnx]
+    models += [(OnnxBindingRunner, path, quant_label(path, "fp32")) for path in args.onnx_iobinding]
+    if args.stub:
+        models.append((LlamaRunner, "stub", "none"))
+    if not models:
+        parser.error("Nothing to benchmark: pass --gguf, --onnx, --onnx-iobinding or --stub")
+
+    threads_list = parse_ints(args.threads)
+    prompt_lengths = parse_ints(args.prompt_tokens)
+    max_tokens_list = parse_ints(args.max_tokens)
+    n_ctx = max(prompt_lengths) + max(max_tokens_list) + 8
+
+    meta = {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "host": platform.node(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+    }
+    results: List[Dict] = []
+
+    for runner_cls, path, quant in models:
+        for threads in threads_list:
+            backend = "stub" if path == "stub" else runner_cls.backend
+            print(f"\n--- {backend} | {os.path.basename(path)} | {quant} | threads={threads} ---")
+            start_load = time.perf_counter()
+            try:
+                runner = runner_cls(path, threads, n_ctx, stub=(path == "stub"))
+            except Exception as e:
+                print(f"Failed to load model: {e}")
+                continue
+            load_s = time.perf_counter() - start_load
+
+            source_tokens = runner.tokenize(PROMPT_SOURCE)
+            for prompt_len in prompt_lengths:
+                while len(source_tokens) < prompt_len:
+                    source_tokens = source_tokens + source_tokens
+                prompt = source_tokens[-prompt_len:]
+                for max_tokens in max_tokens_list:
+                    row = {
+                        "backend": runner.backend,
+                        "model": os.path.basename(path),
+                        "quant": quant,
+                        "threads": threads,
+                        "prompt_tokens": prompt_len,
+                        "max_tokens": max_tokens,
+                        "load_s": load_s,
+                        **bench_config(runner, prompt, max_tokens, args.repeats, args.warmup),
+                    }
+                    results.append(row)
+                    print(f"   prompt={prompt_len:<4} max_tokens={max_tokens:<3} "
+                          f"prompt eval={row['prompt_eval_ms']:.1f}ms "
+                          f"decode={row['decode_ms_per_token'] or 0:.1f}ms/tok "
+                          f"total={row['total_ms']:.1f}ms")
+            runner.close()
+
+    with open(args.output + ".json", "w", encoding="utf-8") as f:
+        json.dump({"meta": meta, "results": results}, f, indent=2)
+    if results:
+        with open(args.output + ".csv", "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=["commit", "timestamp"] + list(results[0]))
+            writer.writeheader()
+            for row in results:
+                writer.writerow({"commit": meta["commit"], "timestamp": meta["timestamp"], **row})
+    print(f"\nResults written to {args.output}.json / {args.output}.csv")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+import os
+import sys
+import logging
+from collections import OrderedDict
+from typing import List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def state_bytes(state) -> int:
+    """
+    Memory held by a state snapshot. For llama.cpp: the serialized context
+    (KV cache) plus the copied input ids and scores, which are n_tokens x
+    n_vocab float32 and dominate for large vocabularies. Other backends'
+    snapshots (onnx_backend.OnnxState) report their own nbytes.
+    """
+    size = getattr(state, "llama_state_size", 0) or getattr(state, "nbytes", 0)
+    for attr in ("scores", "input_ids"):
+        size += getattr(getattr(state, attr, None), "nbytes", 0)
+    return size or sys.getsizeof(state)
+
+
+def common_prefix_len(a: Sequence[int], b: Sequence[int]) -> int:
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+
+class ChatStateCache:
+    """
+    Snapshots of llama.cpp state for already evaluated ChatML prefixes.
+
+    Two tiers are kept: the latest state of each recent conversation, and
+    states holding only a system prompt, which many conversations share.
+    Before a chat turn the snapshot sharing the longest token prefix with the
+    new prompt is restored, so llama.cpp only evaluates the appended messages.
+
+    Both tiers share a byte budget, like LlamaRAMCache(capacity_bytes=...):
+    a snapshot of a few hundred tokens can take hundreds of MB, so a count
+    limit says nothing about memory. Least recently used conversations are
+    evicted first, then system prompts; a snapshot larger than the whole
+    budget is not kept.
+    """
+    def __init__(self, capacity_bytes: int = 128 * 2**20):
+        self.capacity_bytes = capacity_bytes
+        self.conversations: "OrderedDict[Tuple[int, ...], object]" = OrderedDict()
+        self.systems: "OrderedDict[Tuple[int, ...], object]" = OrderedDict()
+        self.sizes = {}
+        self.stats = {"hits": 0, "misses": 0, "reused_tokens": 0, "evictions": 0, "oversize": 0}
+
+    @staticmethod
+    def capacity_from_env() -> int:
+        """CHAT_CACHE_MB in bytes: 128MB by default, off in the low-memory profile."""
+        default = 0 if os.getenv("LOW_MEMORY", "0") == "1" else 128
+        return max(0, int(os.getenv("CHAT_CACHE_MB", default))) * 2**20
+
+    @classmethod
+    def from_env(cls) -> Optional["ChatStateCache"]:
+        capacity = cls.capacity_from_env()
+        if capacity <= 0:
+            return None
+        return cls(capacity_bytes=capacity)
+
+    @property
+    def used_bytes(self) -> int:
+        return sum(self.sizes.values())
+
+    def report(self) -> dict:
+        return {"conversations": len(self.conversations), "systems": len(self.systems),
+                "used_mb": round(self.used_bytes / 2**20, 1), "capacity_mb": self.capacity_bytes / 2**20,
+                **self.stats}
+
+    @staticmethod
+    def supported(llm) -> bool:
+        return all(hasattr(llm, attr) for attr in ("save_state", "load_state", "eval", "input_ids"))
+
+    @staticmethod
+    def _evaluated(llm) -> List[int]:
+        return list(llm.input_ids[:llm.n_tokens])
+
+    def restore(self, llm, tokens: List[int]) -> int:
+        """
+        Restores the best snapshot for a prompt. Returns the number of prompt tokens
+        that no longer need to be evaluated.
+        """
+        current = common_prefix_len(self._evaluated(llm), tokens)
+        best_key, best_len, best_tier = None, current, None
+        for tier in (self.conversations, self.systems):
+            for key in tier:
+                n = common_prefix_len(key, tokens)
+                if n > best_len:
+                    best_key, best_len, best_tier = key, n, tier
+
+        if best_key is not None:
+            llm.load_state(best_tier[best_key])
+            best_tier.move_to_end(best_key)
+
+        if best_len > 0:
+            self.stats["hits"] += 1
+            self.stats["reused_tokens"] += best_len
+        else:
+            self.stats["misses"] += 1
+        return best_len
+
+    def warm_system(self, llm, system_tokens: List[int], reused: int):
+        """
+        Evaluates a system prompt on its own and snapshots it, unless the
+        restored state already covers it or it is cached.
+        """
+        key = tuple(system_tokens)
+        if not key or reused >= len(key) or key in self.systems:
+            return
+        llm.reset()
+        llm.eval(system_tokens)
+        self._put(self.systems, key, llm.save_state())
+
+    def save(self, llm):
+        """Snapshots the evaluated conversation, replacing its older turns."""
+        key = tuple(self._evaluated(llm))
+        if not key:
+            return
+        for old in [k for k in self.conversations if common_prefix_len(k, key) == len(k)]:
+            del self.conversations[old]
+            self.sizes.pop(("conversation", old), None)
+        self._put(self.conversations, key, llm.save_state())
+
+    def _put(self, tier: OrderedDict, key: tuple, state):
+        size = state_bytes(state)
+        if size > self.capacity_bytes:
+            self.stats["oversize"] += 1
+            return
+        name = "system" if tier is self.systems else "conversation"
+        tier[key] = state
+        tier.move_to_end(key)
+        self.sizes[(name, key)] = size
+        # Oldest conversations go first, then system prompts; never the new snapshot
+        candidates = [("conversation", k) for k in self.conversations] + [("system", k) for k in self.systems]
+        for victim in candidates:
+            if self.used_bytes <= self.capacity_bytes:
+                break
+            if victim == (name, key):
+                continue
+            (self.conversations if victim[0] == "conversation" else self.systems).pop(victim[1])
+            del self.sizes[victim]
+            self.stats["evictions"] += 1
@@ -0,0 +1,153 @@
+import time
+import asyncio
+import hashlib
+import json
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+
+def request_key(model_id: str, params: dict) -> str:
+    """
+    Builds a stable cache key for a generation request.
+    """
+    payload = json.dumps({"model": model_id, **params}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class SharedStream:
+    """
+    Events of one streamed execution, fanned out to every subscriber.
+
+    The events are consumed by a background task and kept, so a subscriber
+    joining late first receives the ones it missed and all subscribers see
+    the same stream. An error raised by the source ends every subscription.
+    Once the last subscriber leaves early the source is cancelled.
+    """
+    def __init__(self, events: AsyncIterator):
+        self.events: List = []
+        self.error: Optional[Exception] = None
+        self.done = False
+        self.abandoned = False
+        self.subscribers = 0
+        self._changed = asyncio.Event()
+        self.task = asyncio.ensure_future(self._pump(events))
+
+    async def _pump(self, events: AsyncIterator):
+        try:
+            async for event in events:
+                self.events.append(event)
+                self._notify()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def subscribe(self, disconnected: Optional[Callable[[], Awaitable[bool]]] = None,
+                        poll_s: float = 0.25) -> AsyncIterator:
+        """
+        Yields every event from the first one until the source is exhausted.
+        `disconnected`, checked about every poll_s, ends the subscription early
+        once it returns true.
+        """
+        self.subscribers += 1
+        checked = time.monotonic()
+        i = 0
+        try:
+            while True:
+                while i < len(self.events):
+                    yield self.events[i]
+                    i += 1
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                if disconnected is None:
+                    await self._changed.wait()
+                    continue
+                try:
+                    await asyncio.wait_for(self._changed.wait(), max(0.0, checked + poll_s - time.monotonic()))
+                except asyncio.TimeoutError:
+                    pass
+                if time.monotonic() - checked >= poll_s:
+                    if await disconnected():
+                        return
+                    checked = time.monotonic()
+        finally:
+            self.subscribers -= 1
+            if not self.subscribers and not self.done:
+                self.abandoned = True
+                self.task.cancel()
+
+
+class SingleFlight:
+    """
+    Collapses concurrent identical requests into a single execution.
+
+    The first caller for a key starts the work as a background task; callers
+    arriving while it is in flight await the same task, or for streams
+    subscribe to the same SharedStream. A caller that disconnects does not
+    cancel the work for the others.
+    """
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._streams: Dict[str, SharedStream] = {}
+        self.stats = {"executed": 0, "coalesced": 0}
+
+    def in_flight(self, key: str) -> bool:
+        return key in self._inflight
+
+    async def run(self, key: Optional[str], fn: Callable[[], Awaitable]):
+        """
+        Awaits fn(), sharing the result with identical in-flight calls.
+        A key of None disables coalescing for this call.
+        """
+        if key is None:
+            self.stats["executed"] += 1
+            return await fn()
+
+        task = self._inflight.get(key)
+        if task is None:
+            self.stats["executed"] += 1
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._finish(key, t))
+        else:
+            self.stats["coalesced"] += 1
+        return await asyncio.shield(task)
+
+    def streaming(self, key: str) -> bool:
+        shared = self._streams.get(key)
+        return shared is not None and not shared.abandoned
+
+    def stream(self, key: Optional[str], events: Callable[[], AsyncIterator],
+               disconnected: Optional[Callable[[], Awaitable[bool]]] = None) -> AsyncIterator:
+        """
+        Iterates events(), sharing the stream with an identical in-flight call;
+        events() is only called when there is none. A key of None disables
+        coalescing for this call. See SharedStream.subscribe for `disconnected`.
+        """
+        shared = self._streams.get(key) if key is not None else None
+        if shared is None or shared.abandoned:
+            self.stats["executed"] += 1
+            shared = SharedStream(events())
+            if key is not None:
+                self._streams[key] = shared
+                shared.task.add_done_callback(lambda _: self._finish_stream(key, shared))
+        else:
+            self.stats["coalesced"] += 1
+        return shared.subscribe(disconnected)
+
+    def _finish_stream(self, key: str, shared: SharedStream):
+        if self._streams.get(key) is shared:
+            del self._streams[key]
+
+    def _finish(self, key: str, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # Mark the exception as retrieved even if every caller went away
+        if not task.cancelled():
+            task.exception()
@@ -0,0 +1,69 @@
+import time
+import threading
+from typing import Optional
+
+
+# How often a request queued for the model checks whether its client went away
+CANCEL_POLL_S = 0.05
+
+
+class DeadlineExceeded(Exception):
+    """The request's deadline passed before generation could start."""
+
+
+class Cancelled(Exception):
+    """The client went away before generation could start."""
+
+
+class Deadline:
+    """
+    Absolute point in time (time.monotonic) by which a request must be answered.
+    `hit` is set once generation has been cut short by the deadline.
+    """
+    def __init__(self, at: float):
+        self.at = at
+        self.hit = False
+
+    @classmethod
+    def after(cls, ms: Optional[float], start: Optional[float] = None) -> Optional["Deadline"]:
+        """Deadline `ms` milliseconds after `start` (default: now); None if ms is unset or <= 0."""
+        if not ms or ms <= 0:
+            return None
+        return cls((start if start is not None else time.monotonic()) + ms / 1000)
+
+    def remaining(self) -> float:
+        return max(0.0, self.at - time.monotonic())
+
+    def expired(self) -> bool:
+        return time.monotonic() >= self.at
+
+    def stopping_criteria(self):
+        """Callable in the form of a llama.cpp stopping criterion, true once the deadline passed."""
+        def check(input_ids, logits) -> bool:
+            if self.expired():
+                self.hit = True
+                return True
+            return False
+        return check
+
+
+def acquire(lock: threading.Lock, deadline: Optional[Deadline], cancelled: Optional[threading.Event] = None) -> bool:
+    """
+    Acquires `lock`, waiting no longer than the deadline allows.
+    Returns False, without the lock, if the request expired while queued,
+    or if `cancelled` was set meanwhile.
+    """
+    if cancelled is None:
+        if deadline is None:
+            return lock.acquire()
+        if deadline.expired():
+            return False
+        return lock.acquire(timeout=deadline.remaining())
+
+    while not cancelled.is_set():
+        if deadline is not None and deadline.expired():
+            return False
+        timeout = min(CANCEL_POLL_S, deadline.remaining()) if deadline else CANCEL_POLL_S
+        if lock.acquire(timeout=timeout):
+            return True
+    return False
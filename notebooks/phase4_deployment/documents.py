@@ -0,0 +1,152 @@
+import os
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+# Same context limits as the training samples (phase1_data_engineering/04_fim_gen.py)
+MAX_CONTEXT_LINES = 64
+MAX_CHARS_PER_PART = 2048
+
+
+class Document:
+    """
+    Server-side copy of an editor buffer, kept up to date from edit deltas.
+
+    Tokens are cached per line of text, so after an edit only the touched
+    lines are tokenized again when the FIM window around the cursor is built.
+    """
+    def __init__(self, doc_id: str, text: str, language: Optional[str] = None,
+                 path: Optional[str] = None, token_cache_size: int = 2048):
+        self.doc_id = doc_id
+        self.text = text
+        self.language = language
+        self.path = path
+        self.version = 0
+        self.last_used = time.monotonic()
+        self.token_cache_size = token_cache_size
+        self._token_cache: "OrderedDict[str, List[int]]" = OrderedDict()
+        self._cache_owner = None
+        self.lock = threading.Lock()
+
+    def apply_edits(self, edits: List[dict]):
+        """
+        Applies edits in order. Each edit is {"offset", "removed", "text"}:
+        `removed` characters at `offset` are replaced by `text`.
+        """
+        for edit in edits:
+            offset = int(edit["offset"])
+            removed = int(edit.get("removed", 0))
+            if offset < 0 or removed < 0 or offset + removed > len(self.text):
+                raise ValueError(f"Edit out of range: offset={offset} removed={removed} length={len(self.text)}")
+            self.text = self.text[:offset] + edit.get("text", "") + self.text[offset + removed:]
+            self.version += 1
+        self.last_used = time.monotonic()
+
+    def _bounds(self, cursor: int) -> Tuple[int, int, int]:
+        """Start of the prefix window, start of the cursor line and end of the suffix window."""
+        if cursor < 0 or cursor > len(self.text):
+            raise ValueError(f"Cursor {cursor} outside document of length {len(self.text)}")
+        text = self.text
+        line_start = text.rfind("\n", 0, cursor) + 1
+
+        start = line_start
+        for _ in range(MAX_CONTEXT_LINES):
+            if start == 0:
+                break
+            start = text.rfind("\n", 0, start - 1) + 1
+        start = max(start, line_start - MAX_CHARS_PER_PART)
+
+        end = cursor
+        for _ in range(MAX_CONTEXT_LINES + 1):
+            nl = text.find("\n", end)
+            if nl < 0:
+                end = len(text)
+                break
+            end = nl + 1
+        end = min(end, cursor + MAX_CHARS_PER_PART)
+        return start, line_start, end
+
+    def window(self, cursor: int) -> Tuple[str, str]:
+        """Prefix and suffix text around the cursor, limited like the training samples."""
+        start, _, end = self._bounds(cursor)
+        return self.text[start:cursor], self.text[cursor:end]
+
+    def _pieces(self, start: int, stop: int) -> List[str]:
+        pieces = []
+        while start < stop:
+            nl = self.text.find("\n", start, stop)
+            piece_end = stop if nl < 0 else nl + 1
+            pieces.append(self.text[start:piece_end])
+            start = piece_end
+        return pieces
+
+    def _encode(self, piece: str, formatter) -> List[int]:
+        ids = self._token_cache.get(piece)
+        if ids is None:
+            ids = formatter.encode(piece)
+            self._token_cache[piece] = ids
+            while len(self._token_cache) > self.token_cache_size:
+                self._token_cache.popitem(last=False)
+        else:
+            self._token_cache.move_to_end(piece)
+        return ids
+
+    def encode_window(self, cursor: int, formatter, context: str = "") -> Tuple[List[int], List[int]]:
+        """
+        Token ids of the prefix and suffix window, reusing cached line tokens.
+        The formatter's separator is prepended to each side as in FimFormatter.build.
+        `context` (e.g. retrieved snippets) is placed in front of the prefix.
+        """
+        if self._cache_owner is not formatter:
+            self._token_cache.clear()
+            self._cache_owner = formatter
+
+        start, line_start, end = self._bounds(cursor)
+        prefix_pieces = [context] + self._pieces(start, line_start) + [self.text[line_start:cursor]]
+        suffix_pieces = self._pieces(cursor, end)
+
+        def encode(pieces: List[str]) -> List[int]:
+            pieces = [p for p in pieces if p]
+            if not pieces:
+                return formatter.encode(formatter.pad)
+            ids = list(self._encode(formatter.pad + pieces[0], formatter))
+            for piece in pieces[1:]:
+                ids.extend(self._encode(piece, formatter))
+            return ids
+
+        return encode(prefix_pieces), encode(suffix_pieces)
+
+
+class DocumentStore:
+    """
+    Open documents by id, dropping the least recently used beyond `capacity`.
+    """
+    def __init__(self, capacity: int = 64):
+        self.capacity = capacity
+        self.documents: "OrderedDict[str, Document]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "DocumentStore":
+        return cls(capacity=int(os.getenv("DOCUMENT_LIMIT", 64)))
+
+    def open(self, text: str, language: Optional[str] = None, path: Optional[str] = None) -> Document:
+        doc = Document(uuid.uuid4().hex, text, language, path)
+        with self._lock:
+            self.documents[doc.doc_id] = doc
+            while len(self.documents) > self.capacity:
+                self.documents.popitem(last=False)
+        return doc
+
+    def get(self, doc_id: str) -> Document:
+        """Raises KeyError for unknown or evicted documents."""
+        with self._lock:
+            doc = self.documents[doc_id]
+            self.documents.move_to_end(doc_id)
+        return doc
+
+    def close(self, doc_id: str) -> bool:
+        with self._lock:
+            return self.documents.pop(doc_id, None) is not None
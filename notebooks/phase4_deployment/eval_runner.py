@@ -0,0 +1,219 @@
+"""
+Concurrent evaluation of the completion server on a JSONL test set.
+
+Test cases are sent with bounded concurrency over one pooled HTTP client;
+quality metrics are computed in a process pool while requests are still in
+flight. The report breaks latency percentiles and metrics down per language
+and mode (inline/block).
+
+Input lines are either FIM samples as written by 04_fim_gen.py and split by
+01_data_preparation ({"text": "<PRE> ... <SUF> ... <MID> ...", "metadata": {"type": ...}})
+or explicit cases ({"prompt", "expected", "suffix"?, "language"?, "mode"?, "stop"?}).
+
+Usage:
+    python eval_runner.py test.jsonl --concurrency 8 --output eval_report.json
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+
+import httpx
+
+import utils
+import metrics
+from load_test import summarize
+from test_client_gguf import BASE_URL, MetricsCalculator
+
+METRICS = ("em", "es", "pl", "mr", "rocc", "pr")
+FIM_STOP = "<|im_end|>"
+
+
+def parse_case(sample: dict) -> Optional[dict]:
+    """Normalizes a test line to {"prompt", "suffix", "expected", "language", "mode", "stop"}."""
+    if "text" in sample:
+        text = sample["text"]
+        suf = text.find(" <SUF> ")
+        mid = text.find(" <MID> ", suf + 1)
+        if not text.startswith("<PRE> ") or suf < 0 or mid < 0:
+            return None
+        prompt = text[len("<PRE> "):suf]
+        suffix = text[suf + len(" <SUF> "):mid]
+        expected = text[mid + len(" <MID> "):]
+        if expected.endswith(FIM_STOP):
+            expected = expected[:-len(FIM_STOP)]
+        kind = (sample.get("metadata") or {}).get("type", "")
+        mode = "block" if kind == "FIM_BLOCK" else "inline"
+        case = {"prompt": prompt, "suffix": suffix, "expected": expected, "mode": mode}
+    elif "prompt" in sample and "expected" in sample:
+        case = {
+            "prompt": sample["prompt"],
+            "suffix": sample.get("suffix"),
+            "expected": sample["expected"],
+            "mode": sample.get("mode") or ("block" if sample["expected"].startswith("\n") else "inline"),
+            "stop": sample.get("stop"),
+        }
+    else:
+        return None
+    case["language"] = sample.get("language") or utils.detect_language(case["prompt"])
+    return case
+
+
+def load_cases(path: str, limit: int = 0, seed: int = 42) -> List[dict]:
+    cases = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            case = parse_case(json.loads(line))
+            if case:
+                cases.append(case)
+    if limit and len(cases) > limit:
+        cases = random.Random(seed).sample(cases, limit)
+    return cases
+
+
+def score_batch(batch: List[dict]) -> List[dict]:
+    """Computes every MetricsCalculator metric for (prompt, generated, expected) items. Runs in a worker process."""
+    preds = [item["generated"] for item in batch]
+    refs = [item["expected"] for item in batch]
+    es = metrics.edit_similarity_batch(preds, refs)
+    pr = metrics.persistence_rate_batch(preds, refs)
+    scores = []
+    for i, item in enumerate(batch):
+        pred, expected = preds[i], refs[i]
+        scores.append({
+            "em": MetricsCalculator.exact_match(pred, expected),
+            "es": es[i],
+            "pl": MetricsCalculator.perfect_line(pred, expected),
+            "mr": MetricsCalculator.matched_ratio(pred, expected),
+            "rocc": MetricsCalculator.ratio_of_completed_code(item["prompt"], pred),
+            "pr": pr[i],
+        })
+    return scores
+
+
+async def complete_case(client: httpx.AsyncClient, case: dict, args) -> dict:
+    payload = {
+        "prompt": case["prompt"],
+        "suffix": case["suffix"],
+        "max_tokens": 24 if case["mode"] == "inline" else 64,
+        "temperature": 0.0,
+        "stop": case.get("stop"),
+    }
+    start = time.perf_counter()
+    try:
+        response = await client.post("/v1/completions", json=payload)
+        latency = (time.perf_counter() - start) * 1000
+        if response.status_code != 200:
+            return {**case, "error": f"HTTP {response.status_code}", "latency_ms": latency}
+        generated = response.json()["choices"][0]["text"]
+        return {**case, "generated": generated, "latency_ms": latency}
+    except httpx.HTTPError as e:
+        return {**case, "error": str(e) or type(e).__name__, "latency_ms": None}
+
+
+def build_report(results: List[dict], elapsed: float, args) -> dict:
+    groups = defaultdict(list)
+    for r in results:
+        groups["all"].append(r)
+        groups[f"{r['language']}/{r['mode']}"].append(r)
+
+    def group_report(items: List[dict]) -> dict:
+        ok = [r for r in items if "error" not in r]
+        return {
+            "samples": len(items),
+            "errors": len(items) - len(ok),
+            "latency_ms": summarize([r["latency_ms"] for r in ok]),
+            "metrics": {m: (sum(r["scores"][m] for r in ok) / len(ok) if ok else None) for m in METRICS},
+        }
+
+    return {
+        "config": {"url": args.url, "input": args.input, "concurrency": args.concurrency, "limit": args.limit},
+        "elapsed_s": elapsed,
+        "samples_per_s": len(results) / elapsed if elapsed else 0.0,
+        "groups": {name: group_report(items) for name, items in sorted(groups.items())},
+    }
+
+
+async def run(args) -> dict:
+    cases = load_cases(args.input, args.limit, args.seed)
+    print(f"[eval_runner] Loaded {len(cases)} cases from {args.input}")
+
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(args.concurrency)
+    results: List[dict] = []
+    pending_scores: List[asyncio.Future] = []
+    batch: List[dict] = []
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+
+    with ProcessPoolExecutor(max_workers=args.workers or None) as pool:
+        def flush():
+            if batch:
+                items = list(batch)
+                batch.clear()
+                future = loop.run_in_executor(pool, score_batch, items)
+                future.add_done_callback(lambda f: [item.update(scores=s) for item, s in zip(items, f.result())])
+                pending_scores.append(future)
+
+        async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits) as client:
+            async def worker(case: dict):
+                async with semaphore:
+                    result = await complete_case(client, case, args)
+                results.append(result)
+                if "error" not in result:
+                    batch.append(result)
+                    if len(batch) >= args.batch_size:
+                        flush()
+                if len(results) % 100 == 0:
+                    print(f"[eval_runner] {len(results)}/{len(cases)} done")
+
+            start = time.perf_counter()
+            await asyncio.gather(*(worker(case) for case in cases))
+            flush()
+            await asyncio.gather(*pending_scores)
+            elapsed = time.perf_counter() - start
+
+    if args.samples_output:
+        with open(args.samples_output, "w", encoding="utf-8") as f:
+            for r in results:
+                f.write(json.dumps(r, ensure_ascii=False) + "\n")
+    return build_report(results, elapsed, args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent evaluation of the completion server")
+    parser.add_argument("input", help="JSONL test set (e.g. test.jsonl from 01_data_preparation)")
+    parser.add_argument("--url", default=BASE_URL, help="Server base URL")
+    parser.add_argument("--concurrency", type=int, default=8, help="Requests in flight")
+    parser.add_argument("--workers", type=int, default=0, help="Metric worker processes (default: CPU count)")
+    parser.add_argument("--batch-size", type=int, default=64, help="Results per metric batch")
+    parser.add_argument("--limit", type=int, default=0, help="Evaluate a random subset of this size")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--timeout", type=float, default=60, help="HTTP timeout in seconds")
+    parser.add_argument("--output", default="eval_report.json", help="JSON report path")
+    parser.add_argument("--samples-output", help="Also write per-sample results as JSONL")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
+    print(f"\nSUMMARY REPORT ({report['elapsed_s']:.1f}s, {report['samples_per_s']:.1f} samples/s)")
+    print("-" * 60)
+    for name, group in report["groups"].items():
+        m, lat = group["metrics"], group["latency_ms"]
+        if m["em"] is None:
+            print(f"   {name:<20} n={group['samples']:<5} errors={group['errors']}")
+            continue
+        print(f"   {name:<20} n={group['samples']:<5} p50={lat['p50']:.0f}ms p95={lat['p95']:.0f}ms "
+              f"EM={m['em']*100:.1f}% ES={m['es']*100:.1f}% PL={m['pl']*100:.1f}%")
+    print(f"Report written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+import os
+import logging
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Marker layout for each FIM style.
+# "training" mirrors the samples written by phase1_data_engineering/04_fim_gen.py:
+#     "<PRE> {prefix} <SUF> {suffix} <MID> {middle}"
+# "native" uses the dedicated Qwen2.5-Coder FIM special tokens.
+FIM_STYLES = {
+    "training": {
+        "prefix": "<PRE>", "suffix": " <SUF>", "middle": " <MID>",
+        "pad": " ", "special": False
+    },
+    "native": {
+        "prefix": "<|fim_prefix|>", "suffix": "<|fim_suffix|>", "middle": "<|fim_middle|>",
+        "pad": "", "special": True
+    },
+}
+FIM_ORDERS = ("psm", "spm")
+
+
+class FimFormatter:
+    """
+    Assembles fill-in-the-middle prompts as token-id sequences.
+
+    Marker token ids are resolved once when the formatter is created, so a
+    request only tokenizes its own prefix and suffix text.
+    """
+    def __init__(self, llm, style: str = "training", order: str = "psm"):
+        if style not in FIM_STYLES:
+            raise ValueError(f"Unknown FIM style '{style}'. Expected one of {list(FIM_STYLES)}")
+        if order not in FIM_ORDERS:
+            raise ValueError(f"Unknown FIM order '{order}'. Expected one of {list(FIM_ORDERS)}")
+
+        self.llm = llm
+        self.style = style
+        self.order = order
+
+        spec = FIM_STYLES[style]
+        self.markers = (spec["prefix"], spec["suffix"], spec["middle"])
+        self.pad = spec["pad"]
+        self.prefix_ids = self._resolve(spec["prefix"], spec["special"])
+        self.suffix_ids = self._resolve(spec["suffix"], spec["special"])
+        self.middle_ids = self._resolve(spec["middle"], spec["special"])
+
+    @classmethod
+    def from_env(cls, llm) -> Optional["FimFormatter"]:
+        """
+        Creates a formatter from FIM_STYLE / FIM_ORDER.
+        Returns None when FIM_STYLE=none (raw prompt/suffix passthrough).
+        """
+        style = os.getenv("FIM_STYLE", "training").lower()
+        order = os.getenv("FIM_ORDER", "psm").lower()
+        if style == "none":
+            return None
+        return cls(llm, style=style, order=order)
+
+    def _resolve(self, marker: str, special: bool) -> List[int]:
+        ids = self.llm.tokenize(marker.encode("utf-8"), add_bos=False, special=special)
+        if special and len(ids) != 1:
+            raise ValueError(f"Model vocabulary has no single special token for '{marker}'")
+        return ids
+
+    def encode(self, text: str) -> List[int]:
+        """Tokenizes prompt content (never as special tokens)."""
+        if not text:
+            return []
+        return self.llm.tokenize(text.encode("utf-8"), add_bos=False, special=False)
+
+    def encode_prefix(self, prefix: str) -> List[int]:
+        return self.encode(self.pad + prefix)
+
+    def encode_suffix(self, suffix: str) -> List[int]:
+        return self.encode(self.pad + suffix)
+
+    @property
+    def overhead(self) -> int:
+        """Number of tokens taken by the markers themselves."""
+        return len(self.prefix_ids) + len(self.suffix_ids) + len(self.middle_ids)
+
+    def build(self, prefix: str, suffix: str = "", budget: Optional[int] = None) -> List[int]:
+        """
+        Builds the FIM prompt for a prefix/suffix pair.
+        If budget is given, the result is truncated to at most that many tokens.
+        """
+        return self.build_from_tokens(self.encode_prefix(prefix), self.encode_suffix(suffix), budget)
+
+    def build_from_tokens(self, prefix_ids: List[int], suffix_ids: List[int],
+                          budget: Optional[int] = None) -> List[int]:
+        """
+        Builds the FIM prompt from already tokenized prefix/suffix content.
+        Truncation keeps the end of the prefix and the start of the suffix,
+        and only lets the suffix take more than a quarter of the budget
+        when the prefix does not need it.
+        """
+        if budget is not None:
+            room = max(0, budget - self.overhead)
+            suffix_room = min(len(suffix_ids), max(room // 4, room - len(prefix_ids)))
+            suffix_ids = suffix_ids[:suffix_room]
+            prefix_room = room - len(suffix_ids)
+            prefix_ids = prefix_ids[len(prefix_ids) - prefix_room:] if prefix_room < len(prefix_ids) else prefix_ids
+
+        if self.order == "spm":
+            return self.prefix_ids + self.suffix_ids + suffix_ids + self.middle_ids + prefix_ids
+        return self.prefix_ids + prefix_ids + self.suffix_ids + suffix_ids + self.middle_ids
+
+    def is_preformatted(self, prompt: str) -> bool:
+        """True if the client already embedded FIM markers in the prompt."""
+        return any(marker.strip() in prompt for marker in self.markers)
+
+    def stop_strings(self) -> List[str]:
+        """Marker strings that must never appear in a completion."""
+        return [marker.strip() for marker in self.markers]
+
+    def clean_output(self, text: str) -> str:
+        """Removes the separator the training format puts after the middle marker."""
+        if self.order == "psm" and self.pad and text.startswith(self.pad):
+            return text[len(self.pad):]
+        return text
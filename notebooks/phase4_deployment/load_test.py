@@ -0,0 +1,305 @@
+"""
+Load generator for the completion server.
+
+Simulated editors replay keystroke traces concurrently: after each pause in
+typing longer than the debounce interval a completion is requested, a
+keystroke arriving while it is in flight cancels it, and finished
+completions are accepted with a given probability. Latency percentiles,
+time-to-first-token, throughput and error rate are reported as JSON.
+
+Traces are JSONL lines {"prompt": str, "keystrokes": [[delay_ms, text], ...]};
+without --traces, synthetic traces are typed from built-in code snippets.
+With --stub the server runs in-process with the stub backend (BACKEND=stub),
+so no model file is needed.
+
+Usage:
+    python load_test.py --editors 8 --duration 30
+    python load_test.py --stub --editors 16 --duration 10 --output report.json
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import socket
+import statistics
+import threading
+import time
+from typing import List, Optional
+
+import httpx
+
+BASE_URL = "http://127.0.0.1:8000"
+
+SNIPPETS = [
+    "import numpy as np\nimport pandas as pd\n\ndef load(path):\n    df = pd.read_csv(path)\n    return df.dropna()\n",
+    "def fibonacci(n):\n    if n <= 1:\n        return n\n    return fibonacci(n - 1) + fibonacci(n - 2)\n",
+    "class Stack:\n    def __init__(self):\n        self.items = []\n\n    def push(self, item):\n        self.items.append(item)\n",
+    "public int sum(int[] values) {\n    int total = 0;\n    for (int v : values) {\n        total += v;\n    }\n    return total;\n}\n",
+    "const fetchUser = async (id) => {\n  const res = await fetch(`/api/users/${id}`);\n  return res.json();\n};\n",
+    "#include <vector>\n\nint max_value(const std::vector<int>& v) {\n    int best = v[0];\n    for (int x : v) best = std::max(best, x);\n    return best;\n}\n",
+]
+
+
+def synthetic_trace(text: str, rng: random.Random, wpm: float) -> dict:
+    """
+    Keystrokes typing `text` at about `wpm` words (5 characters) per minute,
+    with log-normal jitter and longer pauses after line ends and punctuation.
+    """
+    mean_ms = 60000 / (wpm * 5)
+    keystrokes = []
+    for ch in text:
+        delay = rng.lognormvariate(math.log(mean_ms), 0.5)
+        if ch == "\n":
+            delay *= 4
+        elif ch in ".(:{":
+            delay *= 2
+        keystrokes.append([round(delay, 1), ch])
+    return {"prompt": "", "keystrokes": keystrokes}
+
+
+def load_traces(path: str) -> List[dict]:
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    """Linear-interpolated percentile, p in [0, 100]."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    pos = (len(ordered) - 1) * p / 100
+    lo = math.floor(pos)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (pos - lo)
+
+
+def summarize(values: List[float]) -> dict:
+    return {
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "mean": statistics.mean(values) if values else None,
+        "max": max(values) if values else None,
+    }
+
+
+class Stats:
+    def __init__(self):
+        self.latency_ms: List[float] = []
+        self.ttft_ms: List[float] = []
+        self.sent = 0
+        self.completed = 0
+        self.cancelled = 0
+        self.errors = 0
+        self.expired = 0
+        self.accepted = 0
+        self.tokens = 0
+
+
+async def request_completion(client: httpx.AsyncClient, prompt: str, args, stats: Stats) -> Optional[str]:
+    """Sends one streamed completion and records its timings. Returns the text, or None on error."""
+    payload = {"prompt": prompt, "max_tokens": args.max_tokens, "temperature": args.temperature, "stream": True}
+    if args.deadline_ms:
+        payload["deadline_ms"] = args.deadline_ms
+
+    stats.sent += 1
+    start = time.perf_counter()
+    first = None
+    parts = []
+    try:
+        async with client.stream("POST", "/v1/completions", json=payload) as response:
+            if response.status_code != 200:
+                await response.aread()
+                if response.status_code == 504:
+                    stats.expired += 1
+                else:
+                    stats.errors += 1
+                return None
+            async for line in response.aiter_lines():
+                if not line.startswith("data: ") or line == "data: [DONE]":
+                    continue
+                chunk = json.loads(line[len("data: "):])
+                if "error" in chunk:
+                    # Failures after the stream started (e.g. the deadline passed in the queue)
+                    if chunk["error"].get("code") == 504:
+                        stats.expired += 1
+                    else:
+                        stats.errors += 1
+                    return None
+                text = chunk["choices"][0].get("text") or ""
+                if text and first is None:
+                    first = time.perf_counter() # First generated text, not just response headers
+                parts.append(text)
+                stats.tokens += (chunk.get("usage") or {}).get("completion_tokens", 0)
+    except httpx.HTTPError:
+        stats.errors += 1
+        return None
+
+    end = time.perf_counter()
+    stats.completed += 1
+    stats.latency_ms.append((end - start) * 1000)
+    if first is not None:
+        stats.ttft_ms.append((first - start) * 1000)
+    return "".join(parts)
+
+
+async def run_editor(client: httpx.AsyncClient, trace: dict, args, stats: Stats, rng: random.Random, stop_at: float):
+    """Replays one trace as a user typing in an editor."""
+    text = trace.get("prompt", "")
+    keystrokes = trace["keystrokes"]
+    pending: Optional[asyncio.Task] = None
+    waited_ms = 0.0
+
+    for i, (delay_ms, chars) in enumerate(keystrokes):
+        await asyncio.sleep(max(0.0, delay_ms - waited_ms) / 1000)
+        if time.perf_counter() >= stop_at:
+            break
+
+        if pending and not pending.done():
+            # The user kept typing: the editor drops the outdated request
+            pending.cancel()
+            stats.cancelled += 1
+        elif pending and not pending.cancelled():
+            completion = pending.result()
+            if completion and rng.random() < args.accept_rate:
+                stats.accepted += 1
+                text += completion
+        pending = None
+
+        text += chars
+
+        # Debounce: the editor requests once typing pauses for debounce_ms
+        next_delay = keystrokes[i + 1][0] if i + 1 < len(keystrokes) else math.inf
+        waited_ms = 0.0
+        if next_delay > args.debounce_ms:
+            await asyncio.sleep(args.debounce_ms / 1000)
+            waited_ms = args.debounce_ms
+            pending = asyncio.ensure_future(request_completion(client, text[-args.prompt_chars:], args, stats))
+
+    if pending and not pending.done() and time.perf_counter() >= stop_at:
+        # The test is over: abandon the request like a closed editor
+        pending.cancel()
+        stats.cancelled += 1
+    elif pending:
+        try:
+            await pending
+        except asyncio.CancelledError:
+            pass
+
+
+def start_stub_server(args) -> str:
+    """
+    Serves server_gguf.py with the stub backend in a background thread and
+    returns its URL. The full request path (scheduling, coalescing, caching,
+    streaming) runs; only generation is simulated, with
+    --stub-token-ms per generated and --stub-prompt-token-ms per evaluated token.
+    """
+    import os
+    import uvicorn
+
+    os.environ["BACKEND"] = "stub"
+    os.environ["STUB_TOKEN_MS"] = str(args.stub_token_ms)
+    os.environ["STUB_PROMPT_TOKEN_MS"] = str(args.stub_prompt_token_ms)
+    import server_gguf
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+
+    server = uvicorn.Server(uvicorn.Config(server_gguf.app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return f"http://127.0.0.1:{port}"
+
+
+async def run(args) -> dict:
+    rng = random.Random(args.seed)
+    traces = load_traces(args.traces) if args.traces else [
+        synthetic_trace(snippet, rng, args.wpm) for snippet in SNIPPETS
+    ]
+    base_url = start_stub_server(args) if args.stub else args.url
+
+    stats = Stats()
+    limits = httpx.Limits(max_connections=args.editors, max_keepalive_connections=args.editors)
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout, limits=limits) as client:
+        health = (await client.get("/health")).json()
+        start = time.perf_counter()
+        stop_at = start + args.duration
+
+        async def editor(i: int):
+            editor_rng = random.Random(args.seed * 1000 + i)
+            # Each editor keeps typing traces until the test duration is over
+            while time.perf_counter() < stop_at:
+                trace = traces[editor_rng.randrange(len(traces))]
+                await run_editor(client, trace, args, stats, editor_rng, stop_at)
+
+        await asyncio.gather(*(editor(i) for i in range(args.editors)))
+        elapsed = time.perf_counter() - start
+
+    finished = stats.completed + stats.errors + stats.expired
+    return {
+        "config": {
+            "url": "stub" if args.stub else args.url,
+            "model": health.get("model"),
+            "editors": args.editors,
+            "duration_s": args.duration,
+            "traces": args.traces or "synthetic",
+            "wpm": args.wpm,
+            "debounce_ms": args.debounce_ms,
+            "accept_rate": args.accept_rate,
+            "max_tokens": args.max_tokens,
+            "deadline_ms": args.deadline_ms,
+        },
+        "elapsed_s": elapsed,
+        "requests": {
+            "sent": stats.sent,
+            "completed": stats.completed,
+            "cancelled": stats.cancelled,
+            "errors": stats.errors,
+            "expired": stats.expired,
+            "accepted": stats.accepted,
+        },
+        "error_rate": (stats.errors + stats.expired) / finished if finished else 0.0,
+        "acceptance_rate": stats.accepted / stats.completed if stats.completed else 0.0,
+        "latency_ms": summarize(stats.latency_ms),
+        "ttft_ms": summarize(stats.ttft_ms),
+        "throughput": {
+            "completions_per_s": stats.completed / elapsed if elapsed else 0.0,
+            "tokens_per_s": stats.tokens / elapsed if elapsed else 0.0,
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent typing-trace load test for the completion server")
+    parser.add_argument("--url", default=BASE_URL, help="Server base URL")
+    parser.add_argument("--stub", action="store_true", help="Run the server in-process with the stub backend")
+    parser.add_argument("--traces", help="JSONL file of recorded keystroke traces")
+    parser.add_argument("--editors", type=int, default=8, help="Concurrent simulated editors")
+    parser.add_argument("--duration", type=float, default=30, help="Test duration in seconds")
+    parser.add_argument("--wpm", type=float, default=40, help="Typing speed of synthetic traces")
+    parser.add_argument("--debounce-ms", type=float, default=150, help="Typing pause that triggers a request")
+    parser.add_argument("--accept-rate", type=float, default=0.3, help="Probability of accepting a completion")
+    parser.add_argument("--prompt-chars", type=int, default=2048, help="Characters before the cursor sent as prompt")
+    parser.add_argument("--max-tokens", type=int, default=16)
+    parser.add_argument("--temperature", type=float, default=0.0)
+    parser.add_argument("--deadline-ms", type=int, default=0, help="Per-request deadline_ms (0: server default)")
+    parser.add_argument("--timeout", type=float, default=30, help="HTTP timeout in seconds")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--stub-token-ms", type=float, default=20, help="Stub decode time per token")
+    parser.add_argument("--stub-prompt-token-ms", type=float, default=0.5, help="Stub prompt-eval time per token")
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
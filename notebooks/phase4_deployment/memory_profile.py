@@ -0,0 +1,112 @@
+import os
+import logging
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# ggml_type ids accepted by llama.cpp for type_k / type_v
+KV_CACHE_TYPES = {"f16": 1, "q8_0": 8, "q4_0": 2}
+MEMORY_MODES = ("mmap", "unload")
+
+
+def _status_kb(field: str) -> Optional[int]:
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def rss_mb() -> Optional[float]:
+    """Resident set size of the server process in MB (Linux only)."""
+    kb = _status_kb("VmRSS")
+    return kb / 1024 if kb is not None else None
+
+
+def peak_rss_mb() -> Optional[float]:
+    kb = _status_kb("VmHWM")
+    return kb / 1024 if kb is not None else None
+
+
+def available_mb() -> Optional[float]:
+    """MemAvailable from /proc/meminfo in MB."""
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+class MemoryProfile:
+    """
+    Memory-related llama.cpp settings.
+
+    The low-memory profile quantizes the KV cache to q8_0 (q4_0 on request),
+    which needs flash attention for the V cache, and shrinks n_ctx according
+    to the memory available at startup. MEMORY_MODE chooses between keeping
+    models mapped and letting the OS page them out (`mmap`), and unloading
+    models idle for `idle_unload_seconds` to reload them on the next request
+    (`unload`).
+    """
+    def __init__(self, low_memory: bool = False, kv_cache_type: str = "f16", n_ctx: int = 512,
+                 mode: str = "mmap", idle_unload_seconds: float = 0):
+        if kv_cache_type not in KV_CACHE_TYPES:
+            raise ValueError(f"Unknown KV cache type '{kv_cache_type}', expected one of {sorted(KV_CACHE_TYPES)}")
+        if mode not in MEMORY_MODES:
+            raise ValueError(f"Unknown memory mode '{mode}', expected one of {MEMORY_MODES}")
+        self.low_memory = low_memory
+        self.kv_cache_type = kv_cache_type
+        self.n_ctx = n_ctx
+        self.mode = mode
+        self.idle_unload_seconds = idle_unload_seconds if mode == "unload" else 0
+
+    @classmethod
+    def from_env(cls) -> "MemoryProfile":
+        low = os.getenv("LOW_MEMORY", "0") == "1"
+        mode = os.getenv("MEMORY_MODE", "unload" if low else "mmap").lower()
+        return cls(
+            low_memory=low,
+            kv_cache_type=os.getenv("KV_CACHE_TYPE", "q8_0" if low else "f16").lower(),
+            n_ctx=int(os.getenv("N_CTX", 0)) or cls.adaptive_n_ctx(low),
+            mode=mode,
+            idle_unload_seconds=float(os.getenv("IDLE_UNLOAD_SECONDS", 300)),
+        )
+
+    @staticmethod
+    def adaptive_n_ctx(low_memory: bool) -> int:
+        """512 tokens normally; in the low-memory profile 384 or 256 when less than 2GB / 1GB is available."""
+        if not low_memory:
+            return 512
+        available = available_mb()
+        if available is None or available >= 2048:
+            return 512
+        return 384 if available >= 1024 else 256
+
+    def llama_kwargs(self) -> dict:
+        kwargs = {
+            "n_ctx": self.n_ctx,
+            "use_mmap": True,
+            "use_mlock": False,
+        }
+        if self.kv_cache_type != "f16":
+            kwargs["type_k"] = KV_CACHE_TYPES[self.kv_cache_type]
+            kwargs["type_v"] = KV_CACHE_TYPES[self.kv_cache_type]
+            kwargs["flash_attn"] = True # Required by a quantized V cache
+        return kwargs
+
+    def report(self) -> dict:
+        return {
+            "low_memory": self.low_memory,
+            "kv_cache_type": self.kv_cache_type,
+            "n_ctx": self.n_ctx,
+            "mode": self.mode,
+            "idle_unload_seconds": self.idle_unload_seconds,
+            "rss_mb": rss_mb(),
+            "peak_rss_mb": peak_rss_mb(),
+        }
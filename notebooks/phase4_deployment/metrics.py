@@ -0,0 +1,133 @@
+"""
+Edit-distance based completion metrics shared by the server utils, the
+clients and the evaluation runner.
+
+Edit similarity follows 03_evaluation.ipynb: 1 - Levenshtein(pred, ref) / max_len.
+Persistence rate is the share of the prediction kept in the reference:
+LCS(pred, ref) / len(pred).
+
+Distances use rapidfuzz (or python-Levenshtein) when installed and otherwise
+a bit-parallel implementation on Python integers (Myers/Hyyrö for
+Levenshtein, Allison-Dix/Hyyrö for LCS), which runs in O(n * ceil(m / w)).
+All backends return identical values.
+"""
+from typing import Dict, List, Sequence
+
+try:
+    from rapidfuzz.distance import Levenshtein as _rf_levenshtein, LCSseq as _rf_lcs
+except ImportError:
+    _rf_levenshtein = _rf_lcs = None
+
+try:
+    import numpy # cpdist returns numpy arrays
+    from rapidfuzz.process import cpdist as _rf_cpdist
+except ImportError:
+    _rf_cpdist = None
+
+try:
+    import Levenshtein as _py_levenshtein
+except ImportError:
+    _py_levenshtein = None
+
+BACKEND = "rapidfuzz" if _rf_levenshtein else ("python-Levenshtein" if _py_levenshtein else "bit-parallel")
+
+
+def _peq(pattern: str) -> Dict[str, int]:
+    """Bit mask of the positions of each character in the pattern."""
+    masks: Dict[str, int] = {}
+    for i, ch in enumerate(pattern):
+        masks[ch] = masks.get(ch, 0) | (1 << i)
+    return masks
+
+
+def _levenshtein_bits(a: str, b: str) -> int:
+    if a == b:
+        return 0
+    if len(a) > len(b):
+        a, b = b, a # Shorter string as the bit-vector pattern
+    m = len(a)
+    if m == 0:
+        return len(b)
+
+    peq = _peq(a)
+    mask = (1 << m) - 1
+    last = 1 << (m - 1)
+    pv, mv, score = mask, 0, m
+    for ch in b:
+        eq = peq.get(ch, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & mask)
+        mh = pv & xh
+        if ph & last:
+            score += 1
+        elif mh & last:
+            score -= 1
+        ph = ((ph << 1) | 1) & mask
+        mh = (mh << 1) & mask
+        pv = mh | (~(xv | ph) & mask)
+        mv = ph & xv
+    return score
+
+
+def _lcs_bits(a: str, b: str) -> int:
+    if len(a) > len(b):
+        a, b = b, a
+    m = len(a)
+    if m == 0:
+        return 0
+
+    peq = _peq(a)
+    mask = (1 << m) - 1
+    s = mask
+    for ch in b:
+        u = s & peq.get(ch, 0)
+        s = ((s + u) | (s - u)) & mask
+    return m - bin(s).count("1")
+
+
+def levenshtein(a: str, b: str) -> int:
+    if _rf_levenshtein:
+        return _rf_levenshtein.distance(a, b)
+    if _py_levenshtein:
+        return _py_levenshtein.distance(a, b)
+    return _levenshtein_bits(a, b)
+
+
+def lcs_length(a: str, b: str) -> int:
+    """Length of the longest common subsequence."""
+    if _rf_lcs:
+        return _rf_lcs.similarity(a, b)
+    return _lcs_bits(a, b)
+
+
+def edit_similarity(pred: str, expected: str) -> float:
+    if not pred and not expected:
+        return 1.0
+    return 1.0 - levenshtein(pred, expected) / max(len(pred), len(expected))
+
+
+def persistence_rate(pred: str, expected: str) -> float:
+    return lcs_length(pred, expected) / len(pred) if pred else 0.0
+
+
+def edit_similarity_batch(preds: Sequence[str], expected: Sequence[str]) -> List[float]:
+    """edit_similarity over pairs; with rapidfuzz the distances are computed in C on all cores."""
+    if len(preds) != len(expected):
+        raise ValueError("preds and expected must have the same length")
+    if _rf_cpdist is not None:
+        distances = _rf_cpdist(preds, expected, scorer=_rf_levenshtein.distance, workers=-1)
+    else:
+        distances = [levenshtein(p, e) for p, e in zip(preds, expected)]
+    return [1.0 if not p and not e else 1.0 - int(d) / max(len(p), len(e))
+            for p, e, d in zip(preds, expected, distances)]
+
+
+def persistence_rate_batch(preds: Sequence[str], expected: Sequence[str]) -> List[float]:
+    if len(preds) != len(expected):
+        raise ValueError("preds and expected must have the same length")
+    if _rf_cpdist is not None:
+        lengths = _rf_cpdist(preds, expected, scorer=_rf_lcs.similarity, workers=-1)
+    else:
+        lengths = [lcs_length(p, e) for p, e in zip(preds, expected)]
+    return [int(n) / len(p) if p else 0.0 for p, n in zip(preds, lengths)]
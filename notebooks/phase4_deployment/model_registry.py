@@ -0,0 +1,279 @@
+import os
+import time
+import logging
+import threading
+from concurrent.futures import Future
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+import fim
+from chat_cache import ChatStateCache
+
+logger = logging.getLogger(__name__)
+
+# Name most editor plugins send by default; it always maps to the default model
+DEFAULT_MODEL_ALIAS = "qwen2.5-coder"
+
+
+class LoadedModel:
+    """
+    A model resident in memory together with its per-model helpers.
+    The lock serializes access to the llama.cpp context, which is not thread-safe.
+    `users` counts the requests holding the model (see ModelRegistry.get and
+    release); a model in use is never unloaded.
+    """
+    def __init__(self, model_id: str, path: str, llm, size_bytes: int):
+        self.model_id = model_id
+        self.path = path
+        self.llm = llm
+        self.size_bytes = size_bytes
+        self.fim = fim.FimFormatter.from_env(llm)
+        self.chat_cache = ChatStateCache.from_env()
+        # Budgeted as model file + the chat cache's full capacity, which it may fill
+        self.footprint = size_bytes + (self.chat_cache.capacity_bytes if self.chat_cache else 0)
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+        self.users = 0
+
+    def close(self):
+        if hasattr(self.llm, "close"):
+            self.llm.close()
+        self.llm = None
+        self.fim = None
+        self.chat_cache = None
+
+
+class ModelRegistry:
+    """
+    Lists the model files (GGUF by default) of a directory and keeps the most recently used ones loaded.
+
+    Models are loaded on first use. When loading a model would exceed the RAM
+    budget (model file plus chat cache capacity per model), the least recently
+    used models are evicted. The default model is
+    pinned and never evicted for the budget; only the idle timeout
+    (unload_idle) releases it, and the next request loads it again.
+
+    Loading and closing models happens outside the registry lock, so a slow
+    load only blocks the requests waiting for that model. Concurrent requests
+    for a model being loaded wait on the same future.
+    """
+    def __init__(self, model_dir: str, loader: Callable[[str], object],
+                 default_path: Optional[str] = None, ram_budget_mb: int = 2048, extension: str = ".gguf",
+                 exclude_suffixes: Tuple[str, ...] = ()):
+        self.model_dir = model_dir
+        self.extension = extension
+        self.exclude_suffixes = exclude_suffixes # Files with the extension that are not models (e.g. caches)
+        self.loader = loader
+        self.ram_budget_bytes = ram_budget_mb * 1024 * 1024
+        self.paths: Dict[str, str] = {}
+        self.loaded: "OrderedDict[str, LoadedModel]" = OrderedDict()
+        self.idle_unloaded = set()
+        self._loading: Dict[str, Future] = {}
+        self._reserved: Dict[str, int] = {} # Budget taken by models being loaded
+        self._lock = threading.RLock()
+
+        self.scan()
+        if default_path:
+            self.default_id = self._model_id(default_path)
+            self.paths.setdefault(self.default_id, default_path)
+        else:
+            self.default_id = next(iter(sorted(self.paths)), None)
+
+    @staticmethod
+    def _model_id(path: str) -> str:
+        return os.path.splitext(os.path.basename(path))[0]
+
+    def scan(self):
+        """Refreshes the list of available models from the model directory."""
+        if not self.model_dir or not os.path.isdir(self.model_dir):
+            return
+        with self._lock:
+            for name in os.listdir(self.model_dir):
+                if name.lower().endswith(self.extension) and not name.lower().endswith(self.exclude_suffixes):
+                    path = os.path.join(self.model_dir, name)
+                    self.paths.setdefault(self._model_id(path), path)
+
+    def resolve(self, name: Optional[str]) -> Optional[str]:
+        """Maps a request's model field to a model id, falling back to the default model."""
+        if name and name not in self.paths and name != DEFAULT_MODEL_ALIAS:
+            self.scan()
+        if name in self.paths:
+            return name
+        return self.default_id
+
+    def list_models(self) -> List[dict]:
+        self.scan()
+        with self._lock:
+            return [
+                {
+                    "id": model_id,
+                    "object": "model",
+                    "owned_by": "local",
+                    "loaded": model_id in self.loaded,
+                    "pinned": model_id == self.default_id,
+                }
+                for model_id in sorted(self.paths)
+            ]
+
+    def get(self, name: Optional[str] = None) -> LoadedModel:
+        """
+        Returns the loaded model for a request, loading it first if needed.
+        The model stays in use until release(entry) is called.
+        Raises KeyError if no model matches and MemoryError if it does not fit the budget.
+        """
+        model_id = self.resolve(name)
+        if model_id is None:
+            raise KeyError("No models available")
+
+        while True:
+            with self._lock:
+                entry = self.loaded.get(model_id)
+                if entry is not None:
+                    self.loaded.move_to_end(model_id)
+                    entry.last_used = time.monotonic()
+                    entry.users += 1
+                    return entry
+                future = self._loading.get(model_id)
+                loading = future is None
+                if loading:
+                    future = self._loading[model_id] = Future()
+                    self._reserved[model_id] = self._footprint(model_id)
+                    try:
+                        victims = self._evict_for(model_id)
+                    except MemoryError as e:
+                        self._finish_load(model_id, future, error=e)
+                        raise
+
+            if not loading:
+                future.result() # Re-raises the loader's error
+                continue # Loaded; take it (or load again if it was unloaded meanwhile)
+
+            for victim in victims:
+                self._close(victim)
+            try:
+                entry = self._load(model_id)
+            except BaseException as e:
+                with self._lock:
+                    self._finish_load(model_id, future, error=e)
+                raise
+            with self._lock:
+                self.loaded[model_id] = entry
+                self.idle_unloaded.discard(model_id)
+                entry.users += 1
+                self._finish_load(model_id, future, entry=entry)
+            return entry
+
+    def release(self, entry: LoadedModel):
+        """Marks one use of a model returned by get() as finished."""
+        with self._lock:
+            entry.users -= 1
+            entry.last_used = time.monotonic()
+
+    def _file_size(self, model_id: str) -> int:
+        path = self.paths[model_id]
+        return os.path.getsize(path) if os.path.exists(path) else 0
+
+    def _footprint(self, model_id: str) -> int:
+        return self._file_size(model_id) + ChatStateCache.capacity_from_env()
+
+    def _finish_load(self, model_id: str, future: Future, entry: Optional[LoadedModel] = None,
+                     error: Optional[BaseException] = None):
+        del self._loading[model_id]
+        self._reserved.pop(model_id, None)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(entry)
+
+    def _load(self, model_id: str) -> LoadedModel:
+        path = self.paths[model_id]
+        size = self._file_size(model_id)
+        logger.info(f"Loading model '{model_id}' from: {path}")
+        start = time.time()
+        llm = self.loader(path)
+        entry = LoadedModel(model_id, path, llm, size)
+        logger.info(f"Model '{model_id}' loaded in {time.time() - start:.1f}s ({size / 2**20:.0f}MB)")
+        return entry
+
+    def _evict_for(self, model_id: str) -> List[LoadedModel]:
+        """
+        Removes least recently used idle models until the model being loaded fits
+        the budget. Called with the registry lock held; the caller closes the
+        returned models after releasing it.
+        """
+        size = self._reserved[model_id]
+        used = sum(m.footprint for m in self.loaded.values()) + sum(self._reserved.values()) - size
+        victims = []
+        for victim_id, entry in list(self.loaded.items()):
+            if used + size <= self.ram_budget_bytes:
+                break
+            if victim_id == self.default_id or entry.users:
+                continue
+            used -= entry.footprint
+            victims.append(self.loaded.pop(victim_id))
+
+        if used + size > self.ram_budget_bytes and (self.loaded or len(self._reserved) > 1):
+            # Put back what was taken out; nothing has been closed yet
+            for entry in reversed(victims):
+                self.loaded[entry.model_id] = entry
+                self.loaded.move_to_end(entry.model_id, last=False)
+            raise MemoryError(
+                f"Model needs {size / 2**20:.0f}MB but only "
+                f"{(self.ram_budget_bytes - used) / 2**20:.0f}MB of the RAM budget is free"
+            )
+        return victims
+
+    @staticmethod
+    def _close(entry: LoadedModel):
+        # Requests that took the model before it was removed release it first
+        with entry.lock:
+            entry.close()
+        logger.info(f"Model '{entry.model_id}' unloaded.")
+
+    def unload(self, model_id: str) -> bool:
+        """Unloads a model unless a request is using it. Returns whether it was unloaded."""
+        with self._lock:
+            entry = self.loaded.get(model_id)
+            if entry is None or entry.users:
+                return False
+            del self.loaded[model_id]
+        self._close(entry)
+        return True
+
+    def unload_idle(self, idle_seconds: float) -> List[str]:
+        """Unloads models unused for `idle_seconds`, skipping busy ones. Returns their ids."""
+        now = time.monotonic()
+        with self._lock:
+            idle = [model_id for model_id, entry in self.loaded.items()
+                    if now - entry.last_used >= idle_seconds and not entry.users]
+        unloaded = []
+        for model_id in idle:
+            if self.unload(model_id):
+                with self._lock:
+                    if model_id not in self.loaded:
+                        self.idle_unloaded.add(model_id)
+                unloaded.append(model_id)
+        return unloaded
+
+    def start_idle_reaper(self, idle_seconds: float) -> threading.Event:
+        """Calls unload_idle periodically in a daemon thread."""
+        stop = threading.Event()
+
+        def run():
+            while not stop.wait(min(idle_seconds, 30)):
+                try:
+                    for model_id in self.unload_idle(idle_seconds):
+                        logger.info(f"Model '{model_id}' idle for {idle_seconds:.0f}s, unloaded until next request")
+                except Exception as e:
+                    logger.error(f"Idle unload failed: {e}")
+
+        threading.Thread(target=run, name="model-idle-reaper", daemon=True).start()
+        return stop
+
+    def unload_all(self):
+        """Unloads every model, waiting for in-flight generations. Used at shutdown."""
+        with self._lock:
+            entries = list(self.loaded.values())
+            self.loaded.clear()
+        for entry in entries:
+            self._close(entry)
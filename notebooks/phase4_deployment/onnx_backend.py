@@ -0,0 +1,339 @@
+"""
+ONNX Runtime backend for the completion server (BACKEND=onnx).
+
+Runs a decoder exported by phase3_onnx_pipeline.py (optimum, task
+text-generation-with-past) with a hand-written decode loop instead of
+ORTModelForCausalLM.generate:
+
+- One InferenceSession per model, reused across requests.
+- All inputs and outputs are bound with IO binding to preallocated numpy
+  buffers, so a decode step allocates nothing but the session's scratch.
+- The KV cache lives in two fixed-capacity buffers per layer and tensor
+  (ping-pong): step t reads past_key_values from one and the model writes
+  present into the other. A buffer is used as a contiguous
+  [1, kv_heads, length, head_dim] prefix, so no copies happen between steps.
+- The evaluated prefix is kept between requests like llama.cpp's KV cache;
+  only the tokens after the longest common prefix are evaluated.
+- Graph optimization runs once: the optimized graph is serialized next to
+  the model (<name>.optimized.onnx, also written by phase3_onnx_pipeline.py)
+  and later starts load it with runtime optimization disabled.
+
+Exported graphs concatenate past and new keys into a fresh present tensor,
+so the cache cannot be appended in place within a single buffer; ping-pong
+is the closest equivalent without a custom export.
+"""
+import os
+import time
+import logging
+from typing import Iterator, List, NamedTuple, Optional, Sequence, Union
+
+import numpy as np
+
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
+
+try:
+    from transformers import AutoTokenizer
+except ImportError:
+    AutoTokenizer = None
+
+import topology
+from backends import completion_response, find_stop
+from memory_profile import MemoryProfile
+
+logger = logging.getLogger(__name__)
+
+ORT_DTYPES = {"tensor(float)": np.float32, "tensor(float16)": np.float16}
+END_TOKENS = ("<|endoftext|>", "<|im_end|>")
+OPTIMIZED_SUFFIX = ".optimized.onnx"
+
+
+def optimized_path(model_path: str) -> str:
+    """Path of the serialized optimized graph of a model."""
+    if model_path.endswith(OPTIMIZED_SUFFIX):
+        return model_path
+    return os.path.splitext(model_path)[0] + OPTIMIZED_SUFFIX
+
+
+def has_external_data(model_path: str) -> bool:
+    """
+    Whether a model keeps its weights outside the .onnx file, as exports over
+    2GB do: the `<file>_data` written next to it, or a graph file too small to
+    hold the weights. Shared with phase3_onnx_pipeline.py.
+    """
+    return os.path.exists(model_path + "_data") or os.path.getsize(model_path) < 2**20
+
+
+def session_options(model_path: str, n_threads: int = 0, optimized_cache: bool = True):
+    """
+    SessionOptions and the file to load for a model. A cached optimized graph
+    no older than the model is loaded with optimization disabled; otherwise the
+    graph is optimized (extended level, portable across CPUs) and, with
+    optimized_cache, serialized for the next start.
+    """
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = n_threads
+    options.inter_op_num_threads = 1
+    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+
+    cached = optimized_path(model_path)
+    if os.path.exists(cached) and (cached == model_path or os.path.getmtime(cached) >= os.path.getmtime(model_path)):
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+        return options, cached, True
+
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+    if optimized_cache and os.access(os.path.dirname(os.path.abspath(cached)), os.W_OK):
+        options.optimized_model_filepath = cached
+        if has_external_data(model_path):
+            # Models over 2GB keep their weights in an external file
+            options.add_session_config_entry("session.optimized_model_external_initializers_file_name",
+                                             os.path.basename(cached) + "_data")
+    return options, model_path, False
+
+
+class OnnxState(NamedTuple):
+    """A save_state snapshot: the evaluated token ids and a copy of their KV cache."""
+    input_ids: List[int]
+    kv: List[np.ndarray]
+
+    @property
+    def nbytes(self) -> int:
+        """Memory held by the snapshot, for chat_cache.state_bytes."""
+        return sum(array.nbytes for array in self.kv) + 8 * len(self.input_ids)
+
+
+class OnnxLlama:
+    """
+    The llama_cpp.Llama subset of backends.CompletionBackend on ONNX Runtime.
+
+    Sampling is greedy at temperature 0, otherwise temperature + top-p.
+    The context capacity (n_ctx) bounds prompt + generated tokens.
+    """
+
+    def __init__(self, model_path: str, n_ctx: int = 512, n_threads: int = 0, tokenizer_path: Optional[str] = None,
+                 optimized_cache: bool = True):
+        if ort is None or AutoTokenizer is None:
+            raise RuntimeError("BACKEND=onnx needs onnxruntime and transformers")
+        options, session_path, preoptimized = session_options(model_path, n_threads, optimized_cache)
+        start = time.perf_counter()
+        self.session = ort.InferenceSession(session_path, options, providers=["CPUExecutionProvider"])
+        self.session_load_s = time.perf_counter() - start
+        self.preoptimized = preoptimized
+        logger.info(f"ONNX session for {os.path.basename(session_path)} created in {self.session_load_s:.2f}s "
+                    f"({'pre-optimized graph' if preoptimized else 'graph optimized at load'})")
+        self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_path or os.path.dirname(os.path.abspath(model_path)))
+        self.model_name = os.path.splitext(os.path.basename(model_path))[0]
+
+        inputs = {i.name: i for i in self.session.get_inputs()}
+        self.n_layers = sum(1 for name in inputs if name.startswith("past_key_values.") and name.endswith(".key"))
+        past = inputs["past_key_values.0.key"]
+        _, self.n_kv_heads, _, self.head_dim = past.shape
+        self.kv_dtype = ORT_DTYPES[past.type]
+        self.has_position_ids = "position_ids" in inputs
+        self.has_cache_branch = "use_cache_branch" in inputs
+        logits = next(o for o in self.session.get_outputs() if o.name == "logits")
+        self.vocab_size = logits.shape[-1]
+        self.logits_dtype = ORT_DTYPES[logits.type]
+
+        self._n_ctx = n_ctx
+        self.end_ids = {t for t in (self.tokenizer.convert_tokens_to_ids(s) for s in END_TOKENS)
+                        if t is not None and t != self.tokenizer.unk_token_id}
+        if self.tokenizer.eos_token_id is not None:
+            self.end_ids.add(self.tokenizer.eos_token_id)
+
+        # Preallocated buffers: token ids, positions, attention mask, last-step logits, KV ping-pong
+        self._ids = np.zeros(n_ctx, dtype=np.int64)
+        self._positions = np.arange(n_ctx, dtype=np.int64)
+        self._mask = np.ones(n_ctx, dtype=np.int64)
+        self._logits = np.empty((1, 1, self.vocab_size), dtype=self.logits_dtype)
+        self._cache_branch = np.zeros(1, dtype=np.bool_)
+        kv_size = self.n_kv_heads * n_ctx * self.head_dim
+        self._kv = [[np.empty(kv_size, dtype=self.kv_dtype) for _ in range(2 * self.n_layers)] for _ in range(2)]
+        self._cur = 0
+        self._binding = self.session.io_binding()
+
+        self.input_ids: List[int] = []
+        self.n_tokens = 0
+        self._rng = np.random.default_rng()
+
+    @classmethod
+    def from_env(cls, model_path: str) -> "OnnxLlama":
+        plan = topology.ThreadPlan.detect()
+        memory = MemoryProfile.from_env()
+        return cls(model_path, n_ctx=memory.n_ctx, n_threads=plan.n_threads,
+                   tokenizer_path=os.getenv("ONNX_TOKENIZER_PATH"),
+                   optimized_cache=os.getenv("ONNX_OPTIMIZED_CACHE", "1") != "0")
+
+    # Tokenizer
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False) -> List[int]:
+        tokens = self.tokenizer(text.decode("utf-8", errors="ignore"), add_special_tokens=False,
+                                split_special_tokens=not special)["input_ids"]
+        bos = self.tokenizer.bos_token_id
+        return ([bos] if add_bos and bos is not None else []) + list(tokens)
+
+    def detokenize(self, tokens: List[int]) -> bytes:
+        return self.tokenizer.decode(tokens, skip_special_tokens=False,
+                                     clean_up_tokenization_spaces=False).encode("utf-8")
+
+    def n_ctx(self) -> int:
+        return self._n_ctx
+
+    # KV cache
+
+    def _kv_view(self, buf: int, index: int, length: int) -> np.ndarray:
+        return self._kv[buf][index][:self.n_kv_heads * length * self.head_dim].reshape(
+            1, self.n_kv_heads, length, self.head_dim)
+
+    def _bind(self, name: str, array: np.ndarray, output: bool = False):
+        bind = self._binding.bind_output if output else self._binding.bind_input
+        bind(name, "cpu", 0, array.dtype.type, list(array.shape), array.ctypes.data)
+
+    def _forward(self, tokens: Sequence[int]) -> np.ndarray:
+        """Evaluates tokens after the cached prefix; returns the logits of the last one."""
+        past, n = self.n_tokens, len(tokens)
+        total = past + n
+        if total > self._n_ctx:
+            raise ValueError(f"Requested tokens ({total}) exceed context window of {self._n_ctx}")
+        cur, nxt = self._cur, 1 - self._cur
+
+        binding = self._binding
+        binding.clear_binding_inputs()
+        binding.clear_binding_outputs()
+        self._ids[:n] = tokens
+        self._bind("input_ids", self._ids[:n].reshape(1, n))
+        self._bind("attention_mask", self._mask[:total].reshape(1, total))
+        if self.has_position_ids:
+            self._bind("position_ids", self._positions[past:total].reshape(1, n))
+        if self.has_cache_branch:
+            self._cache_branch[0] = past > 0
+            self._bind("use_cache_branch", self._cache_branch)
+        for layer in range(self.n_layers):
+            for j, kind in enumerate(("key", "value")):
+                index = 2 * layer + j
+                self._bind(f"past_key_values.{layer}.{kind}", self._kv_view(cur, index, past))
+                self._bind(f"present.{layer}.{kind}", self._kv_view(nxt, index, total), output=True)
+        if n == 1:
+            self._bind("logits", self._logits, output=True)
+        else:
+            # Prompt logits are [1, n, vocab]; let ORT size them once per request
+            binding.bind_output("logits", "cpu")
+
+        self.session.run_with_iobinding(binding)
+        logits = self._logits if n == 1 else binding.get_outputs()[-1].numpy()
+        self._cur = nxt
+        self.input_ids = self.input_ids[:past] + list(tokens)
+        self.n_tokens = total
+        return logits[0, -1]
+
+    def _truncate(self, length: int):
+        """Keeps the first `length` cached tokens (the head stride changes, so this copies once)."""
+        if length >= self.n_tokens:
+            return
+        cur, nxt = self._cur, 1 - self._cur
+        if length > 0:
+            for index in range(2 * self.n_layers):
+                src = self._kv_view(cur, index, self.n_tokens)
+                self._kv_view(nxt, index, length)[...] = src[:, :, :length, :]
+            self._cur = nxt
+        self.n_tokens = length
+        self.input_ids = self.input_ids[:length]
+
+    def reset(self):
+        self.n_tokens = 0
+
+    def eval(self, tokens: Sequence[int]):
+        self.input_ids = self.input_ids[:self.n_tokens]
+        if tokens:
+            self._forward(tokens)
+
+    def save_state(self) -> OnnxState:
+        n = self.n_tokens
+        kv = [self._kv_view(self._cur, i, n).copy() for i in range(2 * self.n_layers)]
+        return OnnxState(list(self.input_ids[:n]), kv)
+
+    def load_state(self, state: OnnxState):
+        input_ids, kv = state
+        n = len(input_ids)
+        for index, array in enumerate(kv):
+            self._kv_view(self._cur, index, n)[...] = array
+        self.input_ids = list(input_ids)
+        self.n_tokens = n
+
+    def close(self):
+        self.input_ids = []
+        self.n_tokens = 0
+
+    # Generation
+
+    def _sample(self, logits: np.ndarray, temperature: float, top_p: float) -> int:
+        if temperature <= 0:
+            return int(np.argmax(logits))
+        scaled = logits.astype(np.float32) / temperature
+        probs = np.exp(scaled - scaled.max())
+        probs /= probs.sum()
+        if top_p < 1.0:
+            order = np.argsort(-probs)
+            keep = order[:int(np.searchsorted(np.cumsum(probs[order]), top_p)) + 1]
+            return int(self._rng.choice(keep, p=probs[keep] / probs[keep].sum()))
+        return int(self._rng.choice(len(probs), p=probs))
+
+    def _generate(self, tokens: List[int], max_tokens: int, stop, stopping_criteria,
+                  temperature: float, top_p: float) -> Iterator[tuple]:
+        if not tokens:
+            raise ValueError("Prompt is empty")
+        if len(tokens) + max_tokens > self._n_ctx:
+            raise ValueError(f"Requested tokens ({len(tokens) + max_tokens}) exceed context window of {self._n_ctx}")
+
+        # Reuse the evaluated prefix; at least the last prompt token is evaluated for its logits
+        evaluated = self.input_ids[:self.n_tokens]
+        keep = 0
+        while keep < min(len(evaluated), len(tokens) - 1) and evaluated[keep] == tokens[keep]:
+            keep += 1
+        self._truncate(keep)
+        logits = self._forward(tokens[keep:])
+
+        stops = [s for s in ([stop] if isinstance(stop, str) else list(stop or [])) if s]
+        # Text that could still turn into a stop sequence is held back until it cannot
+        holdback = max((len(s) for s in stops), default=1) - 1
+        generated: List[int] = []
+        text = ""
+        emitted = 0
+        for i in range(max_tokens):
+            token = self._sample(logits, temperature, top_p)
+            if token in self.end_ids:
+                yield text[emitted:], "stop"
+                return
+            generated.append(token)
+            if stopping_criteria is not None and stopping_criteria(self.input_ids + generated, logits):
+                yield text[emitted:], "stop"
+                return
+            decoded = self.tokenizer.decode(generated, skip_special_tokens=False, clean_up_tokenization_spaces=False)
+            if not decoded.endswith("\ufffd"): # Otherwise an incomplete UTF-8 sequence: wait for the next token
+                text = decoded
+            hit = find_stop(text, stops)
+            if hit >= 0:
+                yield text[emitted:hit], "stop"
+                return
+            safe = max(emitted, len(text) - holdback)
+            yield text[emitted:safe], None
+            emitted = safe
+            if i + 1 < max_tokens:
+                logits = self._forward([token])
+        yield text[emitted:], "length"
+
+    def __call__(self, prompt: Union[str, List[int]], suffix: Optional[str] = None, max_tokens: int = 16,
+                 temperature: float = 0.8, top_p: float = 0.95, stop=None, stream: bool = False,
+                 stopping_criteria=None, **kwargs):
+        tokens = list(prompt) if isinstance(prompt, list) else self.tokenize(prompt.encode("utf-8"), special=True)
+        if suffix:
+            tokens += self.tokenize(suffix.encode("utf-8"), add_bos=False, special=True)
+        steps = self._generate(tokens, max_tokens or 16, stop, stopping_criteria, temperature, top_p)
+        return completion_response(steps, len(tokens), stream, self.model_name)
+
+
+def load_onnx(model_path: str) -> OnnxLlama:
+    """Model loader for BACKEND=onnx; the tokenizer is read from the model directory."""
+    return OnnxLlama.from_env(model_path)
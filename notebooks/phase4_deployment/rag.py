@@ -0,0 +1,533 @@
+import os
+import re
+import ast
+import math
+import time
+import pickle
+import hashlib
+import logging
+import threading
+from collections import Counter, OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+INDEX_VERSION = 1
+MAX_FILE_SIZE_BYTES = 1 * 1024 * 1024
+MAX_CHUNK_LINES = 60
+WINDOW_LINES = 40
+EXCLUDED_DIRS = {'.git', '.hg', '.svn', 'node_modules', 'venv', '.venv', '__pycache__', 'target', 'dist', 'build', 'bin', 'obj', 'vendor'}
+LANG_BY_EXT = {
+    '.py': 'python',
+    '.java': 'java',
+    '.cpp': 'cpp', '.h': 'cpp', '.cc': 'cpp', '.cxx': 'cpp', '.hpp': 'cpp', '.c': 'cpp',
+    '.js': 'javascript', '.jsx': 'javascript', '.ts': 'javascript', '.tsx': 'javascript',
+}
+COMMENT_PREFIX = {'python': '#'}
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+IDENT_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+SUBWORD_RE = re.compile(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|[0-9]+")
+STRING_OR_COMMENT_RE = re.compile(r'"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'|//.*')
+STOPWORDS = {
+    'def', 'class', 'return', 'self', 'import', 'from', 'as', 'if', 'else', 'elif', 'for', 'while',
+    'in', 'is', 'not', 'and', 'or', 'none', 'true', 'false', 'null', 'this', 'new', 'public',
+    'private', 'protected', 'static', 'final', 'void', 'int', 'const', 'let', 'var', 'function',
+    'include', 'std', 'auto', 'try', 'except', 'catch', 'pass', 'with', 'break', 'continue',
+}
+
+
+def walk_workspace(workspace: str) -> Dict[str, Tuple[float, int]]:
+    """
+    Source files of a workspace as {relative path: (mtime, size)}.
+    """
+    found = {}
+    for root, dirs, files in os.walk(workspace):
+        dirs[:] = [d for d in dirs if d not in EXCLUDED_DIRS and not d.startswith('.')]
+        for name in files:
+            if os.path.splitext(name)[1].lower() not in LANG_BY_EXT:
+                continue
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if st.st_size <= MAX_FILE_SIZE_BYTES:
+                found[os.path.relpath(path, workspace)] = (st.st_mtime, st.st_size)
+    return found
+
+
+def workspace_path(path: Optional[str], workspace: str) -> Optional[str]:
+    """
+    Workspace-relative form of a path sent by an editor (usually absolute),
+    as used for indexed files; relative paths are taken as they are.
+    """
+    if not path:
+        return None
+    return os.path.relpath(os.path.abspath(path), workspace) if os.path.isabs(path) else os.path.normpath(path)
+
+
+def terms(text: str) -> List[str]:
+    """
+    Splits code into BM25 terms: whole identifiers plus their camelCase/snake_case parts.
+    """
+    out = []
+    for ident in IDENT_RE.findall(text):
+        low = ident.lower()
+        if len(low) < 2 or low in STOPWORDS:
+            continue
+        out.append(low)
+        parts = SUBWORD_RE.findall(ident)
+        if len(parts) > 1:
+            out.extend(p.lower() for p in parts if len(p) > 1 and p.lower() not in STOPWORDS)
+    return out
+
+
+def _python_spans(text: str) -> List[Tuple[int, int]]:
+    """(start, end) 1-based line spans of functions and classes; large classes are split per member."""
+    spans = []
+
+    def visit(nodes):
+        for node in nodes:
+            if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                continue
+            start = min([d.lineno for d in node.decorator_list] + [node.lineno])
+            end = node.end_lineno
+            if isinstance(node, ast.ClassDef) and end - start + 1 > MAX_CHUNK_LINES and node.body:
+                spans.append((start, max(start, node.body[0].lineno - 1)))
+                visit(node.body)
+            else:
+                spans.append((start, end))
+
+    visit(ast.parse(text).body)
+    return spans
+
+
+def _brace_spans(lines: List[str], first: int, last: int) -> List[Tuple[int, int]]:
+    """
+    0-based line spans of top-level brace blocks between first and last (inclusive),
+    including the statement lines that open them. Large blocks are split into
+    their own top-level blocks.
+    """
+    spans = []
+    depth = 0
+    start = None
+    for i in range(first, last + 1):
+        code = STRING_OR_COMMENT_RE.sub("", lines[i])
+        if depth == 0 and start is None and code.strip():
+            start = i
+        for ch in code:
+            if ch == '{':
+                depth += 1
+            elif ch == '}':
+                depth = max(0, depth - 1)
+                if depth == 0 and start is not None:
+                    spans.append((start, i))
+                    start = None
+        if depth == 0 and start is not None and code.rstrip().endswith(';'):
+            start = None
+
+    result = []
+    for s, e in spans:
+        if e - s + 1 > MAX_CHUNK_LINES:
+            inner = _brace_spans(lines, s + 1, e - 1)
+            if inner:
+                result.append((s, max(s, inner[0][0] - 1)))
+                result.extend(inner)
+                continue
+        result.append((s, e))
+    return result
+
+
+def chunk_source(text: str, lang: str) -> List[Tuple[int, int, str]]:
+    """
+    Splits a source file into (start_line, end_line, text) chunks along
+    function/class boundaries, falling back to fixed windows of lines.
+    Line numbers are 1-based.
+    """
+    lines = text.splitlines()
+    spans: List[Tuple[int, int]] = []
+    try:
+        if lang == 'python':
+            spans = _python_spans(text)
+        elif lang in ('java', 'cpp', 'javascript'):
+            spans = [(s + 1, e + 1) for s, e in _brace_spans(lines, 0, len(lines) - 1)]
+    except (SyntaxError, ValueError, RecursionError):
+        spans = []
+    if not spans:
+        spans = [(s + 1, min(len(lines), s + WINDOW_LINES)) for s in range(0, len(lines), WINDOW_LINES)]
+
+    chunks = []
+    for start, end in spans:
+        # Keep oversized leaves as consecutive windows
+        for s in range(start, end + 1, MAX_CHUNK_LINES):
+            e = min(end, s + MAX_CHUNK_LINES - 1)
+            body = "\n".join(lines[s - 1:e])
+            if body.strip():
+                chunks.append((s, e, body))
+    return chunks
+
+
+class Chunk:
+    __slots__ = ("chunk_id", "path", "start", "end", "text", "lang", "length")
+
+    def __init__(self, chunk_id: int, path: str, start: int, end: int, text: str, lang: str, length: int):
+        self.chunk_id = chunk_id
+        self.path = path
+        self.start = start
+        self.end = end
+        self.text = text
+        self.lang = lang
+        self.length = length
+
+
+class RagIndex:
+    """
+    BM25 inverted index over function/class chunks of a workspace.
+
+    The index is pickled next to the other server caches and updated
+    incrementally: refresh() only re-chunks files whose mtime or size changed
+    and drops files that disappeared.
+    """
+    def __init__(self, workspace: str, index_path: Optional[str] = None):
+        self.workspace = os.path.abspath(workspace)
+        if index_path is None:
+            digest = hashlib.sha1(self.workspace.encode("utf-8")).hexdigest()[:16]
+            index_path = os.path.join(os.path.expanduser("~"), ".cache", "ai-autocomplete", f"rag_{digest}.pkl")
+        self.index_path = index_path
+
+        self.files: Dict[str, Tuple[float, int, List[int]]] = {}
+        self.chunks: Dict[int, Chunk] = {}
+        self.postings: Dict[str, Dict[int, int]] = {}
+        self.total_length = 0
+        self.next_id = 0
+        self.generation = 0
+        self.stats = {"searches": 0, "search_ms_total": 0.0, "search_ms_max": 0.0}
+        self._lock = threading.RLock()
+
+    @classmethod
+    def from_env(cls) -> Optional["RagIndex"]:
+        workspace = os.getenv("RAG_WORKSPACE")
+        if not workspace:
+            return None
+        if not os.path.isdir(workspace):
+            logger.error(f"RAG workspace not found at: {workspace}")
+            return None
+        return cls(workspace, os.getenv("RAG_INDEX_PATH") or None)
+
+    def load(self) -> bool:
+        if not os.path.exists(self.index_path):
+            return False
+        try:
+            with open(self.index_path, "rb") as f:
+                data = pickle.load(f)
+            if data.get("version") != INDEX_VERSION or data.get("workspace") != self.workspace:
+                return False
+            with self._lock:
+                self.files = data["files"]
+                self.chunks = {c[0]: Chunk(*c) for c in data["chunks"]}
+                self.postings = data["postings"]
+                self.total_length = data["total_length"]
+                self.next_id = data["next_id"]
+                self.generation += 1
+            logger.info(f"RAG index loaded: {len(self.chunks)} chunks from {len(self.files)} files")
+            return True
+        except Exception as e:
+            logger.warning(f"Could not load RAG index {self.index_path}: {e}")
+            return False
+
+    def save(self):
+        with self._lock:
+            data = {
+                "version": INDEX_VERSION,
+                "workspace": self.workspace,
+                "files": self.files,
+                "chunks": [(c.chunk_id, c.path, c.start, c.end, c.text, c.lang, c.length) for c in self.chunks.values()],
+                "postings": self.postings,
+                "total_length": self.total_length,
+                "next_id": self.next_id,
+            }
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.index_path)
+
+    def refresh(self) -> int:
+        """
+        Brings the index up to date with the workspace.
+        Returns the number of files added, changed or removed.
+        """
+        found = walk_workspace(self.workspace)
+        changed = [p for p, (mtime, size) in found.items()
+                   if p not in self.files or self.files[p][:2] != (mtime, size)]
+        removed = [p for p in self.files if p not in found]
+        if not changed and not removed:
+            return 0
+
+        # Chunk outside the lock; searches keep running on the old postings
+        new_chunks = {}
+        for rel_path in changed:
+            lang = LANG_BY_EXT[os.path.splitext(rel_path)[1].lower()]
+            try:
+                with open(os.path.join(self.workspace, rel_path), "r", encoding="utf-8", errors="ignore") as f:
+                    text = f.read()
+            except OSError:
+                continue
+            new_chunks[rel_path] = (found[rel_path], lang, chunk_source(text, lang))
+
+        with self._lock:
+            for rel_path in removed + changed:
+                self._remove_file(rel_path)
+            for rel_path, (stat, lang, chunks) in new_chunks.items():
+                self._add_file(rel_path, stat, lang, chunks)
+            self.generation += 1
+
+        logger.info(f"RAG index updated: {len(changed)} changed, {len(removed)} removed, {len(self.chunks)} chunks")
+        return len(changed) + len(removed)
+
+    def _remove_file(self, rel_path: str):
+        entry = self.files.pop(rel_path, None)
+        if not entry:
+            return
+        for chunk_id in entry[2]:
+            chunk = self.chunks.pop(chunk_id, None)
+            if not chunk:
+                continue
+            self.total_length -= chunk.length
+            for term in set(terms(chunk.text)):
+                posting = self.postings.get(term)
+                if posting is not None:
+                    posting.pop(chunk_id, None)
+                    if not posting:
+                        del self.postings[term]
+
+    def _add_file(self, rel_path: str, stat: Tuple[float, int], lang: str, chunks: List[Tuple[int, int, str]]):
+        ids = []
+        for start, end, text in chunks:
+            counts = Counter(terms(text))
+            if not counts:
+                continue
+            chunk_id = self.next_id
+            self.next_id += 1
+            length = sum(counts.values())
+            self.chunks[chunk_id] = Chunk(chunk_id, rel_path, start, end, text, lang, length)
+            self.total_length += length
+            for term, tf in counts.items():
+                self.postings.setdefault(term, {})[chunk_id] = tf
+            ids.append(chunk_id)
+        self.files[rel_path] = (stat[0], stat[1], ids)
+
+    def search(self, query: str, k: int = 3, exclude_path: Optional[str] = None) -> List[Chunk]:
+        """
+        Returns the top-k chunks for a query by BM25 score.
+        exclude_path skips chunks of the file being edited.
+        """
+        start = time.perf_counter()
+        # Recent identifiers matter most; cap the query to keep lookups bounded
+        query_terms = list(dict.fromkeys(reversed(terms(query))))[:32]
+        exclude_path = workspace_path(exclude_path, self.workspace)
+
+        with self._lock:
+            n = len(self.chunks)
+            if not n or not query_terms:
+                return []
+            avg_len = self.total_length / n
+            scores: Dict[int, float] = {}
+            for term in query_terms:
+                posting = self.postings.get(term)
+                if not posting:
+                    continue
+                idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+                for chunk_id, tf in posting.items():
+                    length = self.chunks[chunk_id].length
+                    score = idf * tf * (K1 + 1) / (tf + K1 * (1 - B + B * length / avg_len))
+                    scores[chunk_id] = scores.get(chunk_id, 0.0) + score
+
+            ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+            results = []
+            for chunk_id, _ in ranked:
+                chunk = self.chunks[chunk_id]
+                if exclude_path and chunk.path == exclude_path:
+                    continue
+                results.append(chunk)
+                if len(results) >= k:
+                    break
+
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        self.stats["searches"] += 1
+        self.stats["search_ms_total"] += elapsed_ms
+        self.stats["search_ms_max"] = max(self.stats["search_ms_max"], elapsed_ms)
+        return results
+
+    def start_watcher(self, interval: float) -> threading.Event:
+        """
+        Refreshes the index every `interval` seconds in a daemon thread.
+        Set the returned event to stop it.
+        """
+        stop = threading.Event()
+
+        def run():
+            self.load()
+            while True:
+                try:
+                    if self.refresh():
+                        self.save()
+                except Exception as e:
+                    logger.error(f"RAG refresh failed: {e}")
+                if stop.wait(interval):
+                    break
+
+        threading.Thread(target=run, name="rag-watcher", daemon=True).start()
+        return stop
+
+
+def context_snippets(chunks: List[Chunk], lang: str, budget: int, count_tokens: Callable[[str], int]) -> List[str]:
+    """
+    Formats retrieved chunks as commented snippets for the top of the prompt,
+    skipping those that would exceed the token budget.
+    """
+    comment = COMMENT_PREFIX.get(lang, '//')
+    parts = []
+    used = 0
+    for chunk in chunks:
+        snippet = f"{comment} {chunk.path}\n{chunk.text}\n\n"
+        cost = count_tokens(snippet)
+        if used + cost > budget:
+            continue
+        parts.append(snippet)
+        used += cost
+    return parts
+
+
+IMPORT_LINE_RE = re.compile(r"^\s*(?:import|from\s+\S+\s+import|#\s*include)\b")
+SCOPE_RE = re.compile(
+    r"^\s*(?:(?:async\s+)?def|class|struct|interface|function)\s+([A-Za-z_]\w*)"
+    r"|^\s*[\w<>\[\],:*&\s]*?\b([A-Za-z_]\w*)\s*\([^;]*\)\s*(?:const\s*)?(?:throws\s+[\w.,\s]+)?\{?\s*$"
+)
+CURSOR_IDENT_RE = re.compile(r"([A-Za-z_][\w.]*)[^\w]*$")
+# Receiver or callee of the last `.`/`(` on the line while a member or argument is typed after it
+TRIGGER_IDENT_RE = re.compile(r"([A-Za-z_][\w.]*)\s*[.(][^.()]*$")
+SCOPE_SCAN_LINES = 200
+# Unnamed buffers are told apart in the retrieval cache by a hash of their beginning
+DOCUMENT_KEY_CHARS = 1024
+
+
+def should_retrieve(prefix: str, is_block: bool) -> bool:
+    """
+    Smart trigger: retrieval only pays off right after `.`, `(`, on import
+    lines and when a new line is started in block mode.
+    """
+    tail = prefix.rstrip(" \t")
+    if not tail:
+        return False
+    if is_block and tail.endswith("\n"):
+        return True
+    if tail[-1] in ".(":
+        return True
+    last_line = tail[tail.rfind("\n") + 1:]
+    return bool(IMPORT_LINE_RE.match(last_line))
+
+
+def cursor_context(prefix: str) -> Tuple[str, str]:
+    """
+    Enclosing scope name and the identifier chain before the last trigger
+    character, e.g. ("process_file", "scrubber.scrub") for "...scrubber.scrub("
+    and for "...scrubber.scrub(con". The part typed after the trigger is left
+    out, so the cache entry made at the trigger keeps matching while a member
+    name or argument is typed. Without a trigger on the line, the identifier
+    chain under the cursor.
+    """
+    end = len(prefix)
+    last_start = prefix.rfind("\n", 0, end) + 1
+    last_line = prefix[last_start:]
+    match = TRIGGER_IDENT_RE.search(last_line) or CURSOR_IDENT_RE.search(last_line)
+    ident = match.group(1).rstrip(".") if match else ""
+
+    indent = len(last_line) - len(last_line.lstrip())
+    scope = ""
+    pos = last_start - 1
+    for _ in range(SCOPE_SCAN_LINES):
+        if pos <= 0:
+            break
+        start = prefix.rfind("\n", 0, pos) + 1
+        line = prefix[start:pos]
+        pos = start - 1
+        stripped = line.lstrip()
+        if not stripped:
+            continue
+        line_indent = len(line) - len(stripped)
+        if line_indent >= indent and indent > 0:
+            continue
+        m = SCOPE_RE.match(line)
+        if m:
+            scope = m.group(1) or m.group(2)
+            break
+        indent = line_indent
+        if indent == 0:
+            break
+    return scope, ident
+
+
+def document_key(document: str, prefix: str) -> str:
+    """The document part of a retrieval cache key: its path, or a hash of the buffer's beginning."""
+    if document:
+        return document
+    return "sha1:" + hashlib.sha1(prefix[:DOCUMENT_KEY_CHARS].encode("utf-8", errors="replace")).hexdigest()
+
+
+class SmartRetriever:
+    """
+    Runs retrieval only on trigger points and caches results per
+    (document, enclosing scope, identifier under cursor), the scope being
+    found in the whole prefix. Cached results are dropped as soon as the
+    index generation changes, i.e. indexed files changed.
+    """
+    def __init__(self, index: RagIndex, mode: str = "smart", capacity: int = 256):
+        self.index = index
+        self.mode = mode
+        self.capacity = capacity
+        self._cache: "OrderedDict[tuple, Tuple[int, List[Chunk]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "retrieved": 0, "cache_hits": 0, "skipped": 0}
+
+    @classmethod
+    def from_env(cls) -> Optional["SmartRetriever"]:
+        index = RagIndex.from_env()
+        if not index:
+            return None
+        return cls(index, mode=os.getenv("RAG_TRIGGER", "smart").lower(),
+                   capacity=int(os.getenv("RAG_CACHE_SIZE", 256)))
+
+    def retrieve(self, prefix: str, is_block: bool, document: str = "", k: int = 3,
+                 query_chars: int = 512) -> List[Chunk]:
+        self.stats["requests"] += 1
+        query = prefix[-query_chars:]
+        if self.mode == "always":
+            self.stats["retrieved"] += 1
+            return self.index.search(query, k=k, exclude_path=document or None)
+
+        key = (document_key(document, prefix),) + cursor_context(prefix)
+        generation = self.index.generation
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached and cached[0] == generation:
+                self._cache.move_to_end(key)
+                self.stats["cache_hits"] += 1
+                return cached[1]
+
+        if not should_retrieve(prefix, is_block):
+            self.stats["skipped"] += 1
+            return []
+
+        self.stats["retrieved"] += 1
+        chunks = self.index.search(query, k=k, exclude_path=document or None)
+        with self._lock:
+            self._cache[key] = (generation, chunks)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.capacity:
+                self._cache.popitem(last=False)
+        return chunks
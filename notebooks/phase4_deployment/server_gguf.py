@@ -1,19 +1,44 @@
 ﻿import os
 import time
+import asyncio
 import logging
-import multiprocessing
 import json
+import threading
+from collections import OrderedDict
 from contextlib import asynccontextmanager
-from typing import List, Optional, Union
+from typing import AsyncIterator, Callable, List, Optional, Tuple, Union
 
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field, ConfigDict
-from llama_cpp import Llama
+from starlette.concurrency import run_in_threadpool
+from pydantic import BaseModel, Field, ConfigDict, ValidationError
 from dotenv import load_dotenv
 
+try:
+    from llama_cpp import Llama, StoppingCriteriaList
+except ImportError:
+    # Only BACKEND=stub works without llama.cpp
+    Llama = None
+    from backends import StoppingCriteriaList
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 import utils
+import backends
+import onnx_backend
+import coalesce
+import rag
+import symbols
+import deadlines
+import topology
+from memory_profile import MemoryProfile
+from chat_cache import ChatStateCache
+from model_registry import ModelRegistry, LoadedModel
+from documents import Document, DocumentStore
 
 # Load environment variables
 load_dotenv()
@@ -26,8 +51,57 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Inference backend: "llama" (GGUF via llama.cpp), "onnx" (ONNX Runtime) or "stub" (deterministic, no model file)
+BACKEND = os.getenv("BACKEND", "llama").lower()
+
 # Global model state
-model_state = {"llm": None}
+model_state = {"registry": None, "rag": None, "symbols": None, "threads": None, "memory": None}
+
+# Retrieval settings for context injection
+RAG_TOP_K = int(os.getenv("RAG_TOP_K", 3))
+RAG_TOKEN_BUDGET = int(os.getenv("RAG_TOKEN_BUDGET", 128))
+RAG_QUERY_CHARS = 512
+
+# Cross-file signatures for the identifier at the cursor
+SYMBOL_TOP_K = int(os.getenv("SYMBOL_TOP_K", 3))
+SYMBOL_TOKEN_BUDGET = int(os.getenv("SYMBOL_TOKEN_BUDGET", 48))
+
+# Default latency budgets per completion mode, counted from request arrival (0 = none)
+DEADLINE_MS_INLINE = int(os.getenv("DEADLINE_MS_INLINE", 0))
+DEADLINE_MS_BLOCK = int(os.getenv("DEADLINE_MS_BLOCK", 0))
+deadline_stats = {"expired": 0, "truncated": 0, "cancelled": 0}
+
+# Deterministic completion requests currently being generated
+inflight = coalesce.SingleFlight()
+
+# Retrieved context last put in front of each file's prompts, kept while retrieval adds nothing new
+CONTEXT_CACHE_SIZE = 256
+recent_contexts: "OrderedDict[Tuple[str, str], str]" = OrderedDict()
+recent_contexts_lock = threading.Lock()
+
+# Editor buffers opened through the document-delta endpoints
+documents = DocumentStore.from_env()
+
+def load_llama(model_path: str) -> Llama:
+    """
+    Loads a GGUF model with the CPU inference settings of the server.
+    """
+    if Llama is None:
+        raise RuntimeError("llama-cpp-python is not installed (BACKEND=stub runs without it)")
+    plan = model_state["threads"] or topology.ThreadPlan.detect()
+    memory = model_state["memory"] or MemoryProfile.from_env()
+    llm = Llama(
+        model_path=model_path,
+        n_threads=plan.n_threads, # Decode: physical cores of one NUMA node, within the cgroup quota
+        n_threads_batch=plan.n_threads_batch, # Prompt eval
+        n_batch=512,
+        n_gpu_layers=0, # CPU only
+        verbose=False,
+        **memory.llama_kwargs() # n_ctx, KV cache type, mmap without mlock
+    )
+    logger.info(f"Model loaded successfully! Threads: {plan.n_threads} (batch: {plan.n_threads_batch}), "
+                f"n_ctx: {memory.n_ctx}, KV cache: {memory.kv_cache_type}, RSS: {memory.report()['rss_mb']}MB")
+    return llm
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -35,39 +109,90 @@ async def lifespan(app: FastAPI):
     Context manager for the application lifespan.
     Handles model loading and unloading.
     """
+    # Size llama.cpp thread pools to the CPUs actually available to the container
+    plan = topology.ThreadPlan.detect()
+    plan.apply_affinity()
+    model_state["threads"] = plan
+    logger.info(f"CPU topology: {plan.info}")
+
+    memory = MemoryProfile.from_env()
+    model_state["memory"] = memory
+
     model_path = os.getenv("MODEL_PATH")
-    if not model_path:
-        logger.error("MODEL_PATH environment variable not set.")
-        model_state["llm"] = None
-    elif not os.path.exists(model_path):
-        logger.error(f"Model file not found at: {model_path}")
-        model_state["llm"] = None
+    model_dir = os.getenv("MODEL_DIR") or (os.path.dirname(model_path) if model_path else None)
+    extension = ".gguf"
+    exclude_suffixes = ()
+    if BACKEND == "stub":
+        loader = backends.load_stub
+        model_path = model_path or "stub"
+        logger.info("Using the stub backend; completions are synthetic")
+    else:
+        if BACKEND == "onnx":
+            loader = onnx_backend.load_onnx
+            extension = ".onnx"
+            # Cached optimized graphs sit next to the models they belong to
+            exclude_suffixes = (onnx_backend.OPTIMIZED_SUFFIX,)
+        else:
+            loader = load_llama
+        if model_path and not os.path.exists(model_path):
+            logger.error(f"Model file not found at: {model_path}")
+            model_path = None
+
+    registry = ModelRegistry(
+        model_dir,
+        loader,
+        default_path=model_path,
+        ram_budget_mb=int(os.getenv("MODEL_RAM_BUDGET_MB", 2048)),
+        extension=extension,
+        exclude_suffixes=exclude_suffixes
+    )
+    model_state["registry"] = registry
+
+    # In unload mode idle models are released and loaded again on the next request
+    idle_stop = registry.start_idle_reaper(memory.idle_unload_seconds) if memory.idle_unload_seconds > 0 else None
+
+    if registry.default_id is None:
+        logger.error("No model found. Set MODEL_PATH or MODEL_DIR.")
     else:
         try:
-            logger.info(f"Loading model from: {model_path}")
-            n_threads = max(1, multiprocessing.cpu_count() - 2) # Leave some cores for the OS
-            
-            model_state["llm"] = Llama(
-                model_path=model_path,
-                n_ctx=512,
-                n_threads=n_threads,
-                n_batch=512,
-                n_gpu_layers=0, # CPU only
-                verbose=False,
-                use_mmap=True,
-                use_mlock=False
-            )
-            logger.info(f"Model loaded successfully! Threads: {n_threads}")
+            # The default model is loaded eagerly and pinned
+            entry = registry.get()
+            registry.release(entry)
+            if entry.fim:
+                logger.info(f"FIM format: {entry.fim.style}/{entry.fim.order}")
         except Exception as e:
             logger.error(f"Failed to load model: {e}")
-            model_state["llm"] = None
+
+    # Workspace index for context injection; built and kept fresh in the background
+    retriever = rag.SmartRetriever.from_env()
+    rag_stop = None
+    if retriever:
+        rag_stop = retriever.index.start_watcher(float(os.getenv("RAG_REFRESH_SECONDS", 10)))
+        model_state["rag"] = retriever
+        logger.info(f"RAG enabled for workspace: {retriever.index.workspace} (trigger: {retriever.mode})")
+
+    symbol_index = symbols.SymbolIndex.from_env()
+    symbols_stop = None
+    if symbol_index:
+        symbols_stop = symbol_index.start_watcher(float(os.getenv("RAG_REFRESH_SECONDS", 10)))
+        model_state["symbols"] = symbol_index
+        logger.info(f"Symbol index enabled for workspace: {symbol_index.workspace}")
     
     yield
     
     # Cleanup
-    if model_state["llm"]:
-        del model_state["llm"]
-        logger.info("Model unloaded.")
+    if rag_stop:
+        rag_stop.set()
+        model_state["rag"] = None
+    if symbols_stop:
+        symbols_stop.set()
+        model_state["symbols"] = None
+    if idle_stop:
+        idle_stop.set()
+    registry.unload_all()
+    model_state["registry"] = None
+    model_state["threads"] = None
+    model_state["memory"] = None
 
 app = FastAPI(title="Edge AI Code Server", lifespan=lifespan)
 
@@ -90,6 +215,34 @@ class CompletionRequest(BaseModel):
     top_p: Optional[float] = Field(default=0.95, alias="topP")
     stop: Optional[Union[str, List[str]]] = None
     stream: Optional[bool] = False
+    file_path: Optional[str] = None
+    language: Optional[str] = None
+    deadline_ms: Optional[int] = Field(default=None, alias="deadlineMs")
+
+class DocumentOpenRequest(BaseModel):
+    text: str
+    language: Optional[str] = None
+    file_path: Optional[str] = None
+
+class DocumentEdit(BaseModel):
+    offset: int
+    removed: int = 0
+    text: str = ""
+
+class DocumentEditRequest(BaseModel):
+    edits: List[DocumentEdit]
+
+class DocumentCompletionRequest(BaseModel):
+    model_config = ConfigDict(populate_by_name=True, extra='ignore')
+    model: str = "qwen2.5-coder"
+    edits: List[DocumentEdit] = []
+    cursor: int
+    max_tokens: Optional[int] = Field(default=24, alias="maxTokens")
+    temperature: Optional[float] = 0.0
+    top_p: Optional[float] = Field(default=0.95, alias="topP")
+    stop: Optional[Union[str, List[str]]] = None
+    stream: Optional[bool] = False
+    deadline_ms: Optional[int] = Field(default=None, alias="deadlineMs")
 
 class ChatMessage(BaseModel):
     role: str
@@ -123,103 +276,702 @@ def token_heal(llm: Llama, prompt: str) -> tuple[str, str]:
         pass
     return prompt, ""
 
+async def acquire_model(name: Optional[str]) -> LoadedModel:
+    """
+    Resolves the model for a request, loading it lazily off the event loop.
+    The model cannot be evicted or unloaded until it is released.
+    """
+    registry = model_state["registry"]
+    if not registry:
+        raise HTTPException(status_code=503, detail="Model not initialized")
+    try:
+        return await run_in_threadpool(registry.get, name)
+    except KeyError:
+        raise HTTPException(status_code=503, detail="Model not initialized")
+    except MemoryError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except Exception as e:
+        logger.error(f"Failed to load model '{name}': {e}")
+        raise HTTPException(status_code=503, detail="Failed to load model")
+
+@asynccontextmanager
+async def use_model(name: Optional[str]) -> AsyncIterator[LoadedModel]:
+    """acquire_model() for the duration of the block."""
+    entry = await acquire_model(name)
+    try:
+        yield entry
+    finally:
+        model_state["registry"].release(entry)
+
+def rag_status() -> Optional[dict]:
+    retriever = model_state["rag"]
+    if not retriever:
+        return None
+    index = retriever.index
+    stats = {"workspace": index.workspace, "files": len(index.files), "chunks": len(index.chunks),
+             "trigger": retriever.mode, **retriever.stats, **index.stats}
+    if retriever.stats["requests"]:
+        stats["skip_rate"] = retriever.stats["skipped"] / retriever.stats["requests"]
+        stats["cache_hit_rate"] = retriever.stats["cache_hits"] / retriever.stats["requests"]
+    return stats
+
+def symbols_status() -> Optional[dict]:
+    index = model_state["symbols"]
+    if not index:
+        return None
+    return {"workspace": index.workspace, "files": len(index.files), "prefixes": len(index.by_prefix)}
+
 @app.get("/health")
 def health_check():
-    status = "ok" if model_state["llm"] else "error"
-    return {"status": status, "model": os.path.basename(os.getenv("MODEL_PATH", "unknown"))}
+    registry = model_state["registry"]
+    loaded = bool(registry and (registry.default_id in registry.loaded or registry.default_id in registry.idle_unloaded))
+    status = "ok" if loaded else "error"
+    return {
+        "status": status,
+        "model": registry.default_id if registry else "unknown",
+        "backend": BACKEND,
+        "loaded_models": list(registry.loaded) if registry else [],
+        "chat_cache": {model_id: entry.chat_cache.report()
+                       for model_id, entry in list(registry.loaded.items()) if entry.chat_cache} if registry else {},
+        "coalescing": inflight.stats,
+        "deadlines": deadline_stats,
+        "threads": model_state["threads"].info if model_state["threads"] else None,
+        "memory": model_state["memory"].report() if model_state["memory"] else None,
+        "rag": rag_status(),
+        "symbols": symbols_status()
+    }
 
 @app.get("/v1/models")
 def list_models():
+    registry = model_state["registry"]
     return {
         "object": "list", 
-        "data": [{"id": "qwen2.5-coder", "object": "model", "owned_by": "local"}]
+        "data": registry.list_models() if registry else []
     }
 
-@app.post("/v1/completions")
-async def completions(request: CompletionRequest):
-    llm = model_state["llm"]
-    if not llm:
-        raise HTTPException(status_code=503, detail="Model not initialized")
+def is_block_mode(code: str) -> bool:
+    """Block completion when the cursor starts a new line or follows `:`/`{`; inline otherwise."""
+    lines = [l for l in code.split("\n") if not l.strip().startswith("// ")]
+    last_line = lines[-1].strip() if lines else ""
+    return last_line.endswith(":") or last_line.endswith("{") or code.strip().endswith("\n")
+
+def effective_deadline_ms(request: CompletionRequest, is_block: bool) -> Optional[int]:
+    """The request's deadline_ms, or the default of its completion mode."""
+    if request.deadline_ms is not None:
+        return request.deadline_ms
+    return DEADLINE_MS_BLOCK if is_block else DEADLINE_MS_INLINE
+
+def completion_key(model_id: str, request: CompletionRequest) -> Optional[str]:
+    """
+    Key identifying deterministic completion requests; None for sampled ones.
+    Requests only share a generation with the same latency budget, so one
+    without a deadline never gets another's truncated result or 504.
+    """
+    if request.temperature != 0.0:
+        return None
+    return coalesce.request_key(model_id, {
+        "prompt": request.prompt,
+        "suffix": request.suffix,
+        "max_tokens": request.max_tokens,
+        "top_p": request.top_p,
+        "stop": request.stop,
+        # Both change the prompt (retrieved context, excluded symbols) or the stops
+        "file_path": request.file_path,
+        "language": request.language,
+        "deadline_ms": effective_deadline_ms(request, is_block_mode(request.prompt)) or 0,
+    })
+
+def symbol_context(llm, request: CompletionRequest, code: str, lang: str) -> List[str]:
+    """
+    Signatures of workspace definitions matching the identifier at the cursor,
+    as comment lines within the symbol token budget.
+    """
+    index = model_state["symbols"]
+    if not index:
+        return []
+    lines = []
+    used = 0
+    for symbol in index.for_cursor(code, limit=SYMBOL_TOP_K, exclude_path=request.file_path):
+        line = symbols.format_signatures([symbol], lang)
+        cost = len(llm.tokenize(line.encode("utf-8"), add_bos=False))
+        if used + cost > SYMBOL_TOKEN_BUDGET:
+            break
+        lines.append(line)
+        used += cost
+    return lines
+
+def stable_context(key: Tuple[str, str], blocks: List[str]) -> str:
+    """
+    The context goes in front of the prompt, so any change to it makes
+    llama.cpp evaluate the whole prompt again. A file keeps its previous
+    context while new retrievals only return blocks it already contains
+    (or nothing), and gets a new one when they find something new.
+    """
+    with recent_contexts_lock:
+        previous = recent_contexts.get(key)
+        if previous is not None and all(block in previous for block in blocks):
+            recent_contexts.move_to_end(key)
+            return previous
+        context = "".join(blocks)
+        recent_contexts[key] = context
+        recent_contexts.move_to_end(key)
+        while len(recent_contexts) > CONTEXT_CACHE_SIZE:
+            recent_contexts.popitem(last=False)
+        return context
+
+def retrieve_context(llm, model_id: str, request: CompletionRequest, code: str, lang: str, is_block: bool) -> str:
+    """
+    Retrieves workspace snippets relevant to the code before the cursor and
+    formats them to fit the RAG token budget, followed by the signatures of
+    matching symbols. Empty when both are disabled or nothing matches.
+    For requests naming their file the context is kept stable (stable_context).
+    """
+    blocks = []
+    retriever = model_state["rag"]
+    if retriever:
+        chunks = retriever.retrieve(code, is_block, document=request.file_path or "",
+                                    k=RAG_TOP_K, query_chars=RAG_QUERY_CHARS)
+        if chunks:
+            count_tokens = lambda text: len(llm.tokenize(text.encode("utf-8"), add_bos=False))
+            blocks = rag.context_snippets(chunks, lang, RAG_TOKEN_BUDGET, count_tokens)
+    blocks += symbol_context(llm, request, code, lang)
+    if not request.file_path or not (retriever or model_state["symbols"]):
+        return "".join(blocks)
+    return stable_context((model_id, request.file_path), blocks)
+
+def generate(llm, on_delta: Optional[Callable[[str], None]] = None, **kwargs) -> Tuple[str, dict]:
+    """
+    Calls the model, streaming text deltas to on_delta when given.
+    Returns the generated text and the token usage.
+    """
+    if on_delta is None:
+        output = llm(**kwargs)
+        return output["choices"][0]["text"], output["usage"]
+
+    parts = []
+    for chunk in llm(stream=True, **kwargs):
+        text = chunk["choices"][0]["text"]
+        if text:
+            parts.append(text)
+            on_delta(text)
+
+    # Streamed output carries no usage block; chunks are emitted per token
+    prompt = kwargs["prompt"]
+    prompt_tokens = len(prompt) if isinstance(prompt, list) else len(llm.tokenize(prompt.encode("utf-8")))
+    usage = {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": len(parts),
+        "total_tokens": prompt_tokens + len(parts)
+    }
+    return "".join(parts), usage
 
+def run_completion(entry: LoadedModel, request: CompletionRequest, req_id: int,
+                   on_delta: Optional[Callable[[str], None]] = None,
+                   window_tokens: Optional[Callable] = None,
+                   received_at: Optional[float] = None,
+                   cancelled: Optional[threading.Event] = None) -> dict:
+    """
+    Runs one completion on a loaded model and builds the response body.
+    Blocking; called from the thread pool. If on_delta is given, text is
+    passed to it as it is generated; the returned body stays authoritative.
+    window_tokens(formatter, context) may supply pre-tokenized prefix/suffix
+    ids (document sessions) in place of tokenizing request.prompt/suffix.
+
+    The deadline (request.deadline_ms or the mode default) counts from
+    received_at (time.monotonic). Raises deadlines.DeadlineExceeded if it
+    passes while waiting for the model; generation stops once it passes.
+    Likewise once `cancelled` is set (the client went away): raises
+    deadlines.Cancelled while waiting, stops at the next token afterwards.
+
+    Deltas go through the same check as the final text: text that may begin
+    a sensitive match is held back, and once it matches nothing more is
+    streamed and the completion ends with finish_reason "content_filter".
+    """
     start_time = time.time()
+    stream = utils.SensitiveOutputStream(on_delta) if on_delta else None
+    on_delta = stream.write if stream else None
     
     # Pre-process prompt
     code = request.prompt
     # Remove special tokens if present in prompt to avoid confusion, though usually they aren't
     # (Simplified logic compared to original which did manual stripping of FIM tokens)
     
-    lang = utils.detect_language(code)
+    lang = utils.resolve_language(request.language, request.file_path) or utils.detect_language(code)
     
     # Determine mode (Inline vs Block)
-    lines = [l for l in code.split("\n") if not l.strip().startswith("// ")]
-    last_line = lines[-1].strip() if lines else ""
-    is_block = last_line.endswith(":") or last_line.endswith("{") or code.strip().endswith("\n")
+    is_block = is_block_mode(code)
     
     # Dynamic parameter adjustment
     max_tok = min(request.max_tokens or (16 if is_block else 8), 64) # Cap at 64 for safety
     temp = request.temperature if request.temperature is not None else (0.1 if is_block else 0.0)
     
     # Stop tokens
+    formatter = entry.fim
+    use_fim = formatter is not None and not formatter.is_preformatted(code)
     stops = utils.get_stop_for_lang(lang, is_block)
+    if use_fim:
+        stops.extend(formatter.stop_strings())
     if request.stop:
         stops.extend(request.stop if isinstance(request.stop, list) else [request.stop])
 
-    req_id = int(time.time() * 1000) % 10000
+    deadline_ms = effective_deadline_ms(request, is_block)
+    deadline = deadlines.Deadline.after(deadline_ms, received_at)
+
     logger.info(f"[{req_id}] CMPL | {lang} | {'BLOCK' if is_block else 'INLINE'} | Prompt len: {len(code)}")
 
+    if not deadlines.acquire(entry.lock, deadline, cancelled):
+        if cancelled and cancelled.is_set():
+            deadline_stats["cancelled"] += 1
+            logger.info(f"[{req_id}] DROP | client went away in queue")
+            raise deadlines.Cancelled("The client went away while waiting for the model")
+        deadline_stats["expired"] += 1
+        logger.info(f"[{req_id}] DROP | deadline of {deadline_ms}ms passed in queue")
+        raise deadlines.DeadlineExceeded(f"Deadline of {deadline_ms}ms passed while waiting for the model")
     try:
-        healed_prompt, prefix_loss = token_heal(llm, request.prompt)
+        llm = entry.llm
+        if use_fim and window_tokens:
+            healed_prompt, prefix_loss = request.prompt, ""
+        else:
+            healed_prompt, prefix_loss = token_heal(llm, request.prompt)
+        if prefix_loss and on_delta:
+            on_delta(prefix_loss)
+
+        context = retrieve_context(llm, entry.model_id, request, code, lang, is_block)
         
-        output = llm(
-            prompt=healed_prompt,
-            suffix=request.suffix,
+        if use_fim:
+            # Assemble the FIM prompt as token ids in the same layout the model was trained on
+            budget = llm.n_ctx() - max_tok
+            if window_tokens:
+                prompt = formatter.build_from_tokens(*window_tokens(formatter, context), budget=budget)
+            else:
+                prompt = formatter.build(context + healed_prompt, request.suffix or "", budget=budget)
+            suffix = None
+        else:
+            prompt = context + healed_prompt
+            suffix = request.suffix
+
+        criteria = [deadline.stopping_criteria()] if deadline else []
+        if cancelled:
+            criteria.append(lambda input_ids, logits: cancelled.is_set())
+
+        emit = on_delta
+        if on_delta and use_fim:
+            first = [True]
+            def emit(text):
+                if first[0]:
+                    text = formatter.clean_output(text)
+                    first[0] = False
+                if text:
+                    on_delta(text)
+
+        completion_text, usage = generate(
+            llm,
+            on_delta=emit,
+            prompt=prompt,
+            suffix=suffix,
             max_tokens=max_tok,
             stop=stops,
             temperature=temp,
             top_p=request.top_p,
-            echo=False
+            echo=False,
+            stopping_criteria=StoppingCriteriaList(criteria) if criteria else None
         )
-        
-        generated_text = prefix_loss + output["choices"][0]["text"]
-        generated_text = utils.filter_sensitive_output(generated_text)
-        
-        usage = output["usage"]
-        latency_ms = (time.time() - start_time) * 1000
-        
-        logger.info(f"[{req_id}] DONE | {usage['completion_tokens']} toks | {latency_ms:.0f}ms")
+        if use_fim:
+            completion_text = formatter.clean_output(completion_text)
+    finally:
+        entry.lock.release()
 
-        response = {
-            "id": f"cmpl-{req_id}",
-            "object": "text_completion",
-            "created": int(time.time()),
-            "model": request.model,
-            "choices": [{
-                "text": generated_text, 
-                "index": 0, 
-                "logprobs": None, 
-                "finish_reason": "stop"
-            }],
-            "usage": usage
-        }
+    finish_reason = "stop"
+    if cancelled and cancelled.is_set():
+        deadline_stats["cancelled"] += 1
+        logger.info(f"[{req_id}] STOP | client went away")
+    elif deadline and deadline.hit:
+        # Cut short: return what was generated in time
+        deadline_stats["truncated"] += 1
+        finish_reason = "length"
+    
+    generated_text = prefix_loss + completion_text
+    filtered_text = utils.filter_sensitive_output(generated_text)
+    if generated_text and not filtered_text:
+        finish_reason = "content_filter"
+    elif stream:
+        stream.close()
+    generated_text = filtered_text
+    
+    latency_ms = (time.time() - start_time) * 1000
+    
+    logger.info(f"[{req_id}] DONE | {usage['completion_tokens']} toks | {latency_ms:.0f}ms")
 
-        if request.stream:
-            def stream_generator():
-                yield f"data: {json.dumps(response)}\n\n"
-                yield "data: [DONE]\n\n"
-            return StreamingResponse(stream_generator(), media_type="text/event-stream")
-            
-        return response
+    return {
+        "id": f"cmpl-{req_id}",
+        "object": "text_completion",
+        "created": int(time.time()),
+        "model": entry.model_id,
+        "choices": [{
+            "text": generated_text, 
+            "index": 0, 
+            "logprobs": None, 
+            "finish_reason": finish_reason
+        }],
+        "usage": usage
+    }
+
+async def complete(request: CompletionRequest) -> dict:
+    """
+    Shared completion path of the JSON, msgpack and WebSocket endpoints.
+    """
+    received_at = time.monotonic()
+    req_id = int(time.time() * 1000) % 10000
+
+    async with use_model(request.model) as entry:
+        try:
+            # Identical deterministic requests in flight share one generation
+            key = completion_key(entry.model_id, request)
+            if key and inflight.in_flight(key):
+                logger.info(f"[{req_id}] COALESCED onto in-flight request")
+            return await inflight.run(key, lambda: run_in_threadpool(
+                run_completion, entry, request, req_id, None, None, received_at
+            ))
+        except deadlines.DeadlineExceeded as e:
+            raise HTTPException(status_code=504, detail=str(e))
+        except Exception as e:
+            logger.error(f"[{req_id}] ERROR: {e}")
+            raise HTTPException(status_code=500, detail=str(e))
+
+def completion_request_from_dict(data) -> CompletionRequest:
+    """
+    Builds a CompletionRequest from a decoded msgpack body, validated like a
+    JSON one. Raises ValueError naming the invalid fields.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("expected a map of request fields")
+    try:
+        return CompletionRequest.model_validate(data)
+    except ValidationError as e:
+        raise ValueError("; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors()))
+
+async def completion_events(entry: LoadedModel, request: CompletionRequest, req_id: int,
+                            received_at: float, window_tokens: Optional[Callable] = None) -> AsyncIterator[dict]:
+    """
+    Runs a streamed completion on a model taken with acquire_model, yielding
+    {"delta": text} as tokens are generated and finally {"completion": body}.
+    If the consumer stops early, generation stops at the next token (or leaves
+    the queue for the model); the model is released once it has.
+    """
+    loop = asyncio.get_running_loop()
+    deltas: asyncio.Queue = asyncio.Queue()
+    cancelled = threading.Event()
+
+    def on_delta(text: str):
+        loop.call_soon_threadsafe(deltas.put_nowait, text)
+
+    def finished(done: asyncio.Future):
+        model_state["registry"].release(entry)
+        deltas.put_nowait(None)
+        # Nobody may be left to read the result
+        if not done.cancelled():
+            done.exception()
+
+    task = asyncio.ensure_future(run_in_threadpool(
+        run_completion, entry, request, req_id, on_delta, window_tokens, received_at, cancelled
+    ))
+    task.add_done_callback(finished)
+    try:
+        while (text := await deltas.get()) is not None:
+            yield {"delta": text}
+        yield {"completion": task.result()}
+    finally:
+        if not task.done():
+            cancelled.set()
+
+def stream_completion(entry: LoadedModel, request: CompletionRequest, req_id: int, received_at: float,
+                      window_tokens: Optional[Callable] = None, key: Optional[str] = None,
+                      disconnected: Optional[Callable] = None) -> AsyncIterator[dict]:
+    """
+    completion_events() shared between identical streamed requests: with a
+    completion_key, a request arriving while the same stream is in flight
+    gets its deltas from the start instead of generating again, and releases
+    its own model right away.
+
+    A request stops listening when `disconnected()` (awaited, polled while
+    waiting for tokens) turns true or its consumer stops; once no request
+    listens any more, generation is stopped.
+    """
+    if key and inflight.streaming(key):
+        logger.info(f"[{req_id}] COALESCED onto in-flight stream")
+        model_state["registry"].release(entry)
+    return inflight.stream(key, lambda: completion_events(entry, request, req_id, received_at, window_tokens),
+                           disconnected)
+
+def completion_stream(events: AsyncIterator[dict], req_id: int, extra: Optional[dict] = None) -> StreamingResponse:
+    """
+    Server-sent events in the OpenAI completions format: one chunk per text
+    delta, then a chunk with the finish reason (and `extra` fields) and [DONE].
+    """
+    async def stream_generator():
+        created = int(time.time())
+        try:
+            async for event in events:
+                if "delta" in event:
+                    chunk = {"id": f"cmpl-{req_id}", "object": "text_completion", "created": created,
+                             "choices": [{"text": event["delta"], "index": 0, "logprobs": None, "finish_reason": None}]}
+                else:
+                    response = event["completion"]
+                    chunk = {**response, **(extra or {}), "id": f"cmpl-{req_id}", "choices": [{
+                        "text": "", "index": 0, "logprobs": None,
+                        "finish_reason": response["choices"][0]["finish_reason"]}]}
+                yield f"data: {json.dumps(chunk)}\n\n"
+        except deadlines.DeadlineExceeded as e:
+            yield f"data: {json.dumps({'error': {'code': 504, 'message': str(e)}})}\n\n"
+        except Exception as e:
+            logger.error(f"[{req_id}] ERROR: {e}")
+            yield f"data: {json.dumps({'error': {'code': 500, 'message': str(e)}})}\n\n"
+        yield "data: [DONE]\n\n"
+    return StreamingResponse(stream_generator(), media_type="text/event-stream")
+
+@app.post("/v1/completions")
+async def completions(request: CompletionRequest, http_request: Request):
+    if request.stream:
+        received_at = time.monotonic()
+        req_id = int(time.time() * 1000) % 10000
+        entry = await acquire_model(request.model)
+        events = stream_completion(entry, request, req_id, received_at, key=completion_key(entry.model_id, request),
+                                   disconnected=http_request.is_disconnected)
+        return completion_stream(events, req_id)
+
+    return await complete(request)
+
+def get_document(doc_id: str) -> Document:
+    try:
+        return documents.get(doc_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Unknown document. Open it again with POST /v1/documents")
+
+def apply_document_edits(doc: Document, edits: List[DocumentEdit]):
+    try:
+        doc.apply_edits([edit.model_dump() for edit in edits])
+    except ValueError as e:
+        # The client's copy has diverged; it must reopen the document
+        documents.close(doc.doc_id)
+        raise HTTPException(status_code=409, detail=str(e))
+
+@app.post("/v1/documents")
+def open_document(request: DocumentOpenRequest):
+    doc = documents.open(request.text, request.language, request.file_path)
+    return {"document_id": doc.doc_id, "version": doc.version}
+
+@app.post("/v1/documents/{doc_id}/edits")
+def edit_document(doc_id: str, request: DocumentEditRequest):
+    doc = get_document(doc_id)
+    with doc.lock:
+        apply_document_edits(doc, request.edits)
+        return {"document_id": doc.doc_id, "version": doc.version}
+
+@app.delete("/v1/documents/{doc_id}")
+def close_document(doc_id: str):
+    if not documents.close(doc_id):
+        raise HTTPException(status_code=404, detail="Unknown document")
+    return {"document_id": doc_id, "closed": True}
+
+@app.post("/v1/documents/{doc_id}/completions")
+async def document_completions(doc_id: str, request: DocumentCompletionRequest, http_request: Request):
+    """
+    Applies pending edits, then completes at the cursor using the server's copy
+    of the document, so the client never resends the full prompt.
+    """
+    received_at = time.monotonic()
+    doc = get_document(doc_id)
+    req_id = int(time.time() * 1000) % 10000
+
+    def snapshot():
+        # doc.lock is also held by tokenization in the thread pool; never wait for it on the event loop
+        with doc.lock:
+            apply_document_edits(doc, request.edits)
+            try:
+                prefix, suffix = doc.window(request.cursor)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            return prefix, suffix, doc.version
 
+    prefix, suffix, version = await run_in_threadpool(snapshot)
+
+    def window_tokens(formatter, context):
+        with doc.lock:
+            if doc.version == version:
+                return doc.encode_window(request.cursor, formatter, context)
+        # Edited meanwhile: tokenize the snapshot taken above
+        return formatter.encode_prefix(context + prefix), formatter.encode_suffix(suffix)
+
+    completion_request = CompletionRequest.model_construct(
+        model=request.model,
+        prompt=prefix,
+        suffix=suffix,
+        max_tokens=request.max_tokens,
+        temperature=request.temperature,
+        top_p=request.top_p,
+        stop=request.stop,
+        stream=request.stream,
+        file_path=doc.path,
+        language=doc.language,
+        deadline_ms=request.deadline_ms
+    )
+    if request.stream:
+        entry = await acquire_model(request.model)
+        events = stream_completion(entry, completion_request, req_id, received_at, window_tokens,
+                                   disconnected=http_request.is_disconnected)
+        return completion_stream(events, req_id, {"document_version": version})
+
+    async with use_model(request.model) as entry:
+        try:
+            response = await run_in_threadpool(
+                run_completion, entry, completion_request, req_id, None, window_tokens, received_at
+            )
+        except deadlines.DeadlineExceeded as e:
+            raise HTTPException(status_code=504, detail=str(e))
+        except Exception as e:
+            logger.error(f"[{req_id}] ERROR: {e}")
+            raise HTTPException(status_code=500, detail=str(e))
+    response["document_version"] = version
+    return response
+
+def run_chat(entry: LoadedModel, request: ChatRequest, prompt_parts: List[str], stops: List[str]):
+    """
+    Generates a chat reply, restoring the cached state of the longest
+    already evaluated ChatML prefix first.
+    Returns the llama.cpp output and the number of prompt tokens reused.
+    """
+    full_prompt = "".join(prompt_parts)
+
+    with entry.lock:
+        llm = entry.llm
+        cache = entry.chat_cache
+        reused = 0
+        prompt = full_prompt
+        if cache and ChatStateCache.supported(llm):
+            prompt = llm.tokenize(full_prompt.encode("utf-8"), add_bos=False, special=True)
+            reused = cache.restore(llm, prompt)
+            if request.messages and request.messages[0].role == "system":
+                system_tokens = llm.tokenize(prompt_parts[0].encode("utf-8"), add_bos=False, special=True)
+                cache.warm_system(llm, system_tokens, reused)
+
+        output = llm(
+            prompt=prompt,
+            max_tokens=request.max_tokens or 512,
+            stop=stops,
+            temperature=request.temperature or 0.7,
+            top_p=request.top_p,
+            echo=False
+        )
+
+        if cache and ChatStateCache.supported(llm):
+            cache.save(llm)
+    return output, reused
+
+@app.post("/v1/completions/msgpack")
+async def completions_msgpack(http_request: Request):
+    """
+    Completion endpoint with msgpack request and response bodies.
+    Same fields as /v1/completions; streaming is served by the WebSocket channel.
+    """
+    if msgpack is None:
+        raise HTTPException(status_code=501, detail="msgpack is not installed")
+    try:
+        request = completion_request_from_dict(msgpack.unpackb(await http_request.body(), raw=False))
     except Exception as e:
-        logger.error(f"[{req_id}] ERROR: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        raise HTTPException(status_code=400, detail=f"Invalid msgpack body: {e}")
+    response = await complete(request)
+    return Response(content=msgpack.packb(response), media_type="application/x-msgpack")
+
+@app.websocket("/v1/completions/ws")
+async def completions_ws(websocket: WebSocket):
+    """
+    Persistent completion channel using binary msgpack frames.
+
+    Each request frame carries the /v1/completions fields plus an "id" echoed in
+    the replies. Instead of "prompt" a frame may send "prompt_delta": [keep, text],
+    meaning the previous prompt of this connection cut to `keep` characters with
+    `text` appended. With "stream" set, {"id", "delta"} frames are sent as tokens
+    are generated. Every request ends with an {"id", "done": true, "completion"}
+    frame, whose completion body is authoritative over the deltas, or with an
+    {"id", "error", "code"} frame, code being the HTTP status of the error
+    (400 for a frame that is not a valid request). The connection stays open.
+    Frames are read while a request runs, so closing the socket stops its generation.
+    """
+    await websocket.accept()
+    if msgpack is None:
+        await websocket.close(code=1011, reason="msgpack is not installed")
+        return
+
+    last_prompt = ""
+    messages: asyncio.Queue = asyncio.Queue()
+    closed = asyncio.Event()
+
+    async def read():
+        try:
+            while (message := await websocket.receive())["type"] != "websocket.disconnect":
+                messages.put_nowait(message)
+        finally:
+            closed.set()
+            messages.put_nowait(None)
+
+    async def disconnected() -> bool:
+        return closed.is_set()
+
+    async def send(frame: dict):
+        await websocket.send_bytes(msgpack.packb(frame))
+
+    reader = asyncio.ensure_future(read())
+    try:
+        while (message := await messages.get()) is not None:
+            frame_id = None
+            try:
+                if message.get("bytes") is None:
+                    raise ValueError("expected a binary msgpack frame")
+                frame = msgpack.unpackb(message["bytes"], raw=False)
+                if not isinstance(frame, dict):
+                    raise ValueError("expected a map of request fields")
+                frame_id = frame.pop("id", None)
+                if "prompt_delta" in frame:
+                    keep, text = frame.pop("prompt_delta")
+                    frame["prompt"] = last_prompt[:keep] + text
+                request = completion_request_from_dict(frame)
+            except Exception as e:
+                await send({"id": frame_id, "error": f"Invalid frame: {e}", "code": 400})
+                continue
+            last_prompt = request.prompt
+            received_at = time.monotonic()
+
+            try:
+                if not request.stream:
+                    response = await complete(request)
+                else:
+                    req_id = int(time.time() * 1000) % 10000
+                    entry = await acquire_model(request.model)
+                    key = completion_key(entry.model_id, request)
+                    events = stream_completion(entry, request, req_id, received_at, key=key, disconnected=disconnected)
+                    async for event in events:
+                        if "delta" in event:
+                            await send({"id": frame_id, "delta": event["delta"]})
+                        else:
+                            response = event["completion"]
+                    if closed.is_set():
+                        break
+
+                await send({"id": frame_id, "done": True, "completion": response})
+            except HTTPException as e:
+                await send({"id": frame_id, "error": e.detail, "code": e.status_code})
+            except deadlines.DeadlineExceeded as e:
+                await send({"id": frame_id, "error": str(e), "code": 504})
+            except Exception as e:
+                logger.error(f"WS ERROR: {e}")
+                await send({"id": frame_id, "error": str(e), "code": 500})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        reader.cancel()
 
 @app.post("/v1/chat/completions")
 async def chat_completions(request: ChatRequest):
-    llm = model_state["llm"]
-    if not llm:
-        raise HTTPException(status_code=503, detail="Model not initialized")
-        
     start_time = time.time()
     
     # Format prompt for ChatML
@@ -230,21 +982,14 @@ async def chat_completions(request: ChatRequest):
         prompt_parts.append(f"<|im_start|>{role}\n{content}<|im_end|>\n")
     
     prompt_parts.append("<|im_start|>assistant\n")
-    full_prompt = "".join(prompt_parts)
     
     stops = ["<|im_end|>", "<|im_start|>"]
     if request.stop:
         stops.extend(request.stop if isinstance(request.stop, list) else [request.stop])
         
     try:
-        output = llm(
-            prompt=full_prompt,
-            max_tokens=request.max_tokens or 512,
-            stop=stops,
-            temperature=request.temperature or 0.7,
-            top_p=request.top_p,
-            echo=False
-        )
+        async with use_model(request.model) as entry:
+            output, reused = await run_in_threadpool(run_chat, entry, request, prompt_parts, stops)
         
         generated_text = output["choices"][0]["text"].strip()
         generated_text = utils.filter_sensitive_output(generated_text)
@@ -252,13 +997,13 @@ async def chat_completions(request: ChatRequest):
         usage = output["usage"]
         latency_ms = (time.time() - start_time) * 1000
         
-        logger.info(f"CHAT | {usage['completion_tokens']} toks | {latency_ms:.0f}ms")
+        logger.info(f"CHAT | {usage['completion_tokens']} toks | reused {reused}/{usage['prompt_tokens']} prompt toks | {latency_ms:.0f}ms")
 
         response = {
             "id": f"chatcmpl-{int(time.time())}",
             "object": "chat.completion",
             "created": int(time.time()),
-            "model": request.model,
+            "model": entry.model_id,
             "choices": [{
                 "index": 0, 
                 "message": {"role": "assistant", "content": generated_text}, 
@@ -273,7 +1018,7 @@ async def chat_completions(request: ChatRequest):
                     "id": response["id"], 
                     "object": "chat.completion.chunk", 
                     "created": response["created"], 
-                    "model": request.model, 
+                    "model": entry.model_id, 
                     "choices": [{
                         "index": 0, 
                         "delta": {"content": generated_text}, 
@@ -289,6 +1034,8 @@ async def chat_completions(request: ChatRequest):
             
         return response
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"CHAT ERROR: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -297,4 +1044,12 @@ if __name__ == "__main__":
     import uvicorn
     host = os.getenv("HOST", "127.0.0.1")
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run("server_gguf:app", host=host, port=port, reload=True)
+    if os.getenv("HTTP2", "0") == "1":
+        # HTTP/2 (h2c) needs an ASGI server that speaks it; uvicorn is HTTP/1.1 only
+        from hypercorn.asyncio import serve
+        from hypercorn.config import Config
+        config = Config()
+        config.bind = [f"{host}:{port}"]
+        asyncio.run(serve(app, config))
+    else:
+        uvicorn.run("server_gguf:app", host=host, port=port, reload=True)
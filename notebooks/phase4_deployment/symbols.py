@@ -0,0 +1,262 @@
+import io
+import os
+import re
+import logging
+import threading
+import tokenize
+from typing import Dict, List, Optional, Tuple
+
+from rag import LANG_BY_EXT, walk_workspace, workspace_path
+
+logger = logging.getLogger(__name__)
+
+MIN_PREFIX = 2
+MAX_PREFIX = 8
+MAX_SIGNATURE_LINES = 5
+
+# Same comment-stripping regex as CodeTransformer.remove_comments_cpp_java (03_transform.py)
+CPP_JAVA_COMMENT_RE = re.compile(
+    r'//.*?$|/\*.*?\*/|\'(?:\\.|[^\\\'])*\'|"(?:\\.|[^\\"])*"',
+    re.DOTALL | re.MULTILINE
+)
+PY_IMPORT_RE = re.compile(r"^\s*import\s+([\w., ]+)|^\s*from\s+([\w.]+)\s+import\s+\(?([\w., ]+)", re.MULTILINE)
+PY_DEF_RE = re.compile(r"^\s*(?:async\s+)?(def|class)\s+([A-Za-z_]\w*)", re.MULTILINE)
+TYPE_RE = re.compile(r"\b(class|struct|interface|enum)\s+([A-Za-z_]\w*)")
+FUNC_RE = re.compile(
+    r"^[ \t]*(?:[\w<>\[\],:*&.]+[ \t]+)+[*&]*(?:\w+::)*~?([A-Za-z_]\w*)[ \t]*\(([^;{}()]*(?:\([^()]*\)[^;{}()]*)*)\)[^;{}]*\{",
+    re.MULTILINE
+)
+JS_FUNC_RE = re.compile(
+    r"\bfunction\s*\*?\s*([A-Za-z_$][\w$]*)\s*\(([^)]*)\)"
+    r"|\b(?:const|let|var)\s+([A-Za-z_$][\w$]*)\s*=\s*(?:async\s*)?(?:function\b[^(]*)?\(([^)]*)\)\s*(?:=>|\{)"
+)
+JS_METHOD_RE = re.compile(r"^[ \t]*(?:static\s+|async\s+|get\s+|set\s+)*([A-Za-z_$][\w$]*)\s*\(([^)]*)\)\s*\{", re.MULTILINE)
+CPP_IMPORT_RE = re.compile(r'^\s*#\s*include\s*[<"]([^>"]+)[>"]', re.MULTILINE)
+JAVA_IMPORT_RE = re.compile(r"^\s*import\s+(?:static\s+)?([\w.*]+)\s*;", re.MULTILINE)
+JS_IMPORT_RE = re.compile(r"^\s*import\s+(.+?)\s+from\s+['\"]([^'\"]+)['\"]", re.MULTILINE)
+NOT_FUNCTIONS = {'if', 'for', 'while', 'switch', 'catch', 'return', 'sizeof', 'else', 'do', 'new', 'delete', 'function'}
+CURSOR_NAME_RE = re.compile(r"([A-Za-z_]\w*)(\(?)$")
+
+
+class Symbol:
+    __slots__ = ("name", "kind", "signature", "path", "line")
+
+    def __init__(self, name: str, kind: str, signature: str, path: str = "", line: int = 0):
+        self.name = name
+        self.kind = kind
+        self.signature = signature
+        self.path = path
+        self.line = line
+
+
+def _line_of(text: str, pos: int) -> int:
+    return text.count("\n", 0, pos) + 1
+
+
+def _python_symbols(text: str) -> List[Symbol]:
+    lines = text.splitlines()
+    symbols = []
+
+    def signature(line_no: int) -> str:
+        parts = []
+        for line in lines[line_no - 1:line_no - 1 + MAX_SIGNATURE_LINES]:
+            parts.append(line.strip())
+            if line.rstrip().endswith(":"):
+                break
+        return " ".join(parts).rstrip(":")
+
+    try:
+        prev = None
+        for tok in tokenize.generate_tokens(io.StringIO(text).readline):
+            if prev is not None and prev.type == tokenize.NAME and prev.string in ("def", "class") \
+                    and tok.type == tokenize.NAME:
+                symbols.append(Symbol(tok.string, prev.string, signature(prev.start[0]), line=prev.start[0]))
+            if tok.type not in (tokenize.NL, tokenize.NEWLINE, tokenize.INDENT, tokenize.DEDENT, tokenize.COMMENT):
+                prev = tok
+    except (tokenize.TokenError, IndentationError, SyntaxError):
+        symbols = [Symbol(m.group(2), m.group(1), signature(_line_of(text, m.start(2))), line=_line_of(text, m.start(2)))
+                   for m in PY_DEF_RE.finditer(text)]
+
+    for m in PY_IMPORT_RE.finditer(text):
+        stmt = m.group(0).strip()
+        names = m.group(1) or m.group(3) or ""
+        for name in names.split(","):
+            name = name.strip().split(" as ")[-1].strip()
+            if name:
+                symbols.append(Symbol(name.split(".")[-1], "import", stmt, line=_line_of(text, m.start())))
+    return symbols
+
+
+def _brace_symbols(text: str, lang: str) -> List[Symbol]:
+    code = CPP_JAVA_COMMENT_RE.sub(lambda m: m.group(0) if m.group(0)[0] in "'\"" else " ", text)
+    lines = code.splitlines()
+    symbols = []
+    for m in TYPE_RE.finditer(code):
+        line_no = _line_of(code, m.start())
+        symbols.append(Symbol(m.group(2), m.group(1), lines[line_no - 1].strip().rstrip("{").strip(), line=line_no))
+
+    patterns = (JS_FUNC_RE, JS_METHOD_RE) if lang == "javascript" else (FUNC_RE,)
+    for pattern in patterns:
+        for m in pattern.finditer(code):
+            name = next(g for g in m.groups()[::2] if g) if pattern is JS_FUNC_RE else m.group(1)
+            if name in NOT_FUNCTIONS:
+                continue
+            sig = " ".join(m.group(0).split()).rstrip("{").strip()
+            symbols.append(Symbol(name, "function", sig, line=_line_of(code, m.start())))
+
+    import_re = {"cpp": CPP_IMPORT_RE, "java": JAVA_IMPORT_RE, "javascript": JS_IMPORT_RE}[lang]
+    for m in import_re.finditer(code):
+        target = m.group(1)
+        if lang == "javascript":
+            name = target.strip("{} ").split(",")[0].strip()
+        elif lang == "cpp":
+            name = os.path.splitext(os.path.basename(target))[0]
+        else:
+            name = target.split(".")[-1]
+        symbols.append(Symbol(name, "import", m.group(0).strip(), line=_line_of(code, m.start())))
+    return symbols
+
+
+def extract_symbols(text: str, lang: str) -> List[Symbol]:
+    """
+    Definitions, signatures and imports of a source file, using tokenize for
+    Python and regexes (like the phase-1 transformers) for Java/C++/JS.
+    """
+    if lang == "python":
+        return _python_symbols(text)
+    if lang in ("java", "cpp", "javascript"):
+        return _brace_symbols(text, lang)
+    return []
+
+
+class SymbolIndex:
+    """
+    Workspace symbol table with O(1) lookup by identifier prefix.
+
+    Every symbol is registered under its lower-cased name prefixes of
+    MIN_PREFIX..MAX_PREFIX characters; longer queries look up the MAX_PREFIX
+    bucket and filter it. Files are re-parsed only when their mtime or size changes.
+    """
+    def __init__(self, workspace: str):
+        self.workspace = os.path.abspath(workspace)
+        self.files: Dict[str, Tuple[float, int, List[Symbol]]] = {}
+        self.by_prefix: Dict[str, List[Symbol]] = {}
+        self._lock = threading.RLock()
+
+    @classmethod
+    def from_env(cls) -> Optional["SymbolIndex"]:
+        workspace = os.getenv("SYMBOLS_WORKSPACE") or os.getenv("RAG_WORKSPACE")
+        if not workspace or os.getenv("SYMBOLS_ENABLED", "1") == "0":
+            return None
+        if not os.path.isdir(workspace):
+            logger.error(f"Symbol workspace not found at: {workspace}")
+            return None
+        return cls(workspace)
+
+    @staticmethod
+    def _keys(name: str) -> List[str]:
+        low = name.lower()
+        return [low[:n] for n in range(MIN_PREFIX, min(len(low), MAX_PREFIX) + 1)]
+
+    def refresh(self) -> int:
+        """Re-parses changed files and drops deleted ones. Returns the number of files updated."""
+        found = walk_workspace(self.workspace)
+        changed = [p for p, stat in found.items() if p not in self.files or self.files[p][:2] != stat]
+        removed = [p for p in self.files if p not in found]
+        if not changed and not removed:
+            return 0
+
+        parsed = {}
+        for rel_path in changed:
+            lang = LANG_BY_EXT[os.path.splitext(rel_path)[1].lower()]
+            try:
+                with open(os.path.join(self.workspace, rel_path), "r", encoding="utf-8", errors="ignore") as f:
+                    symbols = extract_symbols(f.read(), lang)
+            except OSError:
+                continue
+            for symbol in symbols:
+                symbol.path = rel_path
+            parsed[rel_path] = (found[rel_path], symbols)
+
+        with self._lock:
+            for rel_path in removed + changed:
+                self._remove_file(rel_path)
+            for rel_path, (stat, symbols) in parsed.items():
+                self.files[rel_path] = (stat[0], stat[1], symbols)
+                for symbol in symbols:
+                    for key in self._keys(symbol.name):
+                        self.by_prefix.setdefault(key, []).append(symbol)
+
+        logger.info(f"Symbol index updated: {len(changed)} changed, {len(removed)} removed")
+        return len(changed) + len(removed)
+
+    def _remove_file(self, rel_path: str):
+        entry = self.files.pop(rel_path, None)
+        if not entry:
+            return
+        for symbol in entry[2]:
+            for key in self._keys(symbol.name):
+                bucket = self.by_prefix.get(key)
+                if bucket is None:
+                    continue
+                bucket[:] = [s for s in bucket if s.path != rel_path]
+                if not bucket:
+                    del self.by_prefix[key]
+
+    def lookup(self, prefix: str, exact: bool = False, limit: int = 4,
+               exclude_path: Optional[str] = None) -> List[Symbol]:
+        """
+        Symbols whose name starts with `prefix` (or equals it when exact),
+        definitions before imports, shortest names first. exclude_path (the
+        file being edited, absolute or workspace-relative) is skipped.
+        """
+        if len(prefix) < MIN_PREFIX:
+            return []
+        exclude_path = workspace_path(exclude_path, self.workspace)
+        with self._lock:
+            bucket = self.by_prefix.get(prefix[:MAX_PREFIX].lower(), [])
+            matches = [s for s in bucket
+                       if (s.name == prefix if exact else s.name.startswith(prefix)) and s.path != exclude_path]
+        matches.sort(key=lambda s: (s.kind == "import", len(s.name), s.path))
+        seen = set()
+        result = []
+        for symbol in matches:
+            if symbol.signature in seen:
+                continue
+            seen.add(symbol.signature)
+            result.append(symbol)
+            if len(result) >= limit:
+                break
+        return result
+
+    def for_cursor(self, prefix: str, limit: int = 4, exclude_path: Optional[str] = None) -> List[Symbol]:
+        """
+        Symbols relevant to the identifier being typed: prefix matches for a
+        partial name, or the exact definition right after `name(`.
+        """
+        m = CURSOR_NAME_RE.search(prefix[-128:])
+        if not m:
+            return []
+        return self.lookup(m.group(1), exact=bool(m.group(2)), limit=limit, exclude_path=exclude_path)
+
+    def start_watcher(self, interval: float) -> threading.Event:
+        """Refreshes the index every `interval` seconds in a daemon thread."""
+        stop = threading.Event()
+
+        def run():
+            while True:
+                try:
+                    self.refresh()
+                except Exception as e:
+                    logger.error(f"Symbol refresh failed: {e}")
+                if stop.wait(interval):
+                    break
+
+        threading.Thread(target=run, name="symbol-watcher", daemon=True).start()
+        return stop
+
+
+def format_signatures(symbols: List[Symbol], lang: str) -> str:
+    """Renders symbols as comment lines to put in front of the prompt."""
+    comment = "#" if lang == "python" else "//"
+    return "".join(f"{comment} {s.path}: {s.signature}\n" for s in symbols)
@@ -0,0 +1,61 @@
+"""
+Checks that the chat-cache byte budget (CHAT_CACHE_MB) holds for ONNX
+snapshots. Runs without onnxruntime or a model: the OnnxLlama KV buffers
+are set up by hand.
+
+    python test_chat_cache.py   (or pytest test_chat_cache.py)
+"""
+import sys
+
+import numpy as np
+
+from chat_cache import ChatStateCache, state_bytes
+from onnx_backend import OnnxLlama
+
+N_LAYERS, KV_HEADS, HEAD_DIM, N_CTX = 4, 2, 64, 512
+
+
+def make_onnx_llama():
+    llm = object.__new__(OnnxLlama)
+    llm.n_layers, llm.n_kv_heads, llm.head_dim = N_LAYERS, KV_HEADS, HEAD_DIM
+    kv_size = KV_HEADS * N_CTX * HEAD_DIM
+    llm._kv = [[np.zeros(kv_size, dtype=np.float32) for _ in range(2 * N_LAYERS)] for _ in range(2)]
+    llm._cur = 0
+    llm.input_ids, llm.n_tokens = [], 0
+    return llm
+
+
+def evaluate(llm, tokens):
+    llm.input_ids, llm.n_tokens = list(tokens), len(tokens)
+
+
+def kv_bytes(n_tokens):
+    return 2 * N_LAYERS * KV_HEADS * n_tokens * HEAD_DIM * 4
+
+
+def test_onnx_state_size():
+    llm = make_onnx_llama()
+    evaluate(llm, range(256))
+    assert kv_bytes(256) <= state_bytes(llm.save_state()) < kv_bytes(257)
+
+
+def test_budget_evicts_onnx_snapshots():
+    llm = make_onnx_llama()
+    cache = ChatStateCache(capacity_bytes=3 * kv_bytes(257))
+    for conversation in range(10):
+        evaluate(llm, [1000 + conversation] + list(range(255)))
+        cache.save(llm)
+        assert cache.used_bytes <= cache.capacity_bytes
+    assert len(cache.conversations) == 3
+    assert cache.stats["evictions"] == 7
+
+    cache = ChatStateCache(capacity_bytes=kv_bytes(128))
+    cache.save(llm)
+    assert not cache.conversations and cache.stats["oversize"] == 1
+
+
+if __name__ == "__main__":
+    test_onnx_state_size()
+    test_budget_evicts_onnx_snapshots()
+    print("Chat cache budget checks PASSED")
+    sys.exit(0)
@@ -1,10 +1,11 @@
 import requests
 import time
 import json
-import difflib
 import re
 import statistics
 
+import metrics
+
 BASE_URL = "http://127.0.0.1:8000"
 
 class MetricsCalculator:
@@ -18,9 +19,7 @@ class MetricsCalculator:
 
     @staticmethod
     def edit_similarity(pred, expected):
-        if not pred and not expected: return 1.0
-        matcher = difflib.SequenceMatcher(None, pred, expected)
-        return matcher.ratio()
+        return metrics.edit_similarity(pred, expected)
 
     @staticmethod
     def perfect_line(pred, expected):
@@ -47,9 +46,7 @@ class MetricsCalculator:
 
     @staticmethod
     def persistence_rate(pred, expected):
-        matcher = difflib.SequenceMatcher(None, pred, expected)
-        match_len = sum(block.size for block in matcher.get_matching_blocks())
-        return match_len / len(pred) if len(pred) > 0 else 0
+        return metrics.persistence_rate(pred, expected)
 
 
 def run_test_case(mode, test_cases):
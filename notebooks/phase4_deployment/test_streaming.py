@@ -0,0 +1,142 @@
+"""
+Checks the streamed and msgpack completion channels (SSE, WebSocket)
+against the stub backend, without a model file or a running server.
+
+    python test_streaming.py   (or pytest test_streaming.py)
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+
+os.environ["BACKEND"] = "stub"
+os.environ.setdefault("MODEL_PATH", "stub")
+
+import httpx
+import msgpack
+from fastapi.testclient import TestClient
+
+import server_gguf
+
+N_CLIENTS = 5
+
+
+def sse_events(body: str):
+    return [json.loads(line[len("data: "):]) for line in body.split("\n\n")
+            if line.startswith("data: ") and line != "data: [DONE]"]
+
+
+def stream_content(body: str):
+    """Text, finish reason and usage of each chunk; ids and timestamps are per request."""
+    return [(chunk["choices"][0]["text"], chunk["choices"][0]["finish_reason"], chunk.get("usage"))
+            for chunk in sse_events(body)]
+
+
+async def concurrent_streams(payload: dict, n: int):
+    app = server_gguf.app
+    async with server_gguf.lifespan(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            before = dict(server_gguf.inflight.stats)
+            responses = await asyncio.gather(*(client.post("/v1/completions", json=payload) for _ in range(n)))
+            after = dict(server_gguf.inflight.stats)
+            users = {model_id: entry.users for model_id, entry in server_gguf.model_state["registry"].loaded.items()}
+    return responses, before, after, users
+
+
+def test_identical_streams_share_one_generation():
+    payload = {"prompt": "def add(a, b):\n    return", "max_tokens": 16, "temperature": 0, "stream": True}
+    responses, before, after, users = asyncio.run(concurrent_streams(payload, N_CLIENTS))
+
+    assert all(r.status_code == 200 for r in responses)
+    streams = [stream_content(r.text) for r in responses]
+    assert len(streams[0]) > 2, "expected several delta chunks and a final chunk"
+    assert all(stream == streams[0] for stream in streams)
+    assert after["executed"] - before["executed"] == 1
+    assert after["coalesced"] - before["coalesced"] == N_CLIENTS - 1
+    assert not any(users.values()), "every request must release its model"
+
+
+def test_sampled_streams_are_not_shared():
+    payload = {"prompt": "x = ", "max_tokens": 4, "temperature": 0.5, "stream": True}
+    _, before, after, _ = asyncio.run(concurrent_streams(payload, 2))
+    assert after["executed"] - before["executed"] == 2
+    assert after["coalesced"] == before["coalesced"]
+
+
+async def abandon_stream(leave: str):
+    """Reads one delta of a long stream, then leaves; returns how long the model stayed in use."""
+    app = server_gguf.app
+    async with server_gguf.lifespan(app):
+        entry = await server_gguf.acquire_model(None)
+        request = server_gguf.CompletionRequest(prompt="def long_function():\n", max_tokens=64)
+        gone = asyncio.Event()
+
+        async def disconnected():
+            return gone.is_set()
+
+        events = server_gguf.stream_completion(entry, request, 1, time.monotonic(), disconnected=disconnected)
+        start = time.monotonic()
+        async for event in events:
+            assert "delta" in event
+            if leave == "close":
+                break
+            gone.set()
+        await events.aclose()
+        while entry.users and time.monotonic() - start < 5:
+            await asyncio.sleep(0.01)
+        return time.monotonic() - start, dict(server_gguf.deadline_stats)
+
+
+def test_abandoned_stream_stops_generation():
+    # 64 stub tokens take about 1.3s; generation must stop right after the client goes away
+    for leave in ("close", "disconnect"):
+        before = server_gguf.deadline_stats["cancelled"]
+        elapsed, stats = asyncio.run(abandon_stream(leave))
+        assert elapsed < 0.6, (leave, elapsed)
+        assert stats["cancelled"] == before + 1
+
+
+def test_ws_survives_invalid_frames():
+    with TestClient(server_gguf.app) as client:
+        with client.websocket_connect("/v1/completions/ws") as ws:
+            for frame in (b"\xc1", msgpack.packb([1, 2]), msgpack.packb({"id": 7, "maxTokens": 4})):
+                ws.send_bytes(frame)
+                reply = msgpack.unpackb(ws.receive_bytes())
+                assert reply["code"] == 400 and "error" in reply
+            assert reply["id"] == 7
+
+            ws.send_text("{}")
+            assert msgpack.unpackb(ws.receive_bytes())["code"] == 400
+
+            ws.send_bytes(msgpack.packb({"id": 8, "prompt": "x = ", "maxTokens": "abc"}))
+            reply = msgpack.unpackb(ws.receive_bytes())
+            assert reply["code"] == 400 and "maxTokens" in reply["error"]
+
+            # The connection is still usable
+            ws.send_bytes(msgpack.packb({"id": 9, "prompt": "x = ", "maxTokens": 4, "stream": True}))
+            while "delta" in (reply := msgpack.unpackb(ws.receive_bytes())):
+                assert reply["id"] == 9
+            assert reply["done"] and reply["id"] == 9
+
+
+def test_msgpack_rejects_invalid_fields():
+    with TestClient(server_gguf.app) as client:
+        for body in ({"prompt": "x", "maxTokens": "abc"}, {"prompt": "x", "stop": {"a": 1}}, {"maxTokens": 4}):
+            response = client.post("/v1/completions/msgpack", content=msgpack.packb(body),
+                                   headers={"Content-Type": "application/x-msgpack"})
+            assert response.status_code == 400, response.text
+        response = client.post("/v1/completions/msgpack", content=msgpack.packb({"prompt": "x = ", "maxTokens": 4}),
+                               headers={"Content-Type": "application/x-msgpack"})
+        assert response.status_code == 200
+
+
+if __name__ == "__main__":
+    test_identical_streams_share_one_generation()
+    test_sampled_streams_are_not_shared()
+    test_abandoned_stream_stops_generation()
+    test_ws_survives_invalid_frames()
+    test_msgpack_rejects_invalid_fields()
+    print("Streaming checks PASSED")
+    sys.exit(0)
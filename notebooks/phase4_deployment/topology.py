@@ -0,0 +1,163 @@
+import os
+import math
+import logging
+from typing import Dict, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+SYS_CPU = "/sys/devices/system/cpu"
+SYS_NODE = "/sys/devices/system/node"
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+
+def parse_cpulist(text: str) -> Set[int]:
+    """Parses a Linux CPU list such as '0-3,8,10-11'."""
+    cpus = set()
+    for part in text.strip().split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            lo, hi = part.split("-", 1)
+            cpus.update(range(int(lo), int(hi) + 1))
+        else:
+            cpus.add(int(part))
+    return cpus
+
+
+def _read(path: str) -> Optional[str]:
+    try:
+        with open(path, "r") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def cgroup_cpu_limit() -> Optional[float]:
+    """
+    CPUs granted by the container's CFS quota (e.g. `docker run --cpus`),
+    from cgroup v2 cpu.max or cgroup v1 cpu.cfs_quota_us. None if unlimited.
+    """
+    cpu_max = _read(os.path.join(CGROUP_ROOT, "cpu.max"))
+    if cpu_max:
+        quota, _, period = cpu_max.partition(" ")
+        if quota != "max" and period:
+            return int(quota) / int(period)
+        return None
+
+    quota = _read(os.path.join(CGROUP_ROOT, "cpu", "cpu.cfs_quota_us")) \
+        or _read(os.path.join(CGROUP_ROOT, "cpu,cpuacct", "cpu.cfs_quota_us"))
+    period = _read(os.path.join(CGROUP_ROOT, "cpu", "cpu.cfs_period_us")) \
+        or _read(os.path.join(CGROUP_ROOT, "cpu,cpuacct", "cpu.cfs_period_us"))
+    if quota and period and int(quota) > 0:
+        return int(quota) / int(period)
+    return None
+
+
+def allowed_cpus() -> Set[int]:
+    """Logical CPUs this process may run on (cpuset / affinity mask)."""
+    if hasattr(os, "sched_getaffinity"):
+        return set(os.sched_getaffinity(0))
+    return set(range(os.cpu_count() or 1))
+
+
+def physical_cores(cpus: Set[int]) -> List[int]:
+    """
+    One logical CPU per physical core among `cpus`, so hyperthread siblings
+    are not counted twice. Falls back to all of `cpus` without sysfs.
+    """
+    primaries = {}
+    for cpu in sorted(cpus):
+        siblings = _read(os.path.join(SYS_CPU, f"cpu{cpu}", "topology", "thread_siblings_list"))
+        key = min(parse_cpulist(siblings)) if siblings else cpu
+        primaries.setdefault(key, cpu)
+    return sorted(primaries.values())
+
+
+def numa_nodes(cpus: Set[int]) -> Dict[int, Set[int]]:
+    """Allowed logical CPUs per NUMA node; a single node 0 without sysfs."""
+    nodes = {}
+    if os.path.isdir(SYS_NODE):
+        for name in os.listdir(SYS_NODE):
+            if not name.startswith("node") or not name[4:].isdigit():
+                continue
+            cpulist = _read(os.path.join(SYS_NODE, name, "cpulist"))
+            node_cpus = parse_cpulist(cpulist) & cpus if cpulist else set()
+            if node_cpus:
+                nodes[int(name[4:])] = node_cpus
+    return nodes or {0: set(cpus)}
+
+
+class ThreadPlan:
+    """
+    Thread counts for llama.cpp and the CPUs to pin the process to.
+
+    Decode is memory-bandwidth bound and loses to hyperthread siblings and
+    cross-node memory traffic, so it gets one thread per physical core of the
+    chosen NUMA node. Prompt evaluation is compute bound and may use every
+    logical CPU of that node. Both stay within the cgroup CPU quota.
+    """
+    def __init__(self, n_threads: int, n_threads_batch: int, affinity: Optional[Set[int]], info: dict):
+        self.n_threads = n_threads
+        self.n_threads_batch = n_threads_batch
+        self.affinity = affinity
+        self.info = info
+
+    @classmethod
+    def detect(cls) -> "ThreadPlan":
+        """
+        Plans from the detected topology. N_THREADS, N_THREADS_BATCH and
+        CPU_AFFINITY ('auto', 'none' or a CPU list like '0-7') override it.
+        """
+        cpus = allowed_cpus()
+        quota = cgroup_cpu_limit()
+        nodes = numa_nodes(cpus)
+
+        affinity_env = os.getenv("CPU_AFFINITY", "auto").strip().lower()
+        if affinity_env not in ("auto", "none", ""):
+            affinity = parse_cpulist(affinity_env) & cpus or None
+            node_cpus = affinity or cpus
+        elif len(nodes) > 1:
+            # Keep threads and the memory they touch on one node
+            node_cpus = max(nodes.values(), key=lambda c: (len(physical_cores(c)), len(c)))
+            affinity = node_cpus if affinity_env == "auto" else None
+        else:
+            node_cpus = cpus
+            affinity = None
+
+        # Whole CPUs granted by the quota, less one for the event loop and tokenization
+        budget = len(node_cpus)
+        if quota is not None:
+            budget = min(budget, max(1, math.floor(quota)))
+        reserve = 1 if budget > 2 else 0
+
+        physical = physical_cores(node_cpus)
+        n_threads = max(1, min(len(physical), budget - reserve))
+        n_threads_batch = max(1, min(len(node_cpus), budget - reserve))
+
+        if os.getenv("N_THREADS"):
+            n_threads = int(os.getenv("N_THREADS"))
+        if os.getenv("N_THREADS_BATCH"):
+            n_threads_batch = int(os.getenv("N_THREADS_BATCH"))
+
+        info = {
+            "logical_cpus": len(cpus),
+            "physical_cores": len(physical_cores(cpus)),
+            "numa_nodes": len(nodes),
+            "cgroup_cpu_limit": quota,
+            "n_threads": n_threads,
+            "n_threads_batch": n_threads_batch,
+            "affinity": sorted(affinity) if affinity else None,
+        }
+        return cls(n_threads, n_threads_batch, affinity, info)
+
+    def apply_affinity(self):
+        """Pins every thread of the process, and threads started later, to the planned CPUs."""
+        if not self.affinity or not hasattr(os, "sched_setaffinity"):
+            return
+        try:
+            # On Linux the mask is per thread; threads inherit it from their creator
+            for tid in os.listdir("/proc/self/task"):
+                os.sched_setaffinity(int(tid), self.affinity)
+        except OSError as e:
+            logger.warning(f"Could not set CPU affinity: {e}")
@@ -1,6 +1,8 @@
+import os
 import re
-import difflib
-from typing import List
+from typing import List, Optional
+
+import metrics
 
 def get_stop_tokens() -> List[str]:
     """Returns the standard stop tokens for the model."""
@@ -42,6 +44,26 @@ def detect_language(code: str) -> str:
         
     return "unknown"
 
+# Editor language ids and file extensions mapped to the languages of detect_language
+LANGUAGE_ALIASES = {
+    "python": "python", "py": "python", "pyi": "python",
+    "cpp": "cpp", "c++": "cpp", "c": "cpp", "cc": "cpp", "cxx": "cpp", "h": "cpp", "hpp": "cpp",
+    "java": "java",
+    "javascript": "javascript", "js": "javascript", "jsx": "javascript", "javascriptreact": "javascript",
+    "typescript": "javascript", "ts": "javascript", "tsx": "javascript", "typescriptreact": "javascript",
+}
+
+def resolve_language(language: Optional[str] = None, path: Optional[str] = None) -> Optional[str]:
+    """
+    Language of a request from the editor's language id, or else the file
+    extension; None when neither is known, so the caller falls back to detect_language.
+    """
+    if language and language.lower() in LANGUAGE_ALIASES:
+        return LANGUAGE_ALIASES[language.lower()]
+    if path:
+        return LANGUAGE_ALIASES.get(os.path.splitext(path)[1].lstrip(".").lower())
+    return None
+
 def get_stop_for_lang(lang: str, is_block: bool) -> List[str]:
     """
     Returns language-specific stop tokens to prevent runaway generation.
@@ -65,21 +87,65 @@ def get_stop_for_lang(lang: str, is_block: bool) -> List[str]:
              
     return stops
 
+# Pattern for common secrets (simplified for performance)
+# Matches strings that look like API keys or passwords
+FORBIDDEN_PATTERN = re.compile(
+    r"(sk-[a-zA-Z0-9]{20,}|password\s*[:=]|api[_-]?key|secret[_-]?key)", 
+    re.IGNORECASE
+)
+# Text that may still grow into a FORBIDDEN_PATTERN match
+FORBIDDEN_KEYWORDS = ("sk-", "password", "api_key", "api-key", "apikey", "secret_key", "secret-key", "secretkey")
+PARTIAL_FORBIDDEN = re.compile(r"(sk-[a-zA-Z0-9]*|password\s*)\Z", re.IGNORECASE)
+PARTIAL_LOOKBACK = 64
+
 def filter_sensitive_output(text: str) -> str:
     """
     Filters out potential sensitive information using regex.
     """
-    # Pattern for common secrets (simplified for performance)
-    # Matches strings that look like API keys or passwords
-    forbidden_pattern = re.compile(
-        r"(sk-[a-zA-Z0-9]{20,}|password\s*[:=]|api[_-]?key|secret[_-]?key)", 
-        re.IGNORECASE
-    )
-    
-    if forbidden_pattern.search(text):
+    if FORBIDDEN_PATTERN.search(text):
         return ""
     return text
 
+class SensitiveOutputStream:
+    """
+    filter_sensitive_output for streamed text. A delta is passed to `emit`
+    only up to the point where the text could not be the beginning of a
+    forbidden match; the tail is held back until more text arrives or
+    close() is called. Once the text matches, nothing more is emitted and
+    `blocked` is set, as the final text is blanked.
+    """
+    def __init__(self, emit):
+        self.emit = emit
+        self.text = ""
+        self.sent = 0
+        self.blocked = False
+
+    def write(self, delta: str):
+        if self.blocked or not delta:
+            return
+        self.text += delta
+        if FORBIDDEN_PATTERN.search(self.text):
+            self.blocked = True
+            return
+        self._send(self._safe_end())
+
+    def close(self):
+        """Emits the held back tail; generation is over, so it cannot grow into a match."""
+        if not self.blocked:
+            self._send(len(self.text))
+
+    def _safe_end(self) -> int:
+        for start in range(max(self.sent, len(self.text) - PARTIAL_LOOKBACK), len(self.text)):
+            tail = self.text[start:]
+            if PARTIAL_FORBIDDEN.match(tail) or any(k.startswith(tail.lower()) for k in FORBIDDEN_KEYWORDS):
+                return start
+        return len(self.text)
+
+    def _send(self, end: int):
+        if end > self.sent:
+            self.emit(self.text[self.sent:end])
+            self.sent = end
+
 class MetricsCalculator:
     """
     Utilities for calculating code completion metrics.
@@ -90,10 +156,7 @@ class MetricsCalculator:
     
     @staticmethod
     def edit_similarity(pred: str, expected: str) -> float:
-        if not pred and not expected:
-            return 1.0
-        matcher = difflib.SequenceMatcher(None, pred, expected)
-        return matcher.ratio()
+        return metrics.edit_similarity(pred, expected)
     
     @staticmethod
     def exact_match(pred: str, expected: str) -> float: